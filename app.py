@@ -2,13 +2,21 @@ from flask import Flask, request, jsonify, render_template, send_from_directory
 import os
 import json
 from model_integration import ModelIntegration
+from inference_daemon import InferenceClient
 
 app = Flask(__name__)
 
 # Initialize the model integration with Hugging Face Transformers
 # By default, we use mock mode for GitHub Codespaces to avoid loading the large model
-# Set use_mock=False to use the actual UnfilteredAI/NSFW-3B model
-model = ModelIntegration(model_name="UnfilteredAI/NSFW-3B", use_mock=True)  # Mock mode for GitHub Codespaces
+# Set USE_MOCK=0 to use the actual model (MODEL_NAME, default UnfilteredAI/NSFW-3B)
+# With INFERENCE_SOCKET set, the model is served by a separate inference daemon (see inference_daemon.py)
+if os.environ.get('INFERENCE_SOCKET'):
+    model = InferenceClient(os.environ['INFERENCE_SOCKET'])
+else:
+    model = ModelIntegration(
+        model_name=os.environ.get('MODEL_NAME', "UnfilteredAI/NSFW-3B"),
+        use_mock=os.environ.get('USE_MOCK', '1').lower() in ('1', 'true', 'yes')  # Mock mode for GitHub Codespaces
+    )
 
 # Serve the static HTML file
 @app.route('/')
@@ -1,20 +1,338 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, g
 from flask_cors import CORS
 import os
 import json
-from model_integration_pipeline import ModelIntegrationPipeline
+import time
+import queue
+import threading
+from model_integration_pipeline import (ModelIntegrationPipeline, MemoryBudgetExceeded, GENRES, LENGTH_TO_TOKENS,
+                                        BASE_ADAPTER)
+from fair_scheduler import FairScheduler, RateLimitExceeded, QueueFull, request_cost
+from length_predictor import OutputLengthPredictor
+from tracing import tracer, child_span, record_span
+from story_sessions import SessionStore
+from slo_controller import SLOController, LEVELS, parse_targets
+from response_cache import ResponseCache, SemanticCache, load_encoder
+from model_router import ModelRouter, QUALITY_TIERS, parse_models
+from inference_daemon import InferenceClient
+from story_pool import StoryPool, build_seeds
+from slow_profiler import profiler
+from cpu_autotune import load_tuning
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
 # Initialize the model with pipeline support (optimized for Pro accounts)
 # Set use_pipeline=True for better performance with Hugging Face Pro accounts
-model = ModelIntegrationPipeline(
-    model_name="UnfilteredAI/NSFW-3B", 
-    use_mock=True,  # Set to False to use actual model
-    use_pipeline=True  # Use efficient pipeline API
+# MODEL_NAME picks the model; it is mocked unless USE_MOCK=0
+if os.environ.get('INFERENCE_SOCKET'):
+    # The model lives in a separate inference daemon (see inference_daemon), shared by all web workers
+    model = InferenceClient(os.environ['INFERENCE_SOCKET'])
+else:
+    model = ModelIntegrationPipeline(
+        model_name=os.environ.get('MODEL_NAME', "UnfilteredAI/NSFW-3B"),
+        use_mock=os.environ.get('USE_MOCK', '1').lower() in ('1', 'true', 'yes'),
+        use_pipeline=True  # Use efficient pipeline API
+    )
+
+# Thread counts, core affinity and batch size found by cpu_autotune.py for this host (None if not tuned)
+cpu_tuning = load_tuning()
+
+# Per-client weighted fair queueing in front of the model, charged by token budget.
+# SCHEDULER_POLICY=sjf orders queued work by predicted output length instead.
+scheduler = FairScheduler(
+    workers=int(os.environ.get('SCHEDULER_WORKERS', 1)),
+    rate=float(os.environ.get('CLIENT_TOKENS_PER_SECOND', 200)),
+    burst=float(os.environ.get('CLIENT_TOKEN_BURST', 8192)),
+    policy=os.environ.get('SCHEDULER_POLICY', 'fair'),
+    # The batch size cpu_autotune.py found worth batching up to on this host
+    max_batch=int(os.environ.get('SCHEDULER_MAX_BATCH', (cpu_tuning or {}).get('max_batch', 8)))
+)
+
+# Runtime optimization profiles for /api/optimize. The model settings are applied by loading a new
+# instance in the background and swapping it in; the scheduler and cache settings apply at the swap.
+OPTIMIZATION_PROFILES = {
+    'speed': {
+        'torch_dtype': 'auto',
+        'quantization': 'int8',
+        'use_cache': True,
+        # The tuned count, if any: more threads would oversubscribe the CPUs the model is pinned to
+        'num_threads': cpu_tuning['num_threads'] if cpu_tuning else os.cpu_count(),
+        'batch_window': 0.05,
+        'response_cache_size': 2048,
+        'session_cache_bytes': 4 * 1024 ** 3
+    },
+    'balanced': {
+        'torch_dtype': 'auto',
+        'quantization': None,
+        'use_cache': True,
+        'num_threads': None,
+        'batch_window': 0.01,
+        'response_cache_size': 512,
+        'session_cache_bytes': 2 * 1024 ** 3
+    },
+    'quality': {
+        'torch_dtype': 'float32',
+        'quantization': None,
+        'use_cache': True,
+        'num_threads': None,
+        'batch_window': 0.0,
+        'response_cache_size': 512,
+        'session_cache_bytes': 2 * 1024 ** 3
+    }
+}
+MODEL_SETTINGS = ('torch_dtype', 'quantization', 'use_cache', 'num_threads')
+optimization = {'active_profile': None, 'pending': None, 'last': None}
+optimization_lock = threading.Lock()
+
+# Story sessions keep their KV cache between turns, so continuations only prefill the new instruction
+sessions = SessionStore(
+    max_bytes=int(os.environ.get('SESSION_CACHE_BYTES', 2 * 1024 ** 3)),
+    ttl=float(os.environ.get('SESSION_TTL', 1800)),
+    spill_dir=os.environ.get('SESSION_SPILL_DIR')
+)
+
+def register_caches(target):
+    """Count the session KV caches against the model's memory budget (MEMORY_BUDGET_MB)"""
+    if not isinstance(target, InferenceClient):
+        target.register_cache('sessions', lambda: sessions.get_stats()['resident_bytes'])
+
+register_caches(model)
+
+# Seconds a replaced model gets to finish its running generations before it is closed anyway
+MODEL_DRAIN_TIMEOUT = float(os.environ.get('MODEL_DRAIN_TIMEOUT', 600))
+
+def retire_model(old_model):
+    """Close a replaced model once the requests already running on it have finished"""
+    def drain():
+        if not old_model.wait_until_idle(MODEL_DRAIN_TIMEOUT):
+            print(f"⚠️ Closing {old_model.model_name} with generations still running after {MODEL_DRAIN_TIMEOUT}s")
+        old_model.close()
+    threading.Thread(target=drain, name='retire-model', daemon=True).start()
+
+# Retry-After sent with 503s for generations refused by the memory budget
+MEMORY_RETRY_AFTER = int(os.environ.get('MEMORY_RETRY_AFTER', 10))
+
+# Upper bound on candidates per /api/generate request
+MAX_CANDIDATES = int(os.environ.get('MAX_CANDIDATES', 4))
+
+# Under overload, each length bucket degrades step by step to stay within its p95 target:
+# capped max_new_tokens, then the smaller model (if SMALL_MODEL_NAME is set), then cached stories
+slo = SLOController(
+    parse_targets(os.environ.get('SLO_P95_TARGETS', 'short:15,medium:30,long:60')),
+    cooldown=float(os.environ.get('SLO_COOLDOWN', 15))
+)
+SLO_TOKEN_CAP = float(os.environ.get('SLO_TOKEN_CAP', 0.5))  # Fraction of the length budget when capped
+small_model = None
+if os.environ.get('SMALL_MODEL_NAME'):
+    small_model = ModelIntegrationPipeline(
+        model_name=os.environ['SMALL_MODEL_NAME'],
+        use_mock=model.mock_mode,
+        use_pipeline=True
+    )
+response_cache = ResponseCache(max_entries=int(os.environ.get('RESPONSE_CACHE_SIZE', 512)))
+
+# Opt-in (SEMANTIC_CACHE=1): a rephrasing of an earlier prompt gets the earlier story at any load.
+# SEMANTIC_CACHE_ENCODER is a small local sentence encoder, or 'hashing' for one without a model.
+semantic_cache = None
+if os.environ.get('SEMANTIC_CACHE', '').lower() in ('1', 'true', 'yes'):
+    semantic_threshold = os.environ.get('SEMANTIC_CACHE_THRESHOLD')  # Defaults to the encoder's
+    semantic_cache = SemanticCache(
+        load_encoder(os.environ.get('SEMANTIC_CACHE_ENCODER', 'sentence-transformers/all-MiniLM-L6-v2')),
+        capacity=int(os.environ.get('SEMANTIC_CACHE_SIZE', 1024)),
+        threshold=float(semantic_threshold) if semantic_threshold else None,
+        ttl=float(os.environ.get('SEMANTIC_CACHE_TTL', 3600))
+    )
+
+# Resident model pool: each request goes to the cheapest model meeting its quality tier and latency budget.
+# ROUTER_MODELS adds models as 'name:tier:cost,...'; the default model serves every tier unless listed there.
+router = ModelRouter()
+router_specs = parse_models(os.environ.get('ROUTER_MODELS', ''))
+default_spec = next((s for s in router_specs if s['name'] == model.model_name), {'tier': 'premium', 'cost': 1.0})
+router.add(model, default_spec['tier'], default_spec['cost'])
+for spec in router_specs:
+    if spec['name'] != model.model_name:
+        router.add(ModelIntegrationPipeline(model_name=spec['name'], use_mock=model.mock_mode, use_pipeline=True),
+                   spec['tier'], spec['cost'])
+
+# While the server is idle, stories are pre-generated for every genre and length (and the example prompts)
+# and handed out instantly to matching requests. STORY_POOL_SIZE=0 disables it; the model must be in-process.
+story_pool = None
+if int(os.environ.get('STORY_POOL_SIZE', 2)) > 0 and not isinstance(model, InferenceClient):
+    story_pool = StoryPool(
+        model,
+        build_seeds(GENRES, list(LENGTH_TO_TOKENS)),
+        per_key=int(os.environ.get('STORY_POOL_SIZE', 2)),
+        ttl=float(os.environ.get('STORY_POOL_TTL', 3600)),
+        idle_delay=float(os.environ.get('STORY_POOL_IDLE_DELAY', 2)),
+        is_busy=lambda: not scheduler.is_idle()
+    )
+    story_pool.start()
+
+# Learns actual output lengths from finished generations (persisted if GENERATION_HISTORY is set)
+length_predictor = OutputLengthPredictor(
+    history_path=os.environ.get('GENERATION_HISTORY'),
+    max_history=int(os.environ.get('GENERATION_HISTORY_MAX', 5000))
 )
 
+def get_client_id():
+    """Identify the caller by API key, falling back to the remote address"""
+    return request.headers.get('X-API-Key') or request.remote_addr or 'anonymous'
+
+def run_generation(prompt, genre, length, temperature, deadline, queued_at, n=1, backend=None, max_tokens=None,
+                   route=None, adapter=None):
+    """Generate a story (or n ranked candidates) on a scheduler worker and record actual lengths"""
+    started_at = time.time()
+    record_span('queue', queued_at, started_at)
+    backend = backend or model
+    candidates = []
+    try:
+        if n > 1:
+            candidates = backend.generate_candidates(prompt, genre, length, n, temperature,
+                                                     max_tokens=max_tokens, deadline=deadline, adapter=adapter)
+        else:
+            candidates = [backend.generate_story_detailed(prompt, genre, length, temperature,
+                                                          max_tokens=max_tokens, deadline=deadline,
+                                                          adapter=adapter)]
+    finally:
+        if route is not None:
+            router.finish(route, time.time() - started_at, sum(c['tokens_generated'] for c in candidates))
+    record_results(prompt, genre, length, temperature, backend, max_tokens, candidates)
+    return candidates
+
+def run_generation_batch(batch):
+    """Generate stories for several compatible queued requests in one batched call (scheduler batching)"""
+    started_at = time.time()
+    record_span('queue', min(args[4] for args in batch), started_at)
+    backend = batch[0][5]
+    results = []
+    try:
+        results = backend.generate_stories([
+            {'prompt': prompt, 'genre': genre, 'length': length, 'temperature': temperature, 'adapter': adapter}
+            for prompt, genre, length, temperature, _, _, _, adapter in batch
+        ])
+    finally:
+        # The batch's generation time is shared by its requests
+        share = (time.time() - started_at) / len(batch)
+        for i, args in enumerate(batch):
+            if args[6] is not None:
+                router.finish(args[6], share, results[i]['tokens_generated'] if results else 0)
+    for (prompt, genre, length, temperature, _, _, _, _), result in zip(batch, results):
+        record_results(prompt, genre, length, temperature, backend, None, [result])
+    return [[result] for result in results]
+
+def record_results(prompt, genre, length, temperature, backend, max_tokens, candidates):
+    """Only full-quality generations teach the predictor and fill the response caches"""
+    if backend is not small_model and max_tokens is None:
+        for result in candidates:
+            if not result['truncated']:
+                length_predictor.record(genre, length, len(prompt), temperature, result['tokens_generated'])
+        # Stories are cached with the tier of the model that wrote them, so a draft-tier
+        # model's story is never served to a request asking for a better tier
+        tier = router.tier_of(backend)
+        if tier is not None and not candidates[0]['truncated']:
+            story, tokens = candidates[0]['story'], candidates[0]['tokens_generated']
+            response_cache.put(prompt, genre, length, story, tokens, tier)
+            if semantic_cache is not None:
+                semantic_cache.put(prompt, genre, length, story, tokens, tier, temperature)
+
+def meets_tier(backend, quality):
+    """True if a pooled model's tier is at least the requested quality"""
+    tier = router.tier_of(backend)
+    return tier is not None and QUALITY_TIERS.index(tier) >= QUALITY_TIERS.index(quality)
+
+def plan_degradation(prompt, genre, length, quality):
+    """
+    The degradation to apply to a request in this length bucket.
+    Levels whose resource is missing (no small model, nothing cached) fall through to the next milder one.
+    
+    Returns:
+        (level, mode, backend, max_tokens, cached story or None)
+    """
+    level = slo.level(length)
+    if level >= 3:
+        cached = response_cache.get(prompt, genre, length, tier=quality)
+        if cached is not None:
+            return 3, LEVELS[3], None, None, cached
+    if level >= 2 and small_model is not None:
+        return 2, LEVELS[2], small_model, None, None
+    if level >= 1:
+        return 1, LEVELS[1], model, max(1, int(LENGTH_TO_TOKENS[length] * SLO_TOKEN_CAP)), None
+    return 0, LEVELS[0], model, None, None
+
+def run_stream_generation(chunks, cancelled, prompt, genre, length, temperature, adapter, queued_at):
+    """Stream a story into the `chunks` queue on a scheduler worker; None marks the end"""
+    record_span('queue', queued_at, time.time())
+    stream = None
+    try:
+        stream = model.generate_story_stream(prompt, genre, length, temperature, adapter=adapter, raw=True)
+        for chunk in stream:
+            if cancelled.is_set():
+                break
+            chunks.put(chunk)
+    except Exception as e:
+        # Before the first chunk the handler can still answer with an error status (503 for the memory budget)
+        chunks.put(e)
+    finally:
+        # Closing the stream early stops the generation
+        if stream is not None:
+            stream.close()
+        chunks.put(None)
+
+def model_is_remote():
+    return isinstance(model, InferenceClient)
+
+def remote_model_response():
+    return jsonify({'error': 'Not available while the model runs in the inference daemon (INFERENCE_SOCKET)'}), 501
+
+def run_session_generation(session, prompt, temperature, queued_at):
+    """Generate the next part of a story session on a scheduler worker"""
+    record_span('queue', queued_at, time.time())
+    try:
+        with session.lock:
+            return model.generate_in_session(session, prompt, temperature)
+    finally:
+        sessions.release(session)  # Unpins it (pinned by create() or get(pin=True))
+
+def rate_limited_response(e):
+    response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+    response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+    return response, 429
+
+def memory_exceeded_response(e):
+    response = jsonify({'error': str(e), 'required_bytes': e.required, 'available_bytes': e.available,
+                        'retry_after': MEMORY_RETRY_AFTER})
+    response.headers['Retry-After'] = str(MEMORY_RETRY_AFTER)
+    return response, 503
+
+@app.before_request
+def start_trace():
+    """Continue the caller's trace (traceparent header) or start a new one"""
+    g.trace_span = tracer.start_span(
+        f"{request.method} {request.path}", traceparent=request.headers.get('traceparent'), kind='server'
+    ).activate()
+
+@app.before_request
+def pause_story_pool():
+    """Any generation request stops the idle-time pool refill right away"""
+    if story_pool is not None and request.method == 'POST':
+        story_pool.note_request()
+
+@app.after_request
+def add_trace_headers(response):
+    span = g.get('trace_span')
+    if span is not None:
+        span.set_attribute('http.status_code', response.status_code)
+        response.headers['traceparent'] = span.traceparent
+        response.headers['X-Trace-Id'] = span.trace_id
+    return response
+
+@app.teardown_request
+def finish_trace(exc):
+    span = g.pop('trace_span', None)
+    if span is not None:
+        span.finish()
+
 @app.route('/')
 def index():
     """Serve the main HTML page"""
@@ -31,40 +349,318 @@ def generate_story():
         genre = data.get('genre', 'romance')
         length = data.get('length', 'medium')
         temperature = float(data.get('temperature', 0.7))
+        n = int(data.get('n', 1))
+        quality = data.get('quality', 'standard')
+        adapter = data.get('adapter')  # LoRA adapter name (defaults to the genre's, if loaded)
+        any_prompt = bool(data.get('any_prompt', False))  # Any ready story of this genre and length will do
+        
+        # Optional time budget in seconds, as a field or an X-Request-Deadline header
+        deadline_seconds = data.get('deadline_seconds', request.headers.get('X-Request-Deadline'))
         
         # Validate inputs
         if not prompt:
             return jsonify({'error': 'Prompt is required'}), 400
         
-        if genre not in ['romance', 'fantasy', 'sci-fi', 'contemporary', 'historical']:
+        if genre not in GENRES:
             return jsonify({'error': 'Invalid genre'}), 400
         
-        if length not in ['short', 'medium', 'long']:
+        if length not in LENGTH_TO_TOKENS:
             return jsonify({'error': 'Invalid length'}), 400
         
         if not 0.0 <= temperature <= 1.0:
             return jsonify({'error': 'Temperature must be between 0.0 and 1.0'}), 400
         
-        # Generate the story
-        story = model.generate_story(prompt, genre, length, temperature)
+        if not 1 <= n <= MAX_CANDIDATES:
+            return jsonify({'error': f'n must be between 1 and {MAX_CANDIDATES}'}), 400
+        
+        if quality not in QUALITY_TIERS:
+            return jsonify({'error': f'quality must be one of {list(QUALITY_TIERS)}'}), 400
+        
+        if adapter is not None and adapter != BASE_ADAPTER and adapter not in model.adapters:
+            return jsonify({'error': f'Unknown adapter: {adapter}'}), 400
+        
+        deadline = None
+        if deadline_seconds is not None:
+            deadline_seconds = float(deadline_seconds)
+            if deadline_seconds <= 0:
+                return jsonify({'error': 'deadline_seconds must be positive'}), 400
+            deadline = time.time() + deadline_seconds
+        
+        ticket = slo.start(length)
+        try:
+            pooled = similar = None
+            if n == 1 and adapter is None:
+                # Only stories written at the request's temperature by a model of its tier (or better);
+                # a deadline is always met, since they are served without queueing
+                if story_pool is not None and meets_tier(model, quality):
+                    pooled = story_pool.take(prompt, genre, length, any_prompt, temperature=temperature)
+                if pooled is None and semantic_cache is not None:
+                    similar = semantic_cache.get(prompt, genre, length, tier=quality, temperature=temperature)
+            if pooled is not None or similar is not None:
+                # Pre-generated while idle, or written for a near-identical prompt; served without queueing
+                level, mode, backend, max_tokens, cached = 0, LEVELS[0], None, None, pooled or similar
+            else:
+                level, mode, backend, max_tokens, cached = plan_degradation(prompt, genre, length, quality)
+            degradation = {'level': level, 'mode': mode}
+            route = None
+            if cached is not None:
+                # Deepest degradation: answer from the response cache without queueing
+                if pooled is None and similar is None:
+                    degradation['cache_match'] = cached['match']
+                candidates = [{'story': cached['story'], 'truncated': False,
+                               'tokens_generated': cached['tokens_generated'], 'score': 0.0}]
+                backend = model
+            else:
+                if backend is model and adapter is None:
+                    # Normal and capped requests go to the cheapest resident model that fits
+                    # (requests naming an adapter stay on the model it is attached to)
+                    route = router.route(quality, max_tokens or LENGTH_TO_TOKENS[length], deadline_seconds)
+                    backend = route['backend']
+                # Generate the story once the scheduler gives this client its turn
+                predicted_cost = length_predictor.predict(genre, length, len(prompt), temperature, max_tokens)
+                try:
+                    if scheduler.batch_window > 0 and n == 1 and deadline is None and max_tokens is None:
+                        # Plain requests may share one batched generate call with compatible queued ones
+                        future = scheduler.submit(
+                            get_client_id(), request_cost(length),
+                            run_generation_batch, prompt, genre, length, temperature, time.time(),
+                            backend, route, adapter,
+                            predicted_cost=predicted_cost, batch_key=(id(backend), length, temperature)
+                        )
+                    else:
+                        # Every candidate decodes its own tokens, so n candidates cost n times the budget
+                        future = scheduler.submit(
+                            get_client_id(), request_cost(length, max_tokens) * n,
+                            run_generation, prompt, genre, length, temperature, deadline, time.time(), n,
+                            backend, max_tokens, route, adapter,
+                            predicted_cost=predicted_cost
+                        )
+                except RateLimitExceeded as e:
+                    if route is not None:
+                        router.cancel(route)
+                    return rate_limited_response(e)
+                except QueueFull as e:
+                    if route is not None:
+                        router.cancel(route)
+                    return jsonify({'error': str(e)}), 503
+                candidates = future.result()
+        finally:
+            slo.finish(ticket)
+        result = candidates[0]
         
         # Get model info for response
-        model_info = model.get_model_info()
+        model_info = backend.get_model_info()
         
-        return jsonify({
-            'story': story,
-            'model_info': model_info,
-            'parameters': {
-                'prompt': prompt,
-                'genre': genre,
-                'length': length,
-                'temperature': temperature
+        with child_span('serialize'):
+            payload = {
+                'story': result['story'],
+                'truncated': result['truncated'],
+                'tokens_generated': result['tokens_generated'],
+                'adapter': result.get('adapter'),
+                'degradation': degradation,
+                'routing': {key: route[key] for key in ('model', 'tier', 'estimated_seconds', 'met_budget')}
+                           if route is not None else None,
+                'pool': {key: pooled[key] for key in ('match', 'prompt', 'age_seconds')}
+                        if pooled is not None else None,
+                'semantic_cache': {key: similar[key] for key in ('similarity', 'prompt')}
+                                  if similar is not None else None,
+                'model_info': model_info,
+                'parameters': {
+                    'prompt': prompt,
+                    'genre': genre,
+                    'length': length,
+                    'temperature': temperature,
+                    'deadline_seconds': deadline_seconds,
+                    'n': n,
+                    'quality': quality,
+                    'adapter': adapter,
+                    'any_prompt': any_prompt
+                }
             }
+            if n > 1 and len(candidates) > 1:
+                # Best first; `story` above is the top-ranked candidate
+                payload['candidates'] = [
+                    {key: c[key] for key in ('story', 'score', 'truncated', 'tokens_generated')}
+                    for c in candidates
+                ]
+            response = jsonify(payload)
+        return response
+        
+    except MemoryBudgetExceeded as e:
+        return memory_exceeded_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/generate/stream', methods=['POST'])
+def generate_story_stream():
+    """Stream a story as plain text while it is generated"""
+    try:
+        data = request.get_json()
+        prompt = data.get('prompt', '')
+        genre = data.get('genre', 'romance')
+        length = data.get('length', 'medium')
+        temperature = float(data.get('temperature', 0.7))
+        adapter = data.get('adapter')
+        
+        if not prompt:
+            return jsonify({'error': 'Prompt is required'}), 400
+        if genre not in GENRES:
+            return jsonify({'error': 'Invalid genre'}), 400
+        if length not in LENGTH_TO_TOKENS:
+            return jsonify({'error': 'Invalid length'}), 400
+        if not 0.0 <= temperature <= 1.0:
+            return jsonify({'error': 'Temperature must be between 0.0 and 1.0'}), 400
+        if adapter is not None and adapter != BASE_ADAPTER and adapter not in model.adapters:
+            return jsonify({'error': f'Unknown adapter: {adapter}'}), 400
+        
+        # The story is generated on a scheduler worker, so streams queue fairly with other requests
+        chunks = queue.Queue()
+        cancelled = threading.Event()
+        try:
+            scheduler.submit(
+                get_client_id(), request_cost(length),
+                run_stream_generation, chunks, cancelled, prompt, genre, length, temperature, adapter, time.time()
+            )
+        except RateLimitExceeded as e:
+            return rate_limited_response(e)
+        except QueueFull as e:
+            return jsonify({'error': str(e)}), 503
+        
+        first = chunks.get()
+        if isinstance(first, MemoryBudgetExceeded):
+            return memory_exceeded_response(first)
+        if isinstance(first, Exception):
+            return jsonify({'error': str(first)}), 500
+        
+        def relay():
+            # Chunks are UTF-8 bytes straight from the model (or the daemon's socket)
+            try:
+                chunk = first
+                while chunk is not None:
+                    if isinstance(chunk, Exception):
+                        # The status is already sent; end the story where it failed
+                        print(f"❌ Stream failed after the first chunk: {chunk}")
+                        break
+                    yield chunk
+                    chunk = chunks.get()
+            finally:
+                cancelled.set()  # The client went away (or the story ended)
+        
+        return Response(relay(), mimetype='text/plain; charset=utf-8')
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/sessions', methods=['POST'])
+def create_session():
+    """Start a story session; its KV cache is kept for later continuations"""
+    if model_is_remote():
+        return remote_model_response()
+    try:
+        data = request.get_json()
+        prompt = data.get('prompt', '')
+        genre = data.get('genre', 'romance')
+        length = data.get('length', 'medium')
+        temperature = float(data.get('temperature', 0.7))
+        
+        if not prompt:
+            return jsonify({'error': 'Prompt is required'}), 400
+        if genre not in GENRES:
+            return jsonify({'error': 'Invalid genre'}), 400
+        if length not in LENGTH_TO_TOKENS:
+            return jsonify({'error': 'Invalid length'}), 400
+        if not 0.0 <= temperature <= 1.0:
+            return jsonify({'error': 'Temperature must be between 0.0 and 1.0'}), 400
+        
+        session = sessions.create(genre, length)
+        try:
+            future = scheduler.submit(
+                get_client_id(), request_cost(length),
+                run_session_generation, session, prompt, temperature, time.time()
+            )
+        except RateLimitExceeded as e:
+            sessions.delete(session.session_id)
+            return rate_limited_response(e)
+        except QueueFull as e:
+            sessions.delete(session.session_id)
+            return jsonify({'error': str(e)}), 503
+        result = future.result()
+        
+        return jsonify({
+            'session_id': session.session_id,
+            'story': result['story'],
+            'tokens_generated': result['tokens_generated'],
+            'prefill_tokens': result['prefill_tokens'],
+            'session': session.to_dict()
         })
         
+    except MemoryBudgetExceeded as e:
+        return memory_exceeded_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/sessions/<session_id>/continue', methods=['POST'])
+def continue_session(session_id):
+    """Continue a story session, prefilling only the new instruction"""
+    if model_is_remote():
+        return remote_model_response()
+    try:
+        data = request.get_json()
+        instruction = data.get('instruction', '')
+        temperature = float(data.get('temperature', 0.7))
+        
+        if not instruction:
+            return jsonify({'error': 'Instruction is required'}), 400
+        if not 0.0 <= temperature <= 1.0:
+            return jsonify({'error': 'Temperature must be between 0.0 and 1.0'}), 400
+        
+        # Pinned while the continuation is queued, so another session's release() can't spill its cache
+        session = sessions.get(session_id, pin=True)
+        if session is None:
+            return jsonify({'error': 'Unknown or expired session'}), 404
+        
+        try:
+            future = scheduler.submit(
+                get_client_id(), request_cost(session.length),
+                run_session_generation, session, instruction, temperature, time.time()
+            )
+        except RateLimitExceeded as e:
+            sessions.release(session)
+            return rate_limited_response(e)
+        except QueueFull as e:
+            sessions.release(session)
+            return jsonify({'error': str(e)}), 503
+        result = future.result()
+        
+        return jsonify({
+            'session_id': session.session_id,
+            'story': result['story'],
+            'tokens_generated': result['tokens_generated'],
+            'prefill_tokens': result['prefill_tokens'],
+            'cached_tokens': result['cached_tokens'],
+            'session': session.to_dict()
+        })
+        
+    except MemoryBudgetExceeded as e:
+        return memory_exceeded_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/sessions/<session_id>', methods=['GET'])
+def get_session(session_id):
+    """Return a story session and its full text"""
+    session = sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Unknown or expired session'}), 404
+    return jsonify({'session': session.to_dict(), 'text': session.text})
+
+@app.route('/api/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    """End a story session and free its cache"""
+    if not sessions.delete(session_id):
+        return jsonify({'error': 'Unknown or expired session'}), 404
+    return jsonify({'message': f'Session {session_id} deleted'})
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
@@ -74,9 +670,50 @@ def health():
         'status': 'healthy',
         'model_loaded': not model_info['mock_mode'],
         'model_info': model_info,
-        'pipeline_enabled': model_info.get('use_pipeline', False)
+        'pipeline_enabled': model_info.get('use_pipeline', False),
+        'memory': model_info.get('memory')
     })
 
+@app.route('/metrics')
+def metrics():
+    """Serving metrics, including per-client queue statistics"""
+    return jsonify({
+        'scheduler': scheduler.get_stats(),
+        'sessions': sessions.get_stats(),
+        'slo': slo.get_stats(),
+        'response_cache': response_cache.get_stats(),
+        'semantic_cache': semantic_cache.get_stats() if semantic_cache is not None else None,
+        'router': router.get_stats(),
+        'story_pool': story_pool.get_stats() if story_pool is not None else None,
+        'inference_worker': model.worker_status() if model_is_remote() else None
+    })
+
+def admin_denied():
+    """With ADMIN_TOKEN set, admin endpoints need it in the X-Admin-Token header"""
+    token = os.environ.get('ADMIN_TOKEN')
+    if token and request.headers.get('X-Admin-Token') != token:
+        return jsonify({'error': 'Admin token required'}), 403
+    return None
+
+@app.route('/api/admin/profiles')
+def list_profiles():
+    """Profiles captured for slow (or randomly sampled) generations, newest first"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify({'profiler': profiler.get_stats(), 'profiles': profiler.list_profiles()})
+
+@app.route('/api/admin/profiles/<name>')
+def get_profile(name):
+    """One captured profile: folded Python stacks and, if recorded, torch operator timings"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    profile = profiler.get_profile(name)
+    if profile is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return jsonify(profile)
+
 @app.route('/api/models')
 def list_models():
     """List available models for Pro account users"""
@@ -110,6 +747,9 @@ def list_models():
     return jsonify({
         'available_models': available_models,
         'current_model': model.model_name,
+        'resident_models': [
+            {key: m[key] for key in ('model', 'tier', 'cost')} for m in router.get_stats()['models']
+        ],
         'pro_account_benefits': [
             'Faster model downloads',
             'Priority access during high traffic',
@@ -119,9 +759,48 @@ def list_models():
         ]
     })
 
+@app.route('/api/adapters', methods=['GET'])
+def list_adapters():
+    """LoRA adapters attached to the current model"""
+    return jsonify({'model': model.model_name, 'adapters': model.get_model_info()['adapters']})
+
+@app.route('/api/adapters', methods=['POST'])
+def load_adapter():
+    """Attach a LoRA adapter (a new style costs only the adapter's weights, not a model reload)"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    try:
+        data = request.get_json()
+        name = data.get('name')
+        path = data.get('path')
+        
+        if not name or not path:
+            return jsonify({'error': 'name and path are required'}), 400
+        
+        model.load_adapter(name, path)
+        return jsonify({'message': f'Loaded adapter {name}', 'adapter': model.get_model_info()['adapters'][name]})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/adapters/<name>', methods=['DELETE'])
+def unload_adapter(name):
+    """Detach a LoRA adapter"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    try:
+        model.unload_adapter(name)
+    except ValueError:
+        return jsonify({'error': 'Unknown adapter'}), 404
+    return jsonify({'message': f'Unloaded adapter {name}'})
+
 @app.route('/api/switch-model', methods=['POST'])
 def switch_model():
     """Switch to a different model (Pro account feature)"""
+    if model_is_remote():
+        return remote_model_response()
     try:
         data = request.get_json()
         new_model_name = data.get('model_name')
@@ -131,11 +810,20 @@ def switch_model():
         
         # Create new model instance
         global model
+        old_model = model
         model = ModelIntegrationPipeline(
             model_name=new_model_name,
             use_mock=False,  # Try to load actual model
             use_pipeline=True
         )
+        router.replace(old_model, model)
+        register_caches(model)
+        if story_pool is not None:
+            story_pool.replace_model(model)
+        retire_model(old_model)
+        
+        # Cached KV state belongs to the old model
+        sessions.clear()
         
         model_info = model.get_model_info()
         
@@ -148,43 +836,112 @@ def switch_model():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def apply_profile(name, settings):
+    """Load the model with a profile's settings in the background and swap it in once it is ready"""
+    global model
+    started_at = time.time()
+    old_model = model
+    try:
+        new_model = ModelIntegrationPipeline(
+            model_name=old_model.model_name,
+            use_mock=old_model.mock_mode,
+            use_pipeline=old_model.use_pipeline,
+            kv_cache_bits=old_model.kv_cache_bits,
+            pipeline_stages=old_model.pipeline_stages,
+            compiled_decode=old_model.compiled_decode,
+            adapters={adapter: info['path'] for adapter, info in old_model.adapters.items()},
+            profile=name,
+            **{key: settings[key] for key in MODEL_SETTINGS}
+        )
+        if new_model.mock_mode and not old_model.mock_mode:
+            raise RuntimeError(f"{old_model.model_name} failed to load with the {name} profile")
+        load_seconds = time.time() - started_at
+        
+        # A quick decode on the new model, before it takes traffic
+        tokens_per_second = None
+        if not new_model.mock_mode:
+            sample = new_model.generate_text("The moonlight filtered through the trees", 32)
+            tokens_per_second = sample['tokens_generated'] / sample['elapsed']
+        
+        # Requests already running finish on the old instance
+        model = new_model
+        router.replace(old_model, new_model)
+        register_caches(new_model)
+        if story_pool is not None:
+            story_pool.replace_model(new_model)
+        sessions.clear()  # Cached KV state belongs to the old model
+        scheduler.batch_window = settings['batch_window']
+        response_cache.max_entries = settings['response_cache_size']
+        sessions.max_bytes = settings['session_cache_bytes']
+        retire_model(old_model)
+        
+        result = {'profile': name, 'status': 'applied', 'settings': settings,
+                  'load_seconds': load_seconds, 'tokens_per_second': tokens_per_second}
+        optimization['active_profile'] = name
+        print(f"✅ Applied {name} profile in {load_seconds:.1f}s")
+    except Exception as e:
+        result = {'profile': name, 'status': 'failed', 'settings': settings, 'error': str(e)}
+        print(f"❌ Could not apply {name} profile: {e}")
+    with optimization_lock:
+        optimization['last'] = result
+        optimization['pending'] = None
+    return result
+
 @app.route('/api/optimize', methods=['POST'])
 def optimize_model():
-    """Optimize model settings for Pro account users"""
+    """Apply an optimization profile to the running model (reloaded in the background, no downtime)"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    if model_is_remote():
+        return remote_model_response()
     try:
-        data = request.get_json()
+        data = request.get_json() or {}
         optimization_level = data.get('level', 'balanced')  # 'speed', 'balanced', 'quality'
+        overrides = data.get('settings') or {}
         
-        optimizations = {
-            'speed': {
-                'torch_dtype': 'float16',
-                'device_map': 'auto',
-                'use_cache': True,
-                'low_cpu_mem_usage': True
-            },
-            'balanced': {
-                'torch_dtype': 'float16',
-                'device_map': 'auto',
-                'use_cache': True
-            },
-            'quality': {
-                'torch_dtype': 'float32',
-                'device_map': 'auto',
-                'use_cache': False
-            }
-        }
+        if optimization_level not in OPTIMIZATION_PROFILES:
+            return jsonify({'error': f'level must be one of {list(OPTIMIZATION_PROFILES)}'}), 400
+        
+        unknown = set(overrides) - set(OPTIMIZATION_PROFILES[optimization_level])
+        if unknown:
+            return jsonify({'error': f'Unknown settings: {sorted(unknown)}'}), 400
+        
+        settings = dict(OPTIMIZATION_PROFILES[optimization_level], **overrides)
+        with optimization_lock:
+            if optimization['pending']:
+                return jsonify({'error': f"Already applying the {optimization['pending']} profile"}), 409
+            optimization['pending'] = optimization_level
         
-        selected_optimizations = optimizations.get(optimization_level, optimizations['balanced'])
+        worker = threading.Thread(target=apply_profile, args=(optimization_level, settings),
+                                  name='optimize', daemon=True)
+        worker.start()
+        if data.get('wait'):
+            # Block until the new model is live and report its measured speed
+            worker.join()
+            result = optimization['last']
+            return jsonify(result), 200 if result['status'] == 'applied' else 500
         
         return jsonify({
-            'message': f'Optimization level set to {optimization_level}',
-            'optimizations': selected_optimizations,
-            'note': 'Restart the application to apply optimizations'
-        })
+            'message': f'Applying the {optimization_level} profile in the background',
+            'profile': optimization_level,
+            'settings': settings,
+            'status_url': '/api/optimize'
+        }), 202
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/optimize', methods=['GET'])
+def optimization_status():
+    """The active optimization profile and the outcome of the last change"""
+    return jsonify({
+        'active_profile': optimization['active_profile'],
+        'pending': optimization['pending'],
+        'last': optimization['last'],
+        'profiles': OPTIMIZATION_PROFILES
+    })
+
 if __name__ == '__main__':
     print("=== NSFW Novel Generator - Pipeline Version ===")
     print("Optimized for Hugging Face Pro accounts")
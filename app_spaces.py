@@ -1,7 +1,10 @@
 import gradio as gr
 import os
 import torch
-from model_integration_pipeline import ModelIntegrationPipeline
+import threading
+from model_integration_pipeline import ModelIntegrationPipeline, GENRES, LENGTH_TO_TOKENS
+from inference_daemon import InferenceClient
+from story_pool import StoryPool, build_seeds, EXAMPLE_PROMPTS
 import logging
 
 # Configure logging
@@ -10,28 +13,81 @@ logger = logging.getLogger(__name__)
 
 # Initialize the model with pipeline support
 logger.info("Initializing model...")
-model = ModelIntegrationPipeline(
-    model_name="UnfilteredAI/NSFW-3B",
-    use_mock=False,  # Try to use actual model in Spaces
-    use_pipeline=True,  # Use efficient pipeline API
-    device="auto"  # Let it auto-detect GPU/CPU
-)
+if os.environ.get('INFERENCE_SOCKET'):
+    # The model is served by a separate inference daemon (see inference_daemon.py)
+    model = InferenceClient(os.environ['INFERENCE_SOCKET'])
+else:
+    model = ModelIntegrationPipeline(
+        model_name=os.environ.get('MODEL_NAME', "UnfilteredAI/NSFW-3B"),  # Pre-fetched into the image by the Dockerfile
+        use_mock=False,  # Try to use actual model in Spaces
+        use_pipeline=True,  # Use efficient pipeline API
+        device="auto"  # Let it auto-detect GPU/CPU
+    )
+
+# Generations in progress; the story pool only refills while there are none
+active_generations = 0
+active_lock = threading.Lock()
+
+# Default slider settings; pooled stories other than the examples' are generated with them
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_TOP_P = 0.9
+DEFAULT_MAX_TOKENS = 200
 
-def generate_story(prompt, genre, length, temperature, top_p, max_tokens):
-    """Generate a story using the model"""
+# Stories for the examples below (and every genre and length) are pre-generated while the Space is idle
+story_pool = None
+if int(os.environ.get('STORY_POOL_SIZE', 2)) > 0 and not isinstance(model, InferenceClient):
+    story_pool = StoryPool(
+        model,
+        build_seeds(GENRES, list(LENGTH_TO_TOKENS), example_settings=True),
+        per_key=int(os.environ.get('STORY_POOL_SIZE', 2)),
+        ttl=float(os.environ.get('STORY_POOL_TTL', 3600)),
+        temperature=DEFAULT_TEMPERATURE,
+        top_p=DEFAULT_TOP_P,
+        max_tokens=DEFAULT_MAX_TOKENS,
+        is_busy=lambda: active_generations > 0
+    )
+    story_pool.start()
+
+def generate_story(prompt, genre, length, temperature, top_p, max_tokens, candidates=1):
+    """Generate a story (or several ranked candidates from one batched pass) using the model"""
+    global active_generations
+    with active_lock:
+        active_generations += 1
     try:
         if not prompt.strip():
             return "Please provide a prompt to generate a story.", get_model_status()
         
-        # Generate the story
-        story = model.generate_story(
-            prompt=prompt,
-            genre=genre,
-            length=length,
-            temperature=temperature,
-            top_p=top_p,
-            max_tokens=max_tokens
-        )
+        candidates = int(candidates)
+        pooled = None
+        if story_pool is not None:
+            story_pool.note_request()
+            # Only stories generated with the sliders' current settings
+            if candidates == 1:
+                pooled = story_pool.take(prompt, genre, length, temperature=temperature, top_p=top_p,
+                                         max_tokens=max_tokens)
+        if pooled is not None:
+            # Pre-generated while the Space was idle
+            story = pooled['story']
+        elif candidates > 1:
+            # All candidates share one prompt prefill; best (most likely under the model) first
+            results = model.generate_candidates(
+                prompt, genre, length, n=candidates,
+                temperature=temperature, top_p=top_p, max_tokens=max_tokens
+            )
+            story = "\n\n".join(
+                f"=== Candidate {i} (score {r['score']:.3f}) ===\n\n{r['story']}"
+                for i, r in enumerate(results, 1)
+            )
+        else:
+            # Generate the story
+            story = model.generate_story(
+                prompt=prompt,
+                genre=genre,
+                length=length,
+                temperature=temperature,
+                top_p=top_p,
+                max_tokens=max_tokens
+            )
         
         # Get model info
         model_info = model.get_model_info()
@@ -42,6 +98,9 @@ def generate_story(prompt, genre, length, temperature, top_p, max_tokens):
     except Exception as e:
         logger.error(f"Error generating story: {str(e)}")
         return f"Error: {str(e)}", "Error occurred"
+    finally:
+        with active_lock:
+            active_generations -= 1
 
 def get_model_status():
     """Get current model status"""
@@ -93,7 +152,7 @@ with gr.Blocks(title="NSFW Novel Generator", theme=gr.themes.Soft()) as demo:
                 temperature_input = gr.Slider(
                     minimum=0.1,
                     maximum=1.0,
-                    value=0.7,
+                    value=DEFAULT_TEMPERATURE,
                     step=0.1,
                     label="Temperature (Creativity)"
                 )
@@ -101,7 +160,7 @@ with gr.Blocks(title="NSFW Novel Generator", theme=gr.themes.Soft()) as demo:
                 top_p_input = gr.Slider(
                     minimum=0.1,
                     maximum=1.0,
-                    value=0.9,
+                    value=DEFAULT_TOP_P,
                     step=0.1,
                     label="Top-p (Diversity)"
                 )
@@ -109,11 +168,19 @@ with gr.Blocks(title="NSFW Novel Generator", theme=gr.themes.Soft()) as demo:
             max_tokens_input = gr.Slider(
                 minimum=50,
                 maximum=500,
-                value=200,
+                value=DEFAULT_MAX_TOKENS,
                 step=50,
                 label="Max Tokens"
             )
             
+            candidates_input = gr.Slider(
+                minimum=1,
+                maximum=4,
+                value=1,
+                step=1,
+                label="Candidates (generated together, best first)"
+            )
+            
             generate_btn = gr.Button("🎭 Generate Story", variant="primary", size="lg")
             
         with gr.Column(scale=3):
@@ -135,14 +202,9 @@ with gr.Blocks(title="NSFW Novel Generator", theme=gr.themes.Soft()) as demo:
     gr.Markdown("## 💡 Example Prompts")
     
     examples = gr.Examples(
-        examples=[
-            ["A mysterious stranger enters a cozy bookshop on a rainy evening", "romance", "medium", 0.7, 0.9, 200],
-            ["In a world where magic is forbidden, a young mage discovers their powers", "fantasy", "long", 0.8, 0.9, 300],
-            ["Two rival scientists are forced to work together on a space station", "sci-fi", "medium", 0.6, 0.8, 250],
-            ["A chance encounter at a coffee shop changes everything", "contemporary", "short", 0.7, 0.9, 150],
-            ["A forbidden romance blooms in Victorian London", "historical", "medium", 0.8, 0.9, 200]
-        ],
-        inputs=[prompt_input, genre_input, length_input, temperature_input, top_p_input, max_tokens_input],
+        # Pre-generated by the story pool with these same settings
+        examples=[list(example) + [1] for example in EXAMPLE_PROMPTS],
+        inputs=[prompt_input, genre_input, length_input, temperature_input, top_p_input, max_tokens_input, candidates_input],
         outputs=[story_output, status_output],
         fn=generate_story,
         cache_examples=False
@@ -161,6 +223,7 @@ with gr.Blocks(title="NSFW Novel Generator", theme=gr.themes.Soft()) as demo:
             - **Temperature**: Controls randomness (0.1 = conservative, 1.0 = creative)
             - **Top-p**: Controls diversity (0.1 = focused, 1.0 = diverse)
             - **Max Tokens**: Maximum length of generated text
+            - **Candidates**: Several stories sampled in one pass, ranked best first (cheaper than re-rolling)
             
             ### Usage Tips
             1. Start with clear, descriptive prompts
@@ -179,7 +242,7 @@ with gr.Blocks(title="NSFW Novel Generator", theme=gr.themes.Soft()) as demo:
     # Event handlers
     generate_btn.click(
         fn=generate_story,
-        inputs=[prompt_input, genre_input, length_input, temperature_input, top_p_input, max_tokens_input],
+        inputs=[prompt_input, genre_input, length_input, temperature_input, top_p_input, max_tokens_input, candidates_input],
         outputs=[story_output, status_output],
         show_progress=True
     )
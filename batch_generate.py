@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Offline bulk generation over a JSONL file of requests
+
+Streams requests (the `requests.jsonl` shape: request_id, title, body; or
+explicit prompt/genre/length/temperature fields) straight into
+ModelIntegrationPipeline in batches, without going through the web API.
+
+- Results are appended to the output JSONL as each batch finishes
+- A checkpoint next to the output records how far the input has been consumed,
+  so an interrupted run picks up where it left off when started again
+- `--workers N` shards the input across N processes (line i goes to shard i % N),
+  each with its own model, part file and checkpoint; parts are merged at the end
+- Input is read one line at a time, so memory stays flat for any file size
+
+Usage:
+    python batch_generate.py requests.jsonl results.jsonl --batch-size 8
+    python batch_generate.py requests.jsonl results.jsonl --real --workers 2
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from typing import Dict, Any, List
+
+from model_integration_pipeline import ModelIntegrationPipeline, GENRES, LENGTH_TO_TOKENS
+
+
+def request_to_params(record: Dict[str, Any], defaults: Dict[str, Any]) -> Dict[str, Any]:
+    """Map an input record to generate_stories() parameters."""
+    prompt = record.get('prompt')
+    if not prompt:
+        # Backlog-style records: the title and body together form the prompt
+        prompt = '. '.join(part for part in (record.get('title'), record.get('body')) if part)
+    genre = record.get('genre', defaults['genre'])
+    length = record.get('length', defaults['length'])
+    return {
+        "prompt": prompt,
+        "genre": genre if genre in GENRES else defaults['genre'],
+        "length": length if length in LENGTH_TO_TOKENS else defaults['length'],
+        "temperature": float(record.get('temperature', defaults['temperature']))
+    }
+
+
+def part_paths(output_path: str, shard: int, num_shards: int):
+    """Output and checkpoint file for one shard."""
+    part = output_path if num_shards == 1 else f"{output_path}.part{shard}"
+    return part, f"{part}.checkpoint"
+
+
+def load_checkpoint(path: str, num_shards: int) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {"input_offset": 0, "line_no": 0, "output_size": 0, "completed": 0, "tokens": 0}
+    with open(path, 'r') as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('num_shards', num_shards) != num_shards:
+        raise ValueError(f"{path} was written by a run with {checkpoint['num_shards']} workers; "
+                         f"resume with --workers {checkpoint['num_shards']}")
+    return checkpoint
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]):
+    """Write the checkpoint atomically so a crash never leaves a half-written one."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def run_shard(args, shard: int, num_shards: int) -> Dict[str, Any]:
+    """Process every line of the input that belongs to `shard`, resuming from its checkpoint."""
+    output_path, checkpoint_path = part_paths(args.output, shard, num_shards)
+    checkpoint = load_checkpoint(checkpoint_path, num_shards)
+    checkpoint['num_shards'] = num_shards
+    defaults = {"genre": args.genre, "length": args.length, "temperature": args.temperature}
+
+    model = ModelIntegrationPipeline(
+        model_name=args.model,
+        use_mock=not args.real,
+        use_pipeline=not args.no_pipeline
+    )
+
+    start_time = time.time()
+    completed = tokens = 0
+
+    with open(args.input, 'rb') as infile, open(output_path, 'ab') as outfile:
+        # Drop anything written after the last checkpoint (e.g. a batch cut off mid-write)
+        outfile.truncate(checkpoint['output_size'])
+        infile.seek(checkpoint['input_offset'])
+        line_no = checkpoint['line_no']
+
+        while True:
+            batch: List[Dict[str, Any]] = []
+            while len(batch) < args.batch_size:
+                line = infile.readline()
+                if not line:
+                    break
+                this_line = line_no
+                line_no += 1
+                if this_line % num_shards != shard or not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"⚠️ Skipping line {this_line + 1}: {e}", file=sys.stderr)
+                    continue
+                batch.append({"line": this_line, "record": record,
+                              "params": request_to_params(record, defaults)})
+            if not batch:
+                break
+
+            results = model.generate_stories([item['params'] for item in batch])
+            for item, result in zip(batch, results):
+                out = {
+                    "request_id": item['record'].get('request_id', item['line']),
+                    "story": result['story'],
+                    "tokens_generated": result['tokens_generated'],
+                    "parameters": item['params']
+                }
+                outfile.write((json.dumps(out) + '\n').encode('utf-8'))
+                tokens += result['tokens_generated']
+            completed += len(batch)
+
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            checkpoint.update({
+                "input_offset": infile.tell(),
+                "line_no": line_no,
+                "output_size": outfile.tell(),
+                "completed": checkpoint['completed'] + len(batch),
+                "tokens": checkpoint['tokens'] + sum(r['tokens_generated'] for r in results)
+            })
+            save_checkpoint(checkpoint_path, checkpoint)
+            print(f"[shard {shard}] {checkpoint['completed']} requests done")
+
+    return {
+        "shard": shard,
+        "completed": completed,
+        "tokens": tokens,
+        "elapsed": time.time() - start_time
+    }
+
+
+def _shard_worker(args, shard: int, num_shards: int, results):
+    results.put(run_shard(args, shard, num_shards))
+
+
+def merge_parts(output_path: str, num_shards: int):
+    """Concatenate the shard part files into the output and remove the parts."""
+    with open(output_path, 'wb') as outfile:
+        for shard in range(num_shards):
+            part_path, _ = part_paths(output_path, shard, num_shards)
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, outfile)
+    for shard in range(num_shards):
+        part_path, _ = part_paths(output_path, shard, num_shards)
+        os.remove(part_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate stories in bulk from a JSONL file of requests")
+    parser.add_argument('input', help="Input JSONL of requests")
+    parser.add_argument('output', help="Output JSONL of results")
+    parser.add_argument('--model', default="UnfilteredAI/NSFW-3B", help="Hugging Face model name or local path")
+    parser.add_argument('--real', action='store_true', help="Load the real model instead of mock mode")
+    parser.add_argument('--no-pipeline', action='store_true', help="Use the traditional model path")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes (input shards)")
+    parser.add_argument('--genre', default='romance', help="Genre for records without one")
+    parser.add_argument('--length', default='medium', help="Length for records without one")
+    parser.add_argument('--temperature', type=float, default=0.7, help="Temperature for records without one")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.workers == 1:
+        stats = [run_shard(args, 0, 1)]
+    else:
+        # Each worker loads its own model, so use fresh interpreters rather than fork
+        ctx = multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+        workers = [
+            ctx.Process(target=_shard_worker, args=(args, shard, args.workers, results))
+            for shard in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        stats = [results.get(timeout=5) for worker in workers if worker.exitcode == 0]
+        if len(stats) != len(workers):
+            print("❌ A worker failed; rerun the same command to resume")
+            sys.exit(1)
+        merge_parts(args.output, args.workers)
+
+    # The run is complete, so the checkpoints have served their purpose
+    for shard in range(args.workers):
+        _, checkpoint_path = part_paths(args.output, shard, args.workers)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    elapsed = time.time() - start_time
+    completed = sum(s['completed'] for s in stats)
+    tokens = sum(s['tokens'] for s in stats)
+    print(f"\n✅ Generated {completed} stories ({tokens} tokens) in {elapsed:.1f}s")
+    if elapsed > 0:
+        print(f"   Throughput: {completed / elapsed:.2f} requests/s, {tokens / elapsed:.1f} tokens/s")
+    print(f"   Results: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
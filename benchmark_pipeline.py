@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for the NSFW Novel Generator model layer
+
+Runs named scenarios against ModelIntegrationPipeline (mock or real model)
+and prints a report for each:
+
+- generation: latency and tokens/s per length bucket
+- scheduling: output-length prediction error, and mean/p95 queueing latency of
+  FIFO versus shortest-predicted-job-first ordering on the recorded history
+
+Every scenario also reports the process RSS at its start, peak and end;
+--max-peak-rss-mb makes the run fail (exit code 1) when a peak exceeds it.
+
+Usage:
+    python benchmark_pipeline.py --scenario generation --scenario scheduling
+    python benchmark_pipeline.py --model UnfilteredAI/NSFW-3B --real --history generation_history.jsonl
+    python benchmark_pipeline.py --real --scenario generation --max-peak-rss-mb 9000
+"""
+
+import sys
+import argparse
+import json
+import random
+import time
+import threading
+import numpy as np
+import psutil
+from typing import Dict, Any, List
+
+from model_integration_pipeline import ModelIntegrationPipeline, GENRES, LENGTH_TO_TOKENS
+from length_predictor import OutputLengthPredictor
+from fair_scheduler import sjf_priority
+
+SAMPLE_PROMPTS = [
+    "Two strangers meet at a masquerade ball",
+    "A mysterious stranger enters a cozy bookshop on a rainy evening",
+    "In a world where magic is forbidden, a young mage discovers their powers",
+    "Two rival scientists are forced to work together on a space station",
+    "A chance encounter at a coffee shop changes everything",
+    "A forbidden romance blooms in Victorian London",
+    "A space explorer discovers an alien artifact",
+    "An heiress hires a bodyguard with a secret"
+]
+
+
+def random_request(rng: random.Random) -> Dict[str, Any]:
+    """A request drawn from the same genre/length mix the UI offers."""
+    return {
+        "prompt": rng.choice(SAMPLE_PROMPTS),
+        "genre": rng.choice(GENRES),
+        "length": rng.choice(list(LENGTH_TO_TOKENS)),
+        "temperature": round(rng.uniform(0.5, 1.0), 1)
+    }
+
+
+def collect_history(model: ModelIntegrationPipeline, predictor: OutputLengthPredictor,
+                    count: int, rng: random.Random):
+    """Run `count` random requests through the model and record their actual lengths."""
+    for _ in range(count):
+        req = random_request(rng)
+        result = model.generate_story_detailed(req['prompt'], req['genre'], req['length'], req['temperature'])
+        predictor.record(req['genre'], req['length'], len(req['prompt']), req['temperature'],
+                         result['tokens_generated'])
+
+
+class RSSSampler:
+    """Samples this process's RSS (with child processes, e.g. pipeline stages) in a background thread."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.start_bytes = self.peak_bytes = self.end_bytes = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def rss(self) -> int:
+        processes = [self.process] + self.process.children(recursive=True)
+        total = 0
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                pass  # A child exited between listing and sampling
+        return total
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, self.rss())
+
+    def __enter__(self):
+        self.start_bytes = self.peak_bytes = self.rss()
+        self.thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stopped.set()
+        self.thread.join()
+        self.end_bytes = self.rss()
+        self.peak_bytes = max(self.peak_bytes, self.end_bytes)
+        return False
+
+    def summary(self) -> Dict[str, float]:
+        mb = 1024 ** 2
+        return {
+            "rss_start_mb": self.start_bytes / mb,
+            "rss_peak_mb": self.peak_bytes / mb,
+            "rss_end_mb": self.end_bytes / mb,
+            "rss_growth_mb": (self.end_bytes - self.start_bytes) / mb
+        }
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    values = np.array(latencies, dtype=np.float64)
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(values.max())
+    }
+
+
+def run_generation_scenario(model: ModelIntegrationPipeline, args) -> Dict[str, Any]:
+    """Latency and throughput of single requests, per length bucket."""
+    rng = random.Random(args.seed)
+    report = {}
+    for length in LENGTH_TO_TOKENS:
+        latencies = []
+        tokens = 0
+        for _ in range(args.repeats):
+            req = random_request(rng)
+            result = model.generate_story_detailed(req['prompt'], req['genre'], length, req['temperature'])
+            latencies.append(result['elapsed'])
+            tokens += result['tokens_generated']
+        report[length] = {
+            "latency": latency_summary(latencies),
+            "tokens_per_second": tokens / sum(latencies) if sum(latencies) > 0 else None
+        }
+    return report
+
+
+def simulate_queue(jobs: List[Dict[str, Any]], policy: str, tokens_per_second: float,
+                   aging_rate: float) -> List[float]:
+    """
+    Single-server queue simulation: each job holds the model for
+    actual_tokens / tokens_per_second. Returns per-job latency (wait + service).
+    """
+    jobs = sorted(jobs, key=lambda j: j['arrival'])
+    latencies = []
+    queue = []
+    now = 0.0
+    i = 0
+    while i < len(jobs) or queue:
+        if not queue:
+            now = max(now, jobs[i]['arrival'])
+        while i < len(jobs) and jobs[i]['arrival'] <= now:
+            queue.append(jobs[i])
+            i += 1
+        if policy == 'sjf':
+            job = min(queue, key=lambda j: sjf_priority(j['predicted'], now - j['arrival'], aging_rate))
+        else:
+            job = min(queue, key=lambda j: j['arrival'])
+        queue.remove(job)
+        now += job['actual_tokens'] / tokens_per_second
+        latencies.append(now - job['arrival'])
+    return latencies
+
+
+def run_scheduling_scenario(model: ModelIntegrationPipeline, args) -> Dict[str, Any]:
+    """Prediction error on held-out history and the latency gain of SJF ordering over FIFO."""
+    rng = random.Random(args.seed)
+    # Synchronous refits, so none can land after the train-split fit below
+    predictor = OutputLengthPredictor(history_path=args.history, background_refit=False)
+    if len(predictor.history) < args.collect:
+        collect_history(model, predictor, args.collect - len(predictor.history), rng)
+
+    records = list(predictor.history)
+    rng.shuffle(records)
+    split = int(len(records) * 0.8)
+    train, test = records[:split], records[split:]
+    predictor.fit(train)
+    if not predictor.trained or not test:
+        return {"error": f"Not enough history ({len(records)} records)"}
+
+    tokens_per_second = args.tokens_per_second or model.tokens_per_second or 30.0
+    mean_service = np.mean([r['actual_tokens'] for r in test]) / tokens_per_second
+    arrival_rate = args.load / mean_service
+
+    # Open-loop Poisson arrivals at the requested utilization
+    jobs = []
+    arrival = 0.0
+    for r in test:
+        arrival += rng.expovariate(arrival_rate)
+        jobs.append({
+            "arrival": arrival,
+            "actual_tokens": r['actual_tokens'],
+            "predicted": predictor.predict(r['genre'], r['length'], r['prompt_len'], r['temperature'])
+        })
+
+    fifo = latency_summary(simulate_queue(jobs, 'fifo', tokens_per_second, args.aging_rate))
+    sjf = latency_summary(simulate_queue(jobs, 'sjf', tokens_per_second, args.aging_rate))
+    return {
+        "train_samples": len(train),
+        "prediction": predictor.evaluate(test),
+        "tokens_per_second": tokens_per_second,
+        "load": args.load,
+        "fifo_latency": fifo,
+        "sjf_latency": sjf,
+        "mean_latency_improvement": 1.0 - sjf['mean'] / fifo['mean'] if fifo['mean'] else 0.0
+    }
+
+
+SCENARIOS = {
+    "generation": run_generation_scenario,
+    "scheduling": run_scheduling_scenario
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the story generation model layer")
+    parser.add_argument('--model', default="UnfilteredAI/NSFW-3B", help="Hugging Face model name or local path")
+    parser.add_argument('--real', action='store_true', help="Load the real model instead of mock mode")
+    parser.add_argument('--no-pipeline', action='store_true', help="Use the traditional model path")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="Scenario to run (repeatable, default: all)")
+    parser.add_argument('--repeats', type=int, default=3, help="Requests per length bucket (generation)")
+    parser.add_argument('--history', help="Generation history JSONL (scheduling)")
+    parser.add_argument('--collect', type=int, default=100,
+                        help="Minimum history size; missing records are generated (scheduling)")
+    parser.add_argument('--load', type=float, default=0.9, help="Simulated utilization (scheduling)")
+    parser.add_argument('--aging-rate', type=float, default=50.0, help="SJF aging in tokens per second waited")
+    parser.add_argument('--tokens-per-second', type=float, help="Decode speed for the queue simulation")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-peak-rss-mb', type=float,
+                        help="Fail (exit code 1) if any scenario's peak RSS exceeds this many MB")
+    parser.add_argument('--json', help="Write the full report to this file")
+    args = parser.parse_args()
+
+    model = ModelIntegrationPipeline(
+        model_name=args.model,
+        use_mock=not args.real,
+        use_pipeline=not args.no_pipeline
+    )
+
+    report = {"model_info": model.get_model_info()}
+    over_budget = []
+    for name in args.scenario or sorted(SCENARIOS):
+        print(f"\n=== Scenario: {name} ===")
+        started = time.time()
+        with RSSSampler() as rss:
+            report[name] = SCENARIOS[name](model, args)
+        report[name]["memory"] = rss.summary()
+        print(json.dumps(report[name], indent=2))
+        print(f"({time.time() - started:.1f}s)")
+        peak = report[name]["memory"]["rss_peak_mb"]
+        if args.max_peak_rss_mb is not None and peak > args.max_peak_rss_mb:
+            over_budget.append(name)
+            print(f"❌ Peak RSS {peak:.0f} MB exceeds --max-peak-rss-mb {args.max_peak_rss_mb:.0f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n📄 Report written to {args.json}")
+    if over_budget:
+        print(f"❌ Over the RSS limit: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+CPU thread and core-affinity autotuner
+
+Torch's default thread counts assume it has the machine to itself, which is
+rarely true next to the web server's request threads, and hyperthread
+siblings or a second NUMA node can make more threads slower. This sweeps,
+on the actual host:
+
+- core affinity: all allowed CPUs, one logical CPU per physical core, and
+  the first NUMA node (when the host has several)
+- inter-op threads
+- intra-op threads (up to the CPUs in the affinity set, including one fewer
+  than all, leaving a core for the web server)
+- batch size
+
+Each configuration decodes a fixed number of tokens of a representative
+story prompt, and its tokens/s is reported. Affinity and inter-op threads
+are process-wide and can only be set before torch starts its thread pools, so
+every (affinity, inter-op) pair is measured in a fresh process.
+
+The best configuration is the fastest at batch size 1, since that is what an
+interactive request sees. Its max_batch is the batch size with the highest
+total tokens/s whose per-sequence speed stays above --min-batch-efficiency of
+batch size 1. The result is written to cpu_tuning.json (CPU_TUNING_FILE).
+ModelIntegrationPipeline applies it when it loads a model on CPU, and
+app_pipeline.py takes the scheduler's max_batch from it.
+
+Usage:
+    python cpu_autotune.py --model UnfilteredAI/NSFW-3B
+    python cpu_autotune.py --model /path/to/tiny-model --tokens 32 --batch-sizes 1,2,4 --output cpu_tuning.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import glob
+import subprocess
+from typing import Dict, Any, Optional, List, Set
+
+from pipeline_parallel import numa_cpu_sets, _parse_cpulist
+
+DEFAULT_TUNING_FILE = 'cpu_tuning.json'
+RESULT_PREFIX = 'AUTOTUNE_RESULT '  # Marks the worker's result line among the model's own output
+
+
+def tuning_path() -> str:
+    return os.environ.get('CPU_TUNING_FILE', DEFAULT_TUNING_FILE)
+
+
+def physical_core_cpus(cpus: Set[int]) -> Set[int]:
+    """One logical CPU per physical core (the lowest-numbered hyperthread sibling)."""
+    chosen = set()
+    for cpu in cpus:
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list') as f:
+                siblings = _parse_cpulist(f.read()) & cpus
+        except OSError:
+            siblings = {cpu}
+        chosen.add(min(siblings or {cpu}))
+    return chosen
+
+
+def _read_cpulist(path: str) -> Optional[Set[int]]:
+    try:
+        with open(path) as f:
+            return _parse_cpulist(f.read())
+    except OSError:
+        return None
+
+
+def host_fingerprint() -> Dict[str, Any]:
+    """
+    What a tuning result depends on; a saved result is only applied on a matching host.
+
+    Only the machine itself counts, not this process's affinity: apply_tuning()
+    narrows that, and the tuning must still load afterwards (e.g. for a second model).
+    """
+    online = _read_cpulist('/sys/devices/system/cpu/online')
+    nodes = [_read_cpulist(path) or set() for path in sorted(
+        glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+        key=lambda p: int(p.split('/node')[-1].split('/')[0]))]
+    return {
+        "cpu_count": os.cpu_count(),
+        "online_cpus": len(online) if online is not None else os.cpu_count(),
+        "numa_nodes": [len(cpus) for cpus in nodes if cpus] or [os.cpu_count()]
+    }
+
+
+def affinity_candidates() -> Dict[str, List[int]]:
+    """Named CPU sets to try; duplicates of an earlier set are left out."""
+    allowed = os.sched_getaffinity(0)
+    candidates = {"all": allowed, "physical": physical_core_cpus(allowed)}
+    nodes = numa_cpu_sets()
+    if len(nodes) > 1:
+        candidates["node0"] = nodes[0]
+        candidates["node0-physical"] = physical_core_cpus(nodes[0])
+    unique = {}
+    for name, cpus in candidates.items():
+        if cpus and sorted(cpus) not in unique.values():
+            unique[name] = sorted(cpus)
+    return unique
+
+
+def thread_candidates(cpus: int) -> List[int]:
+    """Powers of two below `cpus`, half, all but one (a core left for the web server) and all."""
+    counts = {cpus, max(1, cpus // 2), max(1, cpus - 1)}
+    power = 1
+    while power < cpus:
+        counts.add(power)
+        power *= 2
+    return sorted(counts)
+
+
+def load_tuning(path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """The saved best configuration, or None if there is none or it was tuned on a different host."""
+    path = path or tuning_path()
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Ignoring CPU tuning file {path}: {e}")
+        return None
+    if saved.get("host") != host_fingerprint():
+        print(f"⚠️ Ignoring CPU tuning file {path}: tuned on a different host ({saved.get('host')})")
+        return None
+    return saved["best"]
+
+
+def apply_tuning(tuning: Dict[str, Any], num_threads: Optional[int] = None):
+    """
+    Pin this process to the tuned CPUs and set torch's thread counts.
+
+    Affinity applies to the calling thread and the threads it starts afterwards
+    (torch's pools included), so call it before the model runs.
+
+    Args:
+        tuning: A configuration from load_tuning()
+        num_threads: An explicit intra-op thread count, which takes precedence over the tuned one
+    """
+    import torch
+    cpus = set(tuning["cpus"]) & os.sched_getaffinity(0)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    try:
+        torch.set_num_interop_threads(tuning["interop_threads"])
+    except RuntimeError:
+        pass  # Can only be set once per process, before any inter-op work (e.g. on a model reload)
+    torch.set_num_threads(int(num_threads or tuning["num_threads"]))
+
+
+def measure(model_name: str, threads: List[int], batch_sizes: List[int], tokens: int, repeats: int,
+            dtype: str, quantization: Optional[str]) -> List[Dict[str, Any]]:
+    """Decode speed of every (intra-op threads, batch size) pair in this process."""
+    import torch
+    from model_integration_pipeline import ModelIntegrationPipeline
+
+    backend = ModelIntegrationPipeline(model_name=model_name, use_mock=False, use_pipeline=False, device='cpu',
+                                       torch_dtype=dtype, quantization=quantization, cpu_tuning_file=None)
+    if backend.mock_mode:
+        raise RuntimeError(f"Could not load {model_name}")
+    model, tokenizer = backend._get_model_and_tokenizer()
+    prompt = backend._build_system_prompt("Two strangers meet at a masquerade ball", "romance", "medium")
+    input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"]
+
+    def decode(batch_size: int, new_tokens: int) -> float:
+        batch = input_ids.repeat(batch_size, 1)
+        started = time.perf_counter()
+        with torch.no_grad():
+            # Greedy with a fixed length, so every configuration does the same work
+            model.generate(batch, attention_mask=torch.ones_like(batch), max_new_tokens=new_tokens,
+                           min_new_tokens=new_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id)
+        return time.perf_counter() - started
+
+    results = []
+    for num_threads in threads:
+        torch.set_num_threads(num_threads)
+        for batch_size in batch_sizes:
+            decode(batch_size, min(tokens, 8))  # Warm-up: thread pools, allocator, kernels
+            elapsed = min(decode(batch_size, tokens) for _ in range(repeats))
+            results.append({
+                "num_threads": num_threads,
+                "batch_size": batch_size,
+                "seconds": elapsed,
+                "tokens_per_second": batch_size * tokens / elapsed,
+                "per_sequence_tokens_per_second": tokens / elapsed
+            })
+    return results
+
+
+def _worker(spec: Dict[str, Any]):
+    """Entry point of a measuring process: pin, set inter-op threads, then measure."""
+    os.sched_setaffinity(0, spec["cpus"])
+    import torch
+    torch.set_num_interop_threads(spec["interop_threads"])
+    results = measure(spec["model"], spec["threads"], spec["batch_sizes"], spec["tokens"], spec["repeats"],
+                      spec["dtype"], spec["quantization"])
+    print(RESULT_PREFIX + json.dumps(results), flush=True)
+
+
+def run_group(spec: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Measure one (affinity, inter-op threads) group in a fresh process."""
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', json.dumps(spec)],
+                             stdout=subprocess.PIPE, text=True)
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"Measuring process exited with code {process.returncode} and no result")
+
+
+def choose_best(results: List[Dict[str, Any]], min_batch_efficiency: float) -> Dict[str, Any]:
+    """Fastest batch-size-1 configuration, and the batch size it handles best."""
+    singles = [r for r in results if r["batch_size"] == 1] or results
+    best = max(singles, key=lambda r: r["per_sequence_tokens_per_second"])
+    same = [r for r in results
+            if all(r[key] == best[key] for key in ("affinity", "interop_threads", "num_threads"))]
+    efficient = [r for r in same
+                 if r["per_sequence_tokens_per_second"] >= min_batch_efficiency * best["per_sequence_tokens_per_second"]]
+    batch = max(efficient, key=lambda r: r["tokens_per_second"])
+    return {
+        "affinity": best["affinity"],
+        "cpus": best["cpus"],
+        "interop_threads": best["interop_threads"],
+        "num_threads": best["num_threads"],
+        "tokens_per_second": best["tokens_per_second"],
+        "max_batch": batch["batch_size"],
+        "batch_tokens_per_second": batch["tokens_per_second"]
+    }
+
+
+def autotune(model_name: str, batch_sizes: List[int], tokens: int = 64, repeats: int = 2,
+             interop: List[int] = (1, 2), dtype: str = 'auto', quantization: Optional[str] = None,
+             min_batch_efficiency: float = 0.5) -> Dict[str, Any]:
+    """
+    Sweep affinity, inter-op threads, intra-op threads and batch size.
+
+    Returns:
+        {"host", "model", "tuned_at", "best", "results"}, ready to save as the tuning file
+    """
+    results = []
+    for affinity, cpus in affinity_candidates().items():
+        for interop_threads in interop:
+            spec = {"model": model_name, "cpus": cpus, "interop_threads": interop_threads,
+                    "threads": thread_candidates(len(cpus)), "batch_sizes": batch_sizes, "tokens": tokens,
+                    "repeats": repeats, "dtype": dtype, "quantization": quantization}
+            print(f"⏱️ affinity={affinity} ({len(cpus)} CPUs), interop_threads={interop_threads}, "
+                  f"threads={spec['threads']}, batch_sizes={batch_sizes}")
+            try:
+                group = run_group(spec)
+            except RuntimeError as e:
+                print(f"❌ {e}")
+                continue
+            for result in group:
+                result.update(affinity=affinity, cpus=cpus, interop_threads=interop_threads)
+                print(f"   threads={result['num_threads']:>3} batch={result['batch_size']:>2}  "
+                      f"{result['tokens_per_second']:8.1f} tokens/s "
+                      f"({result['per_sequence_tokens_per_second']:.1f} per sequence)")
+            results.extend(group)
+    if not results:
+        raise RuntimeError("No configuration could be measured")
+    return {
+        "host": host_fingerprint(),
+        "model": model_name,
+        "dtype": dtype,
+        "quantization": quantization,
+        "tokens": tokens,
+        "tuned_at": time.time(),
+        "best": choose_best(results, min_batch_efficiency),
+        "results": results
+    }
+
+
+def _int_list(text: str) -> List[int]:
+    return [int(part) for part in text.split(',') if part.strip()]
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--worker':
+        _worker(json.loads(sys.argv[2]))
+        return
+
+    parser = argparse.ArgumentParser(description="Find the fastest CPU thread, affinity and batch configuration")
+    parser.add_argument('--model', default="UnfilteredAI/NSFW-3B", help="Hugging Face model name or local path")
+    parser.add_argument('--tokens', type=int, default=64, help="Tokens decoded per measurement")
+    parser.add_argument('--repeats', type=int, default=2, help="Measurements per configuration (the best counts)")
+    parser.add_argument('--batch-sizes', type=_int_list, default=[1, 2, 4, 8])
+    parser.add_argument('--interop', type=_int_list, default=[1, 2], help="Inter-op thread counts to try")
+    parser.add_argument('--dtype', default='auto', help="torch_dtype the backend runs with")
+    parser.add_argument('--quantization', choices=['int8'], help="Quantization the backend runs with")
+    parser.add_argument('--min-batch-efficiency', type=float, default=0.5,
+                        help="Per-sequence speed a batch must keep, as a fraction of batch size 1")
+    parser.add_argument('--output', default=tuning_path(), help="Where the tuning is saved")
+    args = parser.parse_args()
+
+    report = autotune(args.model, args.batch_sizes, args.tokens, args.repeats, args.interop, args.dtype,
+                      args.quantization, args.min_batch_efficiency)
+    best = report["best"]
+    print(f"\n🏆 Best: affinity={best['affinity']} ({len(best['cpus'])} CPUs), "
+          f"interop_threads={best['interop_threads']}, num_threads={best['num_threads']}: "
+          f"{best['tokens_per_second']:.1f} tokens/s; max_batch={best['max_batch']} "
+          f"({best['batch_tokens_per_second']:.1f} tokens/s)")
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"📄 Tuning saved to {args.output}; the backend applies it at startup")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,101 @@ Deployment script for Hugging Face Spaces
 
 This script helps you deploy the NSFW Novel Generator to Hugging Face Spaces
 with proper configuration and file preparation.
+
+Incremental deploys hash every file (sha256) and compare against the manifest
+stored in the Space by the previous deploy, so only changed files are uploaded
+and files no longer deployed are deleted, all in one commit:
+
+    python deploy_to_spaces.py --repo-id username/space-name --dry-run   # report bytes to transfer
+    python deploy_to_spaces.py --repo-id username/space-name
+    python deploy_to_spaces.py --hub-dir /tmp/fake-space                # local stand-in for the hub
+
+Run without arguments for the interactive git-based setup.
 """
 
 import os
+import json
 import shutil
+import hashlib
+import argparse
 import subprocess
 import sys
 from pathlib import Path
+from typing import Dict, Any, Optional
+
+# Files that make up the Space; lazily imported modules are included so every backend option works
+DEPLOY_FILES = [
+    'Dockerfile',
+    '.dockerignore',
+    'app_spaces.py',
+    'model_integration_pipeline.py',
+    'tracing.py',
+    'slow_profiler.py',
+    'kv_quant.py',
+    'story_sessions.py',
+    'pipeline_parallel.py',
+    'cpu_autotune.py',
+    'inference_daemon.py',
+    'story_pool.py',
+    'response_cache.py',
+    'model_router.py',
+    'requirements.txt',
+    'README_SPACES.md'
+]
+
+# Written to the Space by each incremental deploy: {path: {"sha256": ..., "size": ...}}
+MANIFEST_NAME = '.deploy_manifest.json'
+
+SPACE_README = """
+---
+title: NSFW Novel Generator
+sdk: docker
+app_port: 7860
+pinned: false
+license: mit
+short_description: AI-powered NSFW novel generator using UnfilteredAI/NSFW-3B
+tags:
+  - text-generation
+  - creative-writing
+  - nsfw
+  - transformers
+  - pipeline
+models:
+  - UnfilteredAI/NSFW-3B
+hardware: t4-small
+suggest_hardware: t4-small
+---
+
+# NSFW Novel Generator
+
+🚀 **AI-powered NSFW novel generator using UnfilteredAI/NSFW-3B with pipeline optimization!**
+
+## Features
+
+- **Pipeline Optimization**: Uses Hugging Face pipeline for efficient inference
+- **GPU Acceleration**: Automatic GPU detection and utilization
+- **Interactive UI**: Clean Gradio interface with real-time generation
+- **Parameter Control**: Temperature, top-p, max tokens adjustment
+- **Genre Selection**: Multiple genre options for guided generation
+
+## Usage
+
+1. Enter your story prompt
+2. Select genre and length preferences
+3. Adjust creativity parameters
+4. Click "Generate Story"
+
+## ⚠️ Content Warning
+
+This application generates adult content. Use responsibly and ensure compliance with local laws.
+
+## Technical Details
+
+- **Model**: UnfilteredAI/NSFW-3B
+- **Framework**: Hugging Face Transformers with Pipeline API
+- **Interface**: Gradio
+- **Optimization**: Automatic device mapping and memory management
+"""
 
 def check_requirements():
     """Check if required tools are installed"""
@@ -39,14 +127,7 @@ def prepare_deployment_files():
     print("📁 Preparing deployment files...")
     
     # Files needed for Spaces deployment
-    required_files = [
-        'Dockerfile',
-        'app_spaces.py',
-        'model_integration_pipeline.py',
-        'requirements.txt',
-        'README_SPACES.md',
-        'spaces_config.yaml'
-    ]
+    required_files = DEPLOY_FILES + ['spaces_config.yaml']
     
     missing_files = []
     for file in required_files:
@@ -77,78 +158,138 @@ def create_spaces_directory(space_name):
 
 def copy_deployment_files(spaces_dir):
     """Copy necessary files to the Spaces directory"""
-    files_to_copy = [
-        'Dockerfile',
-        'app_spaces.py',
-        'model_integration_pipeline.py',
-        'requirements.txt',
-        'README_SPACES.md'
-    ]
-    
-    for file in files_to_copy:
+    for file in DEPLOY_FILES:
         shutil.copy2(file, spaces_dir)
         print(f"📄 Copied {file}")
     
-    # Copy and rename spaces config
-    shutil.copy2('spaces_config.yaml', os.path.join(spaces_dir, 'README.md'))
-    
     # Create a proper README.md for the Space
-    readme_content = """
----
-title: NSFW Novel Generator
-sdk: gradio
-sdk_version: 4.0.0
-app_file: app_spaces.py
-pinned: false
-license: mit
-short_description: AI-powered NSFW novel generator using UnfilteredAI/NSFW-3B
-tags:
-  - text-generation
-  - creative-writing
-  - nsfw
-  - transformers
-  - pipeline
-models:
-  - UnfilteredAI/NSFW-3B
-hardware: t4-small
-suggest_hardware: t4-small
----
-
-# NSFW Novel Generator
-
-🚀 **AI-powered NSFW novel generator using UnfilteredAI/NSFW-3B with pipeline optimization!**
-
-## Features
-
-- **Pipeline Optimization**: Uses Hugging Face pipeline for efficient inference
-- **GPU Acceleration**: Automatic GPU detection and utilization
-- **Interactive UI**: Clean Gradio interface with real-time generation
-- **Parameter Control**: Temperature, top-p, max tokens adjustment
-- **Genre Selection**: Multiple genre options for guided generation
+    with open(os.path.join(spaces_dir, 'README.md'), 'w') as f:
+        f.write(SPACE_README)
+    
+    print("✅ All files copied successfully")
 
-## Usage
+def file_sha256(path: str) -> str:
+    """sha256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-1. Enter your story prompt
-2. Select genre and length preferences
-3. Adjust creativity parameters
-4. Click "Generate Story"
+def build_deploy_set() -> Dict[str, Dict[str, Any]]:
+    """
+    The Space's files keyed by path in the Space repo.
+    
+    Returns:
+        {path: {"source": local path or bytes, "sha256": ..., "size": ...}}
+    """
+    files = {}
+    for file in DEPLOY_FILES:
+        files[file] = {"source": file, "sha256": file_sha256(file), "size": os.path.getsize(file)}
+    readme = SPACE_README.encode('utf-8')
+    files['README.md'] = {"source": readme, "sha256": hashlib.sha256(readme).hexdigest(), "size": len(readme)}
+    return files
 
-## ⚠️ Content Warning
+def plan_deploy(files: Dict[str, Dict[str, Any]], remote_manifest: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Compare local content hashes against the Space's manifest.
+    
+    Returns:
+        Dict with `upload`, `delete` and `unchanged` path lists and `upload_bytes`
+    """
+    upload = sorted(path for path, info in files.items()
+                    if remote_manifest.get(path, {}).get('sha256') != info['sha256'])
+    return {
+        "upload": upload,
+        "delete": sorted(path for path in remote_manifest if path not in files),
+        "unchanged": sorted(path for path in files if path not in upload),
+        "upload_bytes": sum(files[path]['size'] for path in upload),
+        "total_bytes": sum(info['size'] for info in files.values())
+    }
 
-This application generates adult content. Use responsibly and ensure compliance with local laws.
+class HubTarget:
+    """A Space on the Hugging Face Hub"""
+    
+    def __init__(self, repo_id: str, token: Optional[str] = None):
+        from huggingface_hub import HfApi
+        self.repo_id = repo_id
+        self.api = HfApi(token=token)
+    
+    def read_manifest(self) -> Dict[str, Dict[str, Any]]:
+        from huggingface_hub import hf_hub_download
+        from huggingface_hub.utils import EntryNotFoundError, RepositoryNotFoundError
+        try:
+            path = hf_hub_download(self.repo_id, MANIFEST_NAME, repo_type='space', token=self.api.token)
+        except (EntryNotFoundError, RepositoryNotFoundError):
+            return {}  # First incremental deploy: everything is uploaded
+        with open(path) as f:
+            return json.load(f)
+    
+    def apply(self, files, plan, manifest):
+        from huggingface_hub import CommitOperationAdd, CommitOperationDelete
+        self.api.create_repo(self.repo_id, repo_type='space', space_sdk='docker', exist_ok=True)
+        operations = [CommitOperationAdd(path_in_repo=path, path_or_fileobj=files[path]['source'])
+                      for path in plan['upload']]
+        operations += [CommitOperationDelete(path_in_repo=path) for path in plan['delete']]
+        operations.append(CommitOperationAdd(path_in_repo=MANIFEST_NAME,
+                                             path_or_fileobj=json.dumps(manifest, indent=2).encode('utf-8')))
+        self.api.create_commit(self.repo_id, operations, repo_type='space',
+                               commit_message=f"Deploy: {len(plan['upload'])} changed, {len(plan['delete'])} removed")
 
-## Technical Details
+class LocalHubTarget:
+    """Local stand-in for a Space: a directory holding the repo files and the manifest"""
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+    
+    def read_manifest(self) -> Dict[str, Dict[str, Any]]:
+        path = os.path.join(self.directory, MANIFEST_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+    
+    def apply(self, files, plan, manifest):
+        for path in plan['upload']:
+            target = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            source = files[path]['source']
+            if isinstance(source, bytes):
+                with open(target, 'wb') as f:
+                    f.write(source)
+            else:
+                shutil.copyfile(source, target)
+        for path in plan['delete']:
+            target = os.path.join(self.directory, path)
+            if os.path.exists(target):
+                os.remove(target)
+        # The manifest goes last, so an interrupted deploy re-uploads what it missed
+        with open(os.path.join(self.directory, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
 
-- **Model**: UnfilteredAI/NSFW-3B
-- **Framework**: Hugging Face Transformers with Pipeline API
-- **Interface**: Gradio
-- **Optimization**: Automatic device mapping and memory management
-"""
+def incremental_deploy(target, dry_run: bool = False) -> Dict[str, Any]:
+    """Upload only the files whose content changed since the last deploy to `target`"""
+    files = build_deploy_set()
+    plan = plan_deploy(files, target.read_manifest())
     
-    with open(os.path.join(spaces_dir, 'README.md'), 'w') as f:
-        f.write(readme_content)
+    print(f"📦 {len(files)} files, {plan['total_bytes']:,} bytes in the deploy set")
+    for path in plan['upload']:
+        print(f"   ⬆️  {path} ({files[path]['size']:,} bytes)")
+    for path in plan['delete']:
+        print(f"   🗑️  {path}")
+    print(f"   {len(plan['unchanged'])} unchanged")
+    print(f"📊 To transfer: {plan['upload_bytes']:,} bytes in {len(plan['upload'])} files, "
+          f"{len(plan['delete'])} deletions")
     
-    print("✅ All files copied successfully")
+    if dry_run:
+        print("🔍 Dry run: nothing uploaded")
+    elif not plan['upload'] and not plan['delete']:
+        print("✅ Space is up to date")
+    else:
+        manifest = {path: {"sha256": info['sha256'], "size": info['size']} for path, info in files.items()}
+        target.apply(files, plan, manifest)
+        print("✅ Deployed")
+    return plan
 
 def initialize_git_repo(spaces_dir, space_url):
     """Initialize git repository and set up remote"""
@@ -165,6 +306,23 @@ def initialize_git_repo(spaces_dir, space_url):
     print("✅ Git repository initialized")
 
 def main():
+    parser = argparse.ArgumentParser(description="Deploy the NSFW Novel Generator to Hugging Face Spaces")
+    parser.add_argument('--repo-id', help="Space to deploy incrementally, e.g. username/nsfw-novel-generator")
+    parser.add_argument('--hub-dir', help="Deploy incrementally to a local directory standing in for the hub")
+    parser.add_argument('--dry-run', action='store_true', help="Only report what would be transferred")
+    args = parser.parse_args()
+    
+    if args.repo_id or args.hub_dir:
+        if not prepare_deployment_files():
+            print("❌ File preparation failed.")
+            sys.exit(1)
+        if args.hub_dir:
+            target = LocalHubTarget(args.hub_dir)
+        else:
+            target = HubTarget(args.repo_id, token=os.environ.get('HF_TOKEN'))
+        incremental_deploy(target, dry_run=args.dry_run)
+        return
+    
     print("🚀 Hugging Face Spaces Deployment Script")
     print("=========================================\n")
     
@@ -212,7 +370,7 @@ def main():
     print(f"1. Create a new Space at: https://huggingface.co/new-space")
     print(f"   - Owner: {username}")
     print(f"   - Space name: {space_name}")
-    print(f"   - SDK: Gradio")
+    print(f"   - SDK: Docker (the Dockerfile runs the Gradio app)")
     print(f"   - Hardware: T4 small (recommended)")
     print(f"   - Visibility: Private (recommended for NSFW content)")
     print(f"\n2. Push your code:")
@@ -0,0 +1,356 @@
+import time
+import threading
+import contextvars
+from concurrent.futures import Future
+from typing import Dict, Any, Optional, List, Callable
+
+from model_integration_pipeline import LENGTH_TO_TOKENS
+
+# Per-client fair scheduling in front of the model.
+# Requests are charged by their token budget, admitted through a per-client
+# token bucket and dispatched in weighted-fair-queueing order, so one caller
+# sending many "long" stories cannot starve short interactive requests.
+# Alternatively ("sjf" policy) queued work is ordered shortest-predicted-first,
+# with aging so long jobs are never starved.
+# With a batching window, a worker that dispatches a batchable job waits up to
+# that long for compatible jobs (same batch key) and runs them in one call.
+# Clients with nothing queued or running and a full bucket are forgotten
+# (at most once per eviction interval), so rotating keys or IPs cannot grow
+# the client table without bound.
+
+POLICIES = ('fair', 'sjf')
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a client's token bucket cannot cover a request."""
+
+    def __init__(self, client_id: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded for client {client_id}, retry in {retry_after:.1f}s")
+        self.client_id = client_id
+        self.retry_after = retry_after
+
+
+class QueueFull(Exception):
+    """Raised when a client already has too many requests waiting."""
+
+
+def request_cost(length: str, max_tokens: Optional[int] = None) -> int:
+    """Charge a request by its token budget: explicit max_tokens or the length bucket."""
+    return int(max_tokens or LENGTH_TO_TOKENS.get(length, 1024))
+
+
+def sjf_priority(predicted_cost: float, waited: float, aging_rate: float) -> float:
+    """
+    Shortest-job-first priority with aging (lower runs first).
+    Every second of waiting counts as `aging_rate` fewer predicted tokens, so a
+    long job eventually outranks any newly arriving short one.
+    """
+    return predicted_cost - aging_rate * waited
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """
+        Args:
+            rate: Tokens added per second
+            capacity: Maximum tokens the bucket can hold (burst size)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_consume(self, amount: float) -> float:
+        """
+        Take `amount` tokens if available.
+
+        Returns:
+            0.0 on success, otherwise the seconds until the bucket could cover the amount
+        """
+        self._refill()
+        # A single request larger than the burst size is charged the whole bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (amount - self.tokens) / self.rate
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+
+class _Job:
+    def __init__(self, client_id: str, cost: int, predicted_cost: float, start_tag: float,
+                 finish_tag: float, func: Callable, args: tuple, kwargs: dict, batch_key: Any = None):
+        self.client_id = client_id
+        self.cost = cost
+        self.predicted_cost = predicted_cost
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.batch_key = batch_key
+        self.future = Future()
+        self.enqueued_at = time.time()
+        # Run in the submitter's context so context variables (e.g. the trace) carry over
+        self.context = contextvars.copy_context()
+
+
+class _ClientState:
+    def __init__(self, weight: float, bucket: TokenBucket):
+        self.weight = weight
+        self.bucket = bucket
+        self.last_finish_tag = 0.0
+        self.queued = 0
+        self.in_flight = 0
+        self.dispatched = 0
+        self.served = 0
+        self.rejected = 0
+        self.tokens_charged = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class FairScheduler:
+    def __init__(self, workers: int = 1, rate: float = 200.0, burst: float = 8192.0,
+                 max_queue_per_client: int = 16, weights: Optional[Dict[str, float]] = None,
+                 policy: str = 'fair', aging_rate: float = 50.0, batch_window: float = 0.0, max_batch: int = 8,
+                 evict_interval: float = 60.0):
+        """
+        Initialize the scheduler and start its worker threads.
+
+        Args:
+            workers: Number of requests executed concurrently against the model
+            rate: Per-client token refill rate (tokens per second)
+            burst: Per-client token bucket capacity
+            max_queue_per_client: Requests a client may have waiting before new ones are refused
+            weights: Optional per-client weights; a weight of 2 gets twice the share of 1
+            policy: 'fair' (weighted fair queueing) or 'sjf' (shortest predicted job first)
+            aging_rate: For 'sjf', predicted tokens forgiven per second of waiting
+            batch_window: Seconds to wait for compatible jobs to batch with (0 disables batching);
+                          can be changed while running
+            max_batch: Most jobs run in one batch
+            evict_interval: Seconds between sweeps that forget idle clients
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy: {policy}")
+        self.policy = policy
+        self.aging_rate = aging_rate
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.batched_jobs = 0
+        self.rate = rate
+        self.burst = burst
+        self.max_queue_per_client = max_queue_per_client
+        self.weights = dict(weights or {})
+        self.clients: Dict[str, _ClientState] = {}
+        self.pending: List[_Job] = []
+        self.in_flight = 0
+        self.evict_interval = evict_interval
+        self.evicted_clients = 0
+        self._last_eviction = time.time()
+        self.virtual_time = 0.0
+        self.lock = threading.Condition()
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"fair-scheduler-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _client(self, client_id: str) -> _ClientState:
+        state = self.clients.get(client_id)
+        if state is None:
+            state = _ClientState(self.weights.get(client_id, 1.0), TokenBucket(self.rate, self.burst))
+            self.clients[client_id] = state
+        return state
+
+    def _evict_idle_clients(self):
+        """Forget clients with nothing queued or running and a full bucket (caller holds the lock)."""
+        now = time.time()
+        if now - self._last_eviction < self.evict_interval:
+            return
+        self._last_eviction = now
+        # A full bucket means the client has not been charged for burst / rate seconds;
+        # recreating it later gives the same state (weights live in self.weights)
+        idle = [client_id for client_id, state in self.clients.items()
+                if not state.queued and not state.in_flight and state.bucket.available() >= state.bucket.capacity]
+        for client_id in idle:
+            del self.clients[client_id]
+        self.evicted_clients += len(idle)
+
+    def set_weight(self, client_id: str, weight: float):
+        """Change a client's share of the model; applies to requests submitted afterwards."""
+        with self.lock:
+            self.weights[client_id] = weight
+            self._client(client_id).weight = weight
+
+    def submit(self, client_id: str, cost: int, func: Callable, *args,
+               predicted_cost: Optional[float] = None, batch_key: Any = None, **kwargs) -> Future:
+        """
+        Queue `func(*args, **kwargs)` on behalf of a client.
+
+        `cost` (the token budget) is what the client is charged; `predicted_cost`
+        (expected tokens actually generated, defaults to `cost`) orders the 'sjf' policy.
+
+        A job with a `batch_key` is run as `func([args, ...])` together with other
+        queued jobs with the same key and func (one args tuple per job, kwargs are
+        not passed); func returns one result per job, in order.
+
+        Raises:
+            RateLimitExceeded: The client's token bucket cannot cover `cost`
+            QueueFull: The client already has `max_queue_per_client` requests waiting
+        """
+        with self.lock:
+            self._evict_idle_clients()
+            state = self._client(client_id)
+            if state.queued >= self.max_queue_per_client:
+                state.rejected += 1
+                raise QueueFull(f"Too many queued requests for client {client_id}")
+            retry_after = state.bucket.try_consume(cost)
+            if retry_after > 0:
+                state.rejected += 1
+                raise RateLimitExceeded(client_id, retry_after)
+
+            # Weighted fair queueing tags: a client's requests follow each other in
+            # virtual time, and cheap requests finish (and so dispatch) earlier
+            start_tag = max(self.virtual_time, state.last_finish_tag)
+            finish_tag = start_tag + cost / state.weight
+            state.last_finish_tag = finish_tag
+            state.queued += 1
+            state.tokens_charged += cost
+
+            job = _Job(client_id, cost, cost if predicted_cost is None else predicted_cost,
+                       start_tag, finish_tag, func, args, kwargs, batch_key)
+            self.pending.append(job)
+            # Wake every worker: one may be collecting a batch while others sit idle
+            self.lock.notify_all()
+            return job.future
+
+    def _next_job(self) -> _Job:
+        """Pop the next job under the active policy (caller holds the lock)."""
+        if self.policy == 'sjf':
+            now = time.time()
+            job = min(self.pending, key=lambda j: (
+                sjf_priority(j.predicted_cost, now - j.enqueued_at, self.aging_rate), j.enqueued_at))
+        else:
+            job = min(self.pending, key=lambda j: (j.finish_tag, j.enqueued_at))
+        self.pending.remove(job)
+        return job
+
+    def _dispatch(self, job: _Job) -> bool:
+        """Account for a job leaving the queue (caller holds the lock); False if it was cancelled."""
+        self.virtual_time = max(self.virtual_time, job.start_tag)
+        state = self.clients[job.client_id]
+        state.queued -= 1
+        state.dispatched += 1
+        wait = time.time() - job.enqueued_at
+        state.total_wait += wait
+        state.max_wait = max(state.max_wait, wait)
+        if not job.future.set_running_or_notify_cancel():
+            # The caller gave up while the job was queued
+            return False
+        state.in_flight += 1
+        self.in_flight += 1
+        return True
+
+    def _collect_batch(self, first: _Job) -> List[_Job]:
+        """Gather queued jobs compatible with `first` for up to batch_window seconds (caller holds the lock)."""
+        batch = [first]
+        deadline = time.time() + self.batch_window
+        while len(batch) < self.max_batch:
+            for job in [j for j in self.pending if j.batch_key == first.batch_key and j.func is first.func]:
+                if len(batch) >= self.max_batch:
+                    break
+                self.pending.remove(job)
+                if self._dispatch(job):
+                    batch.append(job)
+            remaining = deadline - time.time()
+            if len(batch) >= self.max_batch or remaining <= 0:
+                break
+            self.lock.wait(remaining)
+        return batch
+
+    def _worker_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                job = self._next_job()
+                if not self._dispatch(job):
+                    continue
+                batch = [job]
+                if job.batch_key is not None and self.batch_window > 0:
+                    batch = self._collect_batch(job)
+                    self.batches += 1
+                    self.batched_jobs += len(batch)
+                    # Jobs left behind by this worker still need one
+                    if self.pending:
+                        self.lock.notify()
+
+            try:
+                if job.batch_key is None:
+                    job.future.set_result(job.context.run(job.func, *job.args, **job.kwargs))
+                else:
+                    results = job.context.run(job.func, [j.args for j in batch])
+                    for j, result in zip(batch, results):
+                        j.future.set_result(result)
+            except BaseException as e:
+                for j in batch:
+                    if not j.future.done():
+                        j.future.set_exception(e)
+            finally:
+                with self.lock:
+                    for j in batch:
+                        state = self.clients[j.client_id]
+                        state.in_flight -= 1
+                        state.served += 1
+                    self.in_flight -= len(batch)
+
+    def queue_depth(self) -> int:
+        with self.lock:
+            return len(self.pending)
+
+    def is_idle(self) -> bool:
+        """True when nothing is queued or running."""
+        with self.lock:
+            return not self.pending and not self.in_flight
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Per-client queue statistics plus scheduler totals."""
+        with self.lock:
+            clients = {}
+            for client_id, state in self.clients.items():
+                clients[client_id] = {
+                    "weight": state.weight,
+                    "queued": state.queued,
+                    "in_flight": state.in_flight,
+                    "served": state.served,
+                    "rejected": state.rejected,
+                    "tokens_charged": state.tokens_charged,
+                    "bucket_tokens": round(state.bucket.available(), 1),
+                    "avg_wait": state.total_wait / state.dispatched if state.dispatched else 0.0,
+                    "max_wait": state.max_wait
+                }
+            return {
+                "policy": self.policy,
+                "workers": len(self.workers),
+                "queue_depth": len(self.pending),
+                "virtual_time": self.virtual_time,
+                "rate": self.rate,
+                "burst": self.burst,
+                "batch_window": self.batch_window,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_jobs / self.batches if self.batches else 0.0,
+                "evicted_clients": self.evicted_clients,
+                "clients": clients
+            }
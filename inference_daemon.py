@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Local inference daemon
+
+Runs one ModelIntegrationPipeline in its own process and serves it over a
+Unix socket, so the web front ends (app.py, app_pipeline.py, app_spaces.py)
+can be scaled or restarted without loading more copies of the model. Set
+INFERENCE_SOCKET in the front end's environment and it uses InferenceClient
+instead of an in-process model.
+
+Protocol: frames of a 5-byte header (message type, payload length) and a
+payload. Requests, results and errors are JSON; streamed story chunks are the
+generated UTF-8 text as-is, written with one sendmsg (header and chunk, no
+concatenation) and read with one recv, so the hot path never touches JSON.
+
+worker_supervisor.py runs this daemon as a recyclable worker: it polls the
+`worker_status` call, and SIGUSR1 drains the daemon before it exits.
+
+Usage:
+    python inference_daemon.py --socket /tmp/nsfw-novel.sock --model UnfilteredAI/NSFW-3B
+    INFERENCE_SOCKET=/tmp/nsfw-novel.sock python app_pipeline.py
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+from typing import Dict, Any, Optional
+
+FRAME = struct.Struct('!BI')  # message type, payload length
+
+MSG_REQUEST = 1  # JSON {"method", "args", "kwargs"}
+MSG_RESULT = 2   # JSON {"result"}
+MSG_ERROR = 3    # JSON {"type", "message"} (+ "required", "available" for MemoryBudgetExceeded)
+MSG_CHUNK = 4    # Raw UTF-8 text of a streamed story
+MSG_END = 5      # JSON {} closing a stream
+
+# Methods a client may call; generate_story_stream answers with chunks instead of a result
+METHODS = {
+    'generate_story', 'generate_story_detailed', 'generate_candidates', 'generate_stories',
+    'generate_text', 'get_model_info', 'load_adapter', 'unload_adapter'
+}
+STREAM_METHOD = 'generate_story_stream'
+STATUS_METHOD = 'worker_status'  # Answered by the daemon itself (see worker_supervisor)
+
+DEFAULT_SOCKET = '/tmp/nsfw-novel-inference.sock'
+
+
+def send_frame(sock: socket.socket, kind: int, payload: bytes = b''):
+    sock.sendmsg([FRAME.pack(kind, len(payload)), payload])
+
+
+def send_json(sock: socket.socket, kind: int, message: Dict[str, Any]):
+    send_frame(sock, kind, json.dumps(message).encode('utf-8'))
+
+
+def recv_frame(sock: socket.socket) -> Optional[tuple]:
+    """(type, payload bytes), or None when the peer closed the connection."""
+    header = sock.recv(FRAME.size, socket.MSG_WAITALL)
+    if len(header) < FRAME.size:
+        return None
+    kind, length = FRAME.unpack(header)
+    payload = sock.recv(length, socket.MSG_WAITALL) if length else b''
+    if len(payload) < length:
+        return None
+    return kind, payload
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """One client connection; requests on it are served one after another."""
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections.add(self.request)
+        try:
+            while not server.draining:
+                frame = recv_frame(self.request)
+                if frame is None:
+                    return
+                kind, payload = frame
+                with server.lock:
+                    server.busy[self.request] = time.time()
+                try:
+                    self._serve(server.model, payload)
+                finally:
+                    with server.lock:
+                        del server.busy[self.request]
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        finally:
+            with server.lock:
+                server.connections.discard(self.request)
+
+    def _serve(self, model, payload: bytes):
+        try:
+            call = json.loads(payload)
+            method, args, kwargs = call['method'], call.get('args', []), call.get('kwargs', {})
+            if method == STATUS_METHOD:
+                send_json(self.request, MSG_RESULT, {"result": self.server.status()})
+                return
+            with self.server.lock:
+                self.server.requests += 1
+            if method == STREAM_METHOD:
+                self._stream(model, args, kwargs)
+                return
+            if method not in METHODS:
+                raise ValueError(f"Unknown method: {method}")
+            result = getattr(model, method)(*args, **kwargs)
+            send_json(self.request, MSG_RESULT, {"result": result})
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+        except Exception as e:
+            error = {"type": type(e).__name__, "message": str(e)}
+            if hasattr(e, 'required'):
+                error.update(required=e.required, available=e.available)
+            send_json(self.request, MSG_ERROR, error)
+
+    def _stream(self, model, args, kwargs):
+        stream = model.generate_story_stream(*args, raw=True, **kwargs)
+        try:
+            for chunk in stream:
+                send_frame(self.request, MSG_CHUNK, chunk)
+            send_json(self.request, MSG_END, {})
+        finally:
+            # Stops the generation if the client went away mid-story
+            stream.close()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, model):
+        super().__init__(socket_path, _Handler)
+        self.model = model
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.busy: Dict[socket.socket, float] = {}  # Connection -> start of the request it is serving
+        self.requests = 0
+        self.draining = False
+        self.started_at = time.time()
+
+    def status(self) -> Dict[str, Any]:
+        """Load and progress of this worker, for the supervisor's recycling and watchdog."""
+        now = time.time()
+        with self.lock:
+            busy_since = min(self.busy.values(), default=None)
+            in_flight = len(self.busy) - 1  # Not counting this status request
+            requests = self.requests
+        stalled = None
+        if in_flight > 0:
+            # Seconds since anything moved: the latest decode step, or the oldest request's start
+            last_step_at = getattr(self.model, 'last_step_at', None) or 0.0
+            stalled = now - max(last_step_at, busy_since)
+        return {
+            "pid": os.getpid(),
+            "worker_generation": int(os.environ.get('WORKER_GENERATION', 0)),
+            "uptime_seconds": now - self.started_at,
+            "requests": requests,
+            "in_flight": in_flight,
+            "connections": len(self.connections),
+            "stalled_seconds": stalled,
+            "draining": self.draining
+        }
+
+
+class InferenceDaemon:
+    def __init__(self, model, socket_path: str = DEFAULT_SOCKET):
+        """
+        Initialize the daemon.
+
+        Args:
+            model: The ModelIntegrationPipeline to serve
+            socket_path: Unix socket to listen on (a stale file is replaced)
+        """
+        self.model = model
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.server = _Server(socket_path, model)
+        os.chmod(socket_path, 0o660)  # Local front ends in the same group only
+
+    def serve_forever(self):
+        print(f"🔌 Serving {self.model.model_name} on {self.socket_path}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def drain(self, timeout: Optional[float] = None):
+        """
+        Finish the requests in progress, close every connection and stop serving.
+        Returns at once; serve_forever() returns when the drain is done. Clients
+        reconnect on their next call (to the replacement worker, under a supervisor).
+        """
+        threading.Thread(target=self._drain, args=(timeout,), name="inference-drain", daemon=True).start()
+
+    def _drain(self, timeout: Optional[float]):
+        server = self.server
+        print(f"🚰 Draining {self.socket_path}")
+        deadline = time.time() + timeout if timeout is not None else None
+        server.draining = True
+        while deadline is None or time.time() < deadline:
+            with server.lock:
+                # Idle connections are closed now, busy ones by their handler after the current request
+                for conn in server.connections - set(server.busy):
+                    try:
+                        conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                if not server.connections:
+                    break
+            time.sleep(0.1)
+        server.shutdown()
+
+    def close(self):
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.model.close()
+
+
+class RemoteError(RuntimeError):
+    """An error raised inside the daemon."""
+
+
+def remote_error(message: Dict[str, Any]) -> Exception:
+    """The exception to raise for an error frame."""
+    # Keep argument errors distinguishable for callers that answer them with a 400,
+    # and memory budget refusals for those that answer them with a 503
+    if message["type"] == "ValueError":
+        return ValueError(message["message"])
+    if message["type"] == "MemoryBudgetExceeded":
+        from model_integration_pipeline import MemoryBudgetExceeded
+        return MemoryBudgetExceeded(message["required"], message["available"])
+    return RemoteError(f"{message['type']}: {message['message']}")
+
+
+class InferenceClient:
+    """
+    Thin stand-in for ModelIntegrationPipeline that forwards calls to an
+    inference daemon. Safe to share between threads: each call borrows a pooled
+    connection. Story sessions are not available, as their KV cache lives in
+    the caller's process.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, info_ttl: float = 1.0):
+        self.socket_path = socket_path
+        self.info_ttl = info_ttl
+        self._pool: "queue.LifoQueue[socket.socket]" = queue.LifoQueue()
+        self._info = None
+        self._info_at = 0.0
+
+    def _connect(self, fresh: bool = False) -> socket.socket:
+        if not fresh:
+            try:
+                return self._pool.get_nowait()
+            except queue.Empty:
+                pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        return sock
+
+    def _call(self, method: str, *args, **kwargs):
+        # A call that gets no answer is retried once on a new connection: the daemon closes
+        # pooled connections when it is recycled, and a stuck worker is killed and replaced
+        for attempt in range(2):
+            sock = self._connect(fresh=attempt > 0)
+            try:
+                send_json(sock, MSG_REQUEST, {"method": method, "args": list(args), "kwargs": kwargs})
+                frame = recv_frame(sock)
+            except OSError:
+                sock.close()
+                if attempt:
+                    raise
+                continue
+            if frame is not None:
+                break
+            sock.close()
+            if attempt:
+                raise ConnectionError("Inference daemon closed the connection")
+        self._pool.put(sock)
+        kind, payload = frame
+        message = json.loads(payload)
+        if kind == MSG_ERROR:
+            raise remote_error(message)
+        return message["result"]
+
+    def generate_story(self, prompt: str, genre: str, length: str, temperature: float = 0.7, **kwargs) -> str:
+        return self._call('generate_story', prompt, genre, length, temperature, **kwargs)
+
+    def generate_story_detailed(self, prompt: str, genre: str, length: str, temperature: float = 0.7,
+                                **kwargs) -> Dict[str, Any]:
+        return self._call('generate_story_detailed', prompt, genre, length, temperature, **kwargs)
+
+    def generate_candidates(self, prompt: str, genre: str, length: str, n: int = 3, temperature: float = 0.7,
+                            **kwargs):
+        return self._call('generate_candidates', prompt, genre, length, n, temperature, **kwargs)
+
+    def generate_stories(self, requests):
+        return self._call('generate_stories', requests)
+
+    def generate_text(self, text: str, max_new_tokens: int, temperature: float = 0.7, **kwargs) -> Dict[str, Any]:
+        return self._call('generate_text', text, max_new_tokens, temperature, **kwargs)
+
+    def load_adapter(self, name: str, path: str):
+        self._call('load_adapter', name, path)
+        self._info = None
+
+    def unload_adapter(self, name: str):
+        self._call('unload_adapter', name)
+        self._info = None
+
+    def _open_stream(self, request: Dict[str, Any]) -> tuple:
+        """Send a stream request; (socket, first frame), retrying once if a pooled connection was closed."""
+        for attempt in range(2):
+            sock = self._connect(fresh=attempt > 0)
+            try:
+                send_json(sock, MSG_REQUEST, request)
+                frame = recv_frame(sock)
+            except OSError:
+                frame = None
+            if frame is not None or attempt:
+                return sock, frame
+            sock.close()
+
+    def generate_story_stream(self, prompt: str, genre: str, length: str, temperature: float = 0.7,
+                              raw: bool = False, **kwargs):
+        """Yield story chunks as the daemon decodes them (bytes with `raw`, passed through untouched)."""
+        sock, frame = self._open_stream({"method": STREAM_METHOD, "args": [prompt, genre, length, temperature],
+                                         "kwargs": kwargs})
+        finished = False
+        try:
+            while True:
+                if frame is None:
+                    raise ConnectionError("Inference daemon closed the connection")
+                kind, payload = frame
+                if kind == MSG_CHUNK:
+                    yield payload if raw else payload.decode('utf-8')
+                    frame = recv_frame(sock)
+                elif kind == MSG_END:
+                    finished = True
+                    return
+                else:
+                    finished = True
+                    raise remote_error(json.loads(payload))
+        finally:
+            if finished:
+                self._pool.put(sock)
+            else:
+                # Abandoned mid-stream: closing the connection makes the daemon stop generating
+                sock.close()
+
+    def worker_status(self) -> Dict[str, Any]:
+        return self._call(STATUS_METHOD)
+
+    def get_model_info(self) -> Dict[str, Any]:
+        info = self._call('get_model_info')
+        info["inference_socket"] = self.socket_path
+        self._info, self._info_at = info, time.time()
+        return info
+
+    def _cached_info(self) -> Dict[str, Any]:
+        if self._info is None or time.time() - self._info_at > self.info_ttl:
+            self.get_model_info()
+        return self._info
+
+    @property
+    def model_name(self) -> str:
+        return self._cached_info()["model_name"]
+
+    @property
+    def mock_mode(self) -> bool:
+        return self._cached_info()["mock_mode"]
+
+    @property
+    def use_pipeline(self) -> bool:
+        return self._cached_info()["use_pipeline"]
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        return self._cached_info()["tokens_per_second"]
+
+    @property
+    def kv_cache_bits(self) -> Optional[int]:
+        return self._cached_info()["kv_cache_bits"]
+
+    @property
+    def adapters(self) -> Dict[str, Dict[str, Any]]:
+        return self._cached_info()["adapters"]
+
+    def close(self):
+        """Close pooled connections (the daemon and its model keep running)."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a model to local front ends over a Unix socket")
+    parser.add_argument('--socket', default=os.environ.get('INFERENCE_SOCKET', DEFAULT_SOCKET))
+    parser.add_argument('--model', default="UnfilteredAI/NSFW-3B", help="Model name or local path")
+    parser.add_argument('--mock', action='store_true', help="Serve mock stories instead of loading the model")
+    parser.add_argument('--traditional', action='store_true', help="Load without the pipeline API")
+    args = parser.parse_args()
+
+    from model_integration_pipeline import ModelIntegrationPipeline
+    model = ModelIntegrationPipeline(model_name=args.model, use_mock=args.mock, use_pipeline=not args.traditional)
+    daemon = InferenceDaemon(model, args.socket)
+    # Exit through serve_forever's cleanup on SIGTERM so the socket file is removed;
+    # SIGUSR1 (sent by worker_supervisor when recycling) drains first
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    signal.signal(signal.SIGUSR1, lambda *_: daemon.drain())
+    daemon.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import requests
 import json
 import time
+import secrets
 
 class CodespacesConnector:
     """
@@ -21,6 +22,7 @@ class CodespacesConnector:
         self.health_url = f"{self.base_url}/health"
         self.generate_url = f"{self.base_url}/api/generate"
         self.session = requests.Session()
+        self.deadline_margin = 5.0  # Seconds reserved for network transfer
     
     def check_connection(self):
         """
@@ -36,15 +38,22 @@ class CodespacesConnector:
         except requests.exceptions.RequestException as e:
             return {"status": "error", "message": str(e)}
     
-    def generate_story(self, prompt, genre="romance", length="medium", temperature=0.7):
+    def generate_story(self, prompt, genre="romance", length="medium", temperature=0.7, timeout=60, trace=False):
         """
         Generate a story using the GitHub Codespaces application API.
         
+        The server is told how long we are willing to wait, so that instead of
+        generating past our timeout it returns a partial story (`truncated: True`).
+        Each call carries a W3C `traceparent` header; the returned `trace_id`
+        identifies the call in the server's trace file.
+        
         Args:
             prompt (str): The story prompt
             genre (str): The genre of the story (romance, fantasy, sci-fi, contemporary, historical)
             length (str): The desired length (short, medium, long)
             temperature (float): Creativity parameter (0.0 to 1.0)
+            timeout (float): Seconds to wait for the story
+            trace (bool): Ask the server to record this call's trace regardless of its sampling rate
             
         Returns:
             dict: The generated story or an error message
@@ -53,24 +62,31 @@ class CodespacesConnector:
             "prompt": prompt,
             "genre": genre,
             "length": length,
-            "temperature": temperature
+            "temperature": temperature,
+            # Leave room for the network round trip and JSON serialization
+            "deadline_seconds": max(1.0, timeout - self.deadline_margin)
         }
         
+        trace_id = secrets.token_hex(16)
+        headers = {"traceparent": f"00-{trace_id}-{secrets.token_hex(8)}-{'01' if trace else '00'}"}
+        
         try:
             start_time = time.time()
             response = self.session.post(
                 self.generate_url, 
                 json=payload,
-                timeout=60  # Longer timeout for story generation
+                headers=headers,
+                timeout=timeout  # Longer timeout for story generation
             )
             response.raise_for_status()
             generation_time = time.time() - start_time
             
             result = response.json()
             result["generation_time"] = generation_time
+            result["trace_id"] = trace_id
             return result
         except requests.exceptions.RequestException as e:
-            return {"status": "error", "message": str(e)}
+            return {"status": "error", "message": str(e), "trace_id": trace_id}
 
 # Example usage
 if __name__ == "__main__":
@@ -92,6 +108,8 @@ if __name__ == "__main__":
         
         if story_result.get("status") == "success":
             print(f"\nGenerated in {story_result.get('generation_time', 0):.2f} seconds:\n")
+            if story_result.get("truncated"):
+                print("(Partial story: the server stopped at the deadline)\n")
             print(story_result.get("story", "No story generated"))
         else:
             print(f"Error: {story_result.get('message')}")
\ No newline at end of file
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Quantized KV cache
+
+Stores past_key_values as int8 (or packed int4) with one scale per head and
+token, so a 2048-token generation holds roughly half (int8) or a quarter
+(int4) of the fp16 cache. The most recent `residual_length` tokens stay in
+full precision and are quantized in chunks, like the KIVI-style
+QuantizedCache in transformers, but without the optimum-quanto/HQQ
+dependency: quantization is plain torch.
+
+Enable it in the backends with ModelIntegrationPipeline(kv_cache_bits=8) or
+the KV_CACHE_BITS environment variable.
+
+Usage:
+    python kv_quant.py --model /path/to/small-model --bits 8     # memory report + quality check
+    python kv_quant.py --model UnfilteredAI/NSFW-3B --bits 4 --tokens 2048 --report-only
+"""
+
+import argparse
+from typing import Dict, Any, Optional, Tuple
+
+SUPPORTED_BITS = (8, 4)
+SCALE_BYTES = 2  # Scales are stored in float16
+
+
+def quantize_per_head(tensor, nbits: int = 8) -> Tuple[Any, Any]:
+    """
+    Symmetric absmax quantization of a [batch, heads, tokens, head_dim] tensor.
+
+    Every (batch, head, token) vector gets its own scale, so an outlier in one
+    head does not cost precision in the others. 4-bit values are packed two
+    per byte along head_dim.
+
+    Returns:
+        (quantized int8/uint8 tensor, float16 scales of shape [batch, heads, tokens, 1])
+    """
+    import torch
+    qmax = 2 ** (nbits - 1) - 1
+    x = tensor.float()
+    scale = x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / qmax
+    q = torch.round(x / scale).clamp(-qmax, qmax).to(torch.int8)
+    if nbits == 4:
+        # Shift to 1..15 and pack pairs of values into one byte
+        q = (q + 8).to(torch.uint8)
+        q = (q[..., 0::2] << 4) | q[..., 1::2]
+    return q, scale.to(torch.float16)
+
+
+def dequantize_per_head(q, scale, nbits: int = 8, dtype=None):
+    """Inverse of quantize_per_head."""
+    import torch
+    if nbits == 4:
+        high = (q >> 4).to(torch.int8) - 8
+        low = (q & 0x0F).to(torch.int8) - 8
+        q = torch.stack([high, low], dim=-1).flatten(-2)
+    return (q.float() * scale.float()).to(dtype or torch.float16)
+
+
+try:
+    from transformers.cache_utils import QuantizedLayer
+except ImportError:  # transformers without the Cache layer API (< 4.56) or not installed
+    QuantizedLayer = None
+
+
+if QuantizedLayer is not None:
+    class QuantizedKVLayer(QuantizedLayer):
+        """
+        transformers QuantizedLayer backed by quantize_per_head.
+        Defined at module level so session caches can be spilled with torch.save.
+        """
+
+        is_croppable = False
+
+        def __init__(self, nbits: int = 8, residual_length: int = 128):
+            super().__init__(nbits=nbits, residual_length=residual_length)
+            self._quantized_keys = None
+            self._quantized_values = None
+
+        def _quantize(self, tensor, axis):
+            return quantize_per_head(tensor, self.nbits)
+
+        def _dequantize(self, q_tensor):
+            return dequantize_per_head(*q_tensor, nbits=self.nbits, dtype=self.dtype)
+
+        def batch_repeat_interleave(self, repeats: int) -> None:
+            super().batch_repeat_interleave(repeats)
+            if self._quantized_keys is not None:
+                self._quantized_keys = tuple(t.repeat_interleave(repeats, dim=0) for t in self._quantized_keys)
+                self._quantized_values = tuple(t.repeat_interleave(repeats, dim=0) for t in self._quantized_values)
+
+        def batch_select_indices(self, indices) -> None:
+            super().batch_select_indices(indices)
+            if self._quantized_keys is not None:
+                self._quantized_keys = tuple(t[indices, ...] for t in self._quantized_keys)
+                self._quantized_values = tuple(t[indices, ...] for t in self._quantized_values)
+
+
+def make_quantized_cache(config, nbits: int = 8, residual_length: int = 128):
+    """
+    A fresh quantized cache for `config`'s model, to pass as `past_key_values` to `generate`.
+
+    Args:
+        config: The model config
+        nbits: 8 or 4
+        residual_length: Recent tokens kept in full precision before being quantized
+    """
+    from transformers.cache_utils import Cache
+
+    if nbits not in SUPPORTED_BITS:
+        raise ValueError(f"kv_cache_bits must be one of {SUPPORTED_BITS}, got {nbits}")
+    if QuantizedLayer is None:
+        raise ImportError("A quantized KV cache needs transformers >= 4.56")
+    num_layers = config.get_text_config(decoder=True).num_hidden_layers
+    return Cache(layers=[QuantizedKVLayer(nbits, residual_length) for _ in range(num_layers)])
+
+
+def kv_geometry(config) -> Dict[str, int]:
+    """Layers, KV heads and head size of a model config."""
+    config = config.get_text_config(decoder=True)
+    heads = config.num_attention_heads
+    head_dim = getattr(config, 'head_dim', None) or config.hidden_size // heads
+    return {
+        "layers": config.num_hidden_layers,
+        "kv_heads": getattr(config, 'num_key_value_heads', None) or heads,
+        "head_dim": head_dim
+    }
+
+
+def kv_bytes_per_token(config, nbits: Optional[int] = None, dtype_bytes: int = 2) -> float:
+    """KV cache bytes per token (keys and values, all layers); nbits=None means unquantized."""
+    geometry = kv_geometry(config)
+    vectors = 2 * geometry["layers"] * geometry["kv_heads"]
+    if nbits is None:
+        return vectors * geometry["head_dim"] * dtype_bytes
+    return vectors * (geometry["head_dim"] * nbits / 8 + SCALE_BYTES)
+
+
+def memory_report(config, tokens: int = 2048, nbits: int = 8, dtype_bytes: int = 2,
+                  budget_bytes: int = 8 * 1024 ** 3, residual_length: int = 128) -> Dict[str, Any]:
+    """
+    KV memory for one generation of `tokens` tokens, full precision vs quantized,
+    and how many such generations fit in `budget_bytes` of cache memory.
+    """
+    fp_bytes = kv_bytes_per_token(config, None, dtype_bytes) * tokens
+    residual = min(tokens, residual_length)
+    quant_bytes = (kv_bytes_per_token(config, nbits) * (tokens - residual)
+                   + kv_bytes_per_token(config, None, dtype_bytes) * residual)
+    return {
+        **kv_geometry(config),
+        "tokens": tokens,
+        "kv_cache_bits": nbits,
+        "fp_bytes": int(fp_bytes),
+        "quantized_bytes": int(quant_bytes),
+        "ratio": quant_bytes / fp_bytes,
+        "budget_bytes": budget_bytes,
+        "fp_concurrent": int(budget_bytes // fp_bytes),
+        "quantized_concurrent": int(budget_bytes // quant_bytes)
+    }
+
+
+def quality_check(model, tokenizer, text: str, nbits: int = 8, residual_length: int = 16,
+                  greedy_tokens: int = 64) -> Dict[str, Any]:
+    """
+    Compare the quantized cache against the full-precision cache on one model.
+
+    - Teacher-forced: the text is fed one token at a time through both caches and
+      the next-token distributions are compared (KL divergence, top-1 agreement)
+    - Greedy: both caches decode `greedy_tokens` from the text's opening and the
+      length of the identical prefix is reported
+    """
+    import torch
+    from transformers import DynamicCache
+
+    input_ids = tokenizer(text, return_tensors="pt")["input_ids"].to(model.device)
+    caches = {"fp": DynamicCache(), "quantized": make_quantized_cache(model.config, nbits, residual_length)}
+    log_probs = {name: [] for name in caches}
+    with torch.no_grad():
+        for position in range(input_ids.shape[1]):
+            for name, cache in caches.items():
+                logits = model(input_ids[:, position:position + 1], past_key_values=cache, use_cache=True).logits
+                log_probs[name].append(torch.log_softmax(logits[:, -1].float(), dim=-1))
+    fp = torch.cat(log_probs["fp"])
+    quant = torch.cat(log_probs["quantized"])
+    kl = (fp.exp() * (fp - quant)).sum(-1)
+
+    prompt = input_ids[:, :max(2, input_ids.shape[1] // 4)]
+    sequences = {}
+    with torch.no_grad():
+        for name in caches:
+            cache = DynamicCache() if name == "fp" else make_quantized_cache(model.config, nbits, residual_length)
+            sequences[name] = model.generate(
+                prompt, attention_mask=torch.ones_like(prompt), past_key_values=cache,
+                max_new_tokens=greedy_tokens, min_new_tokens=greedy_tokens, do_sample=False,
+                pad_token_id=tokenizer.eos_token_id
+            )[0, prompt.shape[1]:]
+    matching = (sequences["fp"] == sequences["quantized"]).int().cumprod(0).sum().item()
+
+    return {
+        "kv_cache_bits": nbits,
+        "positions": int(input_ids.shape[1]),
+        "mean_kl": kl.mean().item(),
+        "max_kl": kl.max().item(),
+        "top1_agreement": (fp.argmax(-1) == quant.argmax(-1)).float().mean().item(),
+        "greedy_prefix_match": int(matching),
+        "greedy_tokens": greedy_tokens,
+        "fp_cache_bytes": _cache_bytes(caches["fp"]),
+        "quantized_cache_bytes": _cache_bytes(caches["quantized"])
+    }
+
+
+def _cache_bytes(cache) -> int:
+    from story_sessions import cache_nbytes
+    return cache_nbytes(cache)
+
+
+def _format_bytes(n: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n < 1024 or unit == "GiB":
+            return f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantized KV cache memory report and quality check")
+    parser.add_argument('--model', required=True, help="Model name or local path")
+    parser.add_argument('--bits', type=int, default=8, choices=SUPPORTED_BITS)
+    parser.add_argument('--tokens', type=int, default=2048, help="Tokens per generation for the memory report")
+    parser.add_argument('--budget-gib', type=float, default=8.0, help="KV memory budget for the capacity estimate")
+    parser.add_argument('--report-only', action='store_true', help="Only load the config; skip the quality check")
+    parser.add_argument('--text', default=("The moonlight filtered through the ancient oak trees, casting dancing "
+                                           "shadows on the garden path. Their hearts raced as they drew closer, "
+                                           "the scent of jasmine filling the air, and the night seemed to hold "
+                                           "its breath around them."))
+    args = parser.parse_args()
+
+    from transformers import AutoConfig
+    config = AutoConfig.from_pretrained(args.model)
+    report = memory_report(config, args.tokens, args.bits, budget_bytes=int(args.budget_gib * 1024 ** 3))
+    print(f"📊 KV cache for a {args.tokens}-token generation "
+          f"({report['layers']} layers x {report['kv_heads']} KV heads x {report['head_dim']}):")
+    print(f"   fp16:  {_format_bytes(report['fp_bytes'])}  ->  {report['fp_concurrent']} concurrent in {args.budget_gib:g} GiB")
+    print(f"   int{args.bits}:  {_format_bytes(report['quantized_bytes'])}  ->  "
+          f"{report['quantized_concurrent']} concurrent ({report['ratio']:.0%} of fp16)")
+
+    if args.report_only:
+        return
+
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, dtype=torch.float32)
+    model.eval()
+    quality = quality_check(model, tokenizer, args.text, args.bits)
+    print(f"\n🔬 Quality vs fp cache over {quality['positions']} positions:")
+    print(f"   KL divergence: mean {quality['mean_kl']:.2e}, max {quality['max_kl']:.2e}")
+    print(f"   Top-1 agreement: {quality['top1_agreement']:.1%}")
+    print(f"   Greedy decode identical for {quality['greedy_prefix_match']}/{quality['greedy_tokens']} tokens")
+    print(f"   Measured cache: {_format_bytes(quality['fp_cache_bytes'])} fp vs "
+          f"{_format_bytes(quality['quantized_cache_bytes'])} quantized")
+
+
+if __name__ == "__main__":
+    main()
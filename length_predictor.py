@@ -0,0 +1,187 @@
+import os
+import json
+import threading
+import numpy as np
+from collections import deque
+from typing import Dict, Any, Optional, List
+
+from model_integration_pipeline import LENGTH_TO_TOKENS, GENRES
+
+# Lightweight output-length predictor.
+# Stories usually stop well short of their length bucket's cap, so the cap is a
+# poor estimate of how long a request will occupy the model. This learns the
+# actual number of generated tokens from recorded history with a small ridge
+# regression over (genre, length, prompt length, temperature).
+# Only the most recent max_history records are kept (the history file is
+# compacted to that window), and refits run on a background thread so the
+# request that triggers one does not wait for it.
+
+
+class OutputLengthPredictor:
+    def __init__(self, history_path: Optional[str] = None, min_samples: int = 20,
+                 refit_every: int = 50, l2: float = 1.0, max_history: int = 5000,
+                 background_refit: bool = True):
+        """
+        Initialize the predictor, loading any recorded history.
+
+        Args:
+            history_path: JSONL file of past generations; new records are appended to it
+            min_samples: Records needed before predictions replace the bucket cap
+            refit_every: Refit after this many new records
+            l2: Ridge regularization strength
+            max_history: Most recent records kept in memory and in the history file
+            background_refit: Refit on a background thread instead of inside record()
+        """
+        self.history_path = history_path
+        self.min_samples = min_samples
+        self.refit_every = refit_every
+        self.l2 = l2
+        self.max_history = max_history
+        self.background_refit = background_refit
+        self.history = deque(maxlen=max_history)
+        self.weights = None
+        self._since_fit = 0
+        self._file_records = 0
+        self._refitting = False
+        self._lock = threading.Lock()
+
+        if history_path and os.path.exists(history_path):
+            records = list(self.load_history(history_path))
+            self.history.extend(records)
+            self._file_records = len(records)
+            if len(records) > max_history:
+                self._compact()
+            self.fit()
+
+    @staticmethod
+    def load_history(path: str):
+        """Yield records from a history JSONL file, skipping malformed lines."""
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'actual_tokens' in record:
+                    yield record
+
+    @staticmethod
+    def features(genre: str, length: str, prompt_len: int, temperature: float) -> np.ndarray:
+        """One-hot genre and length, log prompt length, temperature and a bias term."""
+        row = np.zeros(len(GENRES) + len(LENGTH_TO_TOKENS) + 3, dtype=np.float64)
+        if genre in GENRES:
+            row[GENRES.index(genre)] = 1.0
+        lengths = list(LENGTH_TO_TOKENS)
+        if length in lengths:
+            row[len(GENRES) + lengths.index(length)] = 1.0
+        row[-3] = np.log1p(prompt_len)
+        row[-2] = temperature
+        row[-1] = 1.0
+        return row
+
+    def record(self, genre: str, length: str, prompt_len: int, temperature: float, actual_tokens: int):
+        """Add a finished generation to the history (and the history file, if any)."""
+        record = {
+            "genre": genre,
+            "length": length,
+            "prompt_len": prompt_len,
+            "temperature": temperature,
+            "actual_tokens": actual_tokens
+        }
+        with self._lock:
+            self.history.append(record)
+            self._since_fit += 1
+            if self.history_path:
+                with open(self.history_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+                self._file_records += 1
+            refit = self._since_fit >= self.refit_every and not self._refitting
+            if refit:
+                self._refitting = True
+        if not refit:
+            return
+        if self.background_refit:
+            threading.Thread(target=self._refit, name="length-predictor-refit", daemon=True).start()
+        else:
+            self._refit()
+
+    def _refit(self):
+        try:
+            # The file is allowed to reach twice the window before it is rewritten
+            if self.history_path and self._file_records > 2 * self.max_history:
+                self._compact()
+            self.fit()
+        finally:
+            self._refitting = False
+
+    def _compact(self):
+        """Rewrite the history file with just the records kept in memory."""
+        with self._lock:
+            tmp_path = self.history_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for record in self.history:
+                    f.write(json.dumps(record) + '\n')
+            os.replace(tmp_path, self.history_path)
+            self._file_records = len(self.history)
+
+    def fit(self, records: Optional[List[Dict[str, Any]]] = None):
+        """
+        Fit the regression on `records` (default: the kept history).
+
+        The target is the fraction of the length bucket's cap actually used,
+        which keeps the buckets on one scale.
+        """
+        with self._lock:
+            records = list(self.history if records is None else records)
+            self._since_fit = 0
+        if len(records) < self.min_samples:
+            self.weights = None
+            return
+
+        X = np.stack([
+            self.features(r['genre'], r['length'], r['prompt_len'], r['temperature'])
+            for r in records
+        ])
+        caps = np.array([LENGTH_TO_TOKENS.get(r['length'], 1024) for r in records], dtype=np.float64)
+        y = np.array([r['actual_tokens'] for r in records], dtype=np.float64) / caps
+
+        # Closed-form ridge regression (the bias term is not shrunk)
+        penalty = self.l2 * np.eye(X.shape[1])
+        penalty[-1, -1] = 0.0
+        A = X.T @ X + penalty
+        self.weights = np.linalg.solve(A, X.T @ y)
+
+    @property
+    def trained(self) -> bool:
+        return self.weights is not None
+
+    def predict(self, genre: str, length: str, prompt_len: int, temperature: float,
+                max_tokens: Optional[int] = None) -> int:
+        """
+        Predict the number of tokens a request will generate.
+        Falls back to the token budget itself until enough history is recorded.
+        """
+        cap = LENGTH_TO_TOKENS.get(length, 1024)
+        budget = max_tokens or cap
+        if self.weights is None:
+            return budget
+        fraction = float(self.features(genre, length, prompt_len, temperature) @ self.weights)
+        tokens = int(round(fraction * cap))
+        return max(1, min(budget, tokens))
+
+    def evaluate(self, records: List[Dict[str, Any]]) -> Dict[str, float]:
+        """Prediction error on held-out records, next to the bucket-cap baseline."""
+        if not records:
+            return {"samples": 0}
+        actual = np.array([r['actual_tokens'] for r in records], dtype=np.float64)
+        predicted = np.array([
+            self.predict(r['genre'], r['length'], r['prompt_len'], r['temperature'])
+            for r in records
+        ], dtype=np.float64)
+        caps = np.array([LENGTH_TO_TOKENS.get(r['length'], 1024) for r in records], dtype=np.float64)
+        return {
+            "samples": len(records),
+            "mae": float(np.mean(np.abs(predicted - actual))),
+            "mape": float(np.mean(np.abs(predicted - actual) / np.maximum(actual, 1))),
+            "cap_mae": float(np.mean(np.abs(caps - actual)))
+        }
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+HTTP load-testing harness for the Flask apps
+
+Starts one of the Flask apps locally in a separate process (mock backend by
+default, or a small local model with --model) and drives /api/generate with
+open-loop Poisson arrivals at a sweep of request rates, using a realistic
+genre/length mix. Latency is measured from each request's scheduled arrival,
+so a server that falls behind shows up as growing latency rather than a
+quietly reduced send rate.
+
+For each rate it reports achieved throughput, latency percentiles and error
+rates, and marks the saturation point: the first rate the server cannot keep
+up with.
+
+Usage:
+    python load_test.py --app app_pipeline --rates 1,2,4,8,16 --duration 20
+    python load_test.py --app app --debug-server --rates 5,10,20
+    python load_test.py --url http://localhost:5000 --rates 1,2,4
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List
+
+import numpy as np
+import requests
+
+from model_integration_pipeline import GENRES
+from benchmark_pipeline import SAMPLE_PROMPTS
+
+# Launches an app module's Flask app; a local model is chosen through MODEL_NAME/USE_MOCK before import,
+# so everything the app builds around its model at import time (router, pools, caches) uses it
+SERVER_SNIPPET = """
+import importlib
+module = importlib.import_module({app!r})
+module.app.run(host='127.0.0.1', port={port}, debug={debug}, use_reloader=False, threaded=True)
+"""
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """Parse 'short:0.6,medium:0.3,long:0.1' into normalized weights."""
+    mix = {}
+    for part in spec.split(','):
+        name, weight = part.split(':')
+        mix[name.strip()] = float(weight)
+    total = sum(mix.values())
+    return {name: weight / total for name, weight in mix.items()}
+
+
+def start_server(app: str, port: int, model: str, debug: bool) -> subprocess.Popen:
+    """Start the app in its own process and wait for /health to answer."""
+    code = SERVER_SNIPPET.format(app=app, port=port, debug=debug)
+    env = dict(os.environ, MODEL_NAME=model, USE_MOCK='0') if model else None
+    server = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 300
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            if requests.get(f"{url}/health", timeout=1).ok:
+                return server
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("Server did not become healthy within 300s")
+
+
+class LoadGenerator:
+    def __init__(self, url: str, mix: Dict[str, float], clients: int, timeout: float,
+                 max_inflight: int, seed: int):
+        self.url = url.rstrip('/')
+        self.mix = mix
+        self.clients = [f"load-test-{i}" for i in range(clients)]
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.rng = random.Random(seed)
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _payload(self) -> Dict[str, Any]:
+        return {
+            "prompt": self.rng.choice(SAMPLE_PROMPTS),
+            "genre": self.rng.choice(GENRES),
+            "length": self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0],
+            "temperature": 0.7
+        }
+
+    def _send(self, scheduled_at: float, payload: Dict[str, Any], client: str) -> Dict[str, Any]:
+        try:
+            response = self._session().post(
+                f"{self.url}/api/generate", json=payload,
+                headers={"X-API-Key": client}, timeout=self.timeout
+            )
+            status = response.status_code
+            size = len(response.content)
+        except requests.exceptions.RequestException as e:
+            status = type(e).__name__
+            size = 0
+        return {
+            "length": payload['length'],
+            "status": status,
+            "latency": time.time() - scheduled_at,
+            "bytes": size
+        }
+
+    def run(self, rate: float, duration: float) -> List[Dict[str, Any]]:
+        """Send Poisson arrivals at `rate` req/s for `duration` seconds; wait for all replies."""
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.max_inflight) as pool:
+            start = time.time()
+            next_arrival = start + self.rng.expovariate(rate)
+            while next_arrival < start + duration:
+                delay = next_arrival - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(pool.submit(self._send, next_arrival, self._payload(), self.rng.choice(self.clients)))
+                next_arrival += self.rng.expovariate(rate)
+            results = [f.result() for f in futures]
+        wall = time.time() - start
+        for result in results:
+            result['wall'] = wall
+        return results
+
+
+def summarize(rate: float, duration: float, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    ok = [r for r in results if r['status'] == 200]
+    latencies = np.array([r['latency'] for r in ok]) if ok else np.array([0.0])
+    wall = results[0]['wall'] if results else duration
+    errors = {}
+    for r in results:
+        if r['status'] != 200:
+            errors[str(r['status'])] = errors.get(str(r['status']), 0) + 1
+    return {
+        "rate": rate,
+        "offered": len(results) / duration,
+        "sent": len(results),
+        "throughput": len(ok) / wall if wall > 0 else 0.0,
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "p99": float(np.percentile(latencies, 99)),
+        "error_rate": 1.0 - len(ok) / len(results) if results else 0.0,
+        "errors": errors,
+        "mean_response_bytes": float(np.mean([r['bytes'] for r in ok])) if ok else 0.0
+    }
+
+
+def find_saturation(rows: List[Dict[str, Any]], slo_p95: float) -> Any:
+    """First rate whose throughput falls 10% short of the offered load, errors, or breaks the p95 SLO."""
+    for row in rows:
+        if (row['throughput'] < 0.9 * row['offered'] or row['error_rate'] > 0.01
+                or (slo_p95 and row['p95'] > slo_p95)):
+            return row['rate']
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open-loop HTTP load test for the Flask apps")
+    parser.add_argument('--app', default='app_pipeline', choices=['app_pipeline', 'app'],
+                        help="App module to start locally")
+    parser.add_argument('--url', help="Target an already running server instead of starting one")
+    parser.add_argument('--model', help="Local model path/name to load instead of the mock backend")
+    parser.add_argument('--debug-server', action='store_true', help="Run Flask with debug=True, as app.py does")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--rates', default='1,2,4,8,16', help="Comma-separated request rates (req/s)")
+    parser.add_argument('--duration', type=float, default=20.0, help="Seconds of arrivals per rate")
+    parser.add_argument('--mix', default='short:0.5,medium:0.35,long:0.15', help="Length mix")
+    parser.add_argument('--clients', type=int, default=8, help="Distinct API keys to spread load over")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Per-request timeout")
+    parser.add_argument('--max-inflight', type=int, default=256, help="Cap on concurrent open requests")
+    parser.add_argument('--slo-p95', type=float, default=0.0, help="p95 latency target for saturation (0 = none)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', help="Write the throughput/latency curve as CSV")
+    parser.add_argument('--json', help="Write the full report as JSON")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if not url:
+        print(f"🚀 Starting {args.app} on port {args.port} ({args.model or 'mock backend'})...")
+        server = start_server(args.app, args.port, args.model, args.debug_server)
+        url = f"http://127.0.0.1:{args.port}"
+
+    generator = LoadGenerator(url, parse_mix(args.mix), args.clients, args.timeout, args.max_inflight, args.seed)
+    rows = []
+    try:
+        print(f"\n{'rate':>8} {'sent':>6} {'thru/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>7}")
+        for rate in [float(r) for r in args.rates.split(',')]:
+            row = summarize(rate, args.duration, generator.run(rate, args.duration))
+            rows.append(row)
+            print(f"{row['rate']:>8.1f} {row['sent']:>6d} {row['throughput']:>8.2f} {row['p50']:>8.3f} "
+                  f"{row['p95']:>8.3f} {row['p99']:>8.3f} {row['error_rate']:>7.1%}"
+                  + (f"  {row['errors']}" if row['errors'] else ""))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    saturation = find_saturation(rows, args.slo_p95)
+    if saturation is None:
+        print("\n✅ No saturation within the tested rates")
+    else:
+        print(f"\n⚠️ Saturation at {saturation} req/s")
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['rate', 'offered', 'sent', 'throughput', 'p50', 'p95', 'p99', 'error_rate'],
+                                    extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"url": url, "app": args.app, "model": args.model or "mock",
+                       "saturation_rate": saturation, "rows": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,190 @@
 import os
+import re
 import json
+import time
+import threading
+import contextlib
 import numpy as np
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Callable
+
+from tracing import record_span
+from slow_profiler import profiler
 
 # Enhanced model integration with Hugging Face Pipeline support
 # This version supports both the traditional approach and the pipeline API
 
+# Map length to approximate token counts
+LENGTH_TO_TOKENS = {
+    "short": 512,
+    "medium": 1024,
+    "long": 2048
+}
+
+# Compiled decode: static KV caches are sized to a length tier's budget plus the prompt rounded up to this
+STATIC_PROMPT_BUCKET = 256
+
+GENRES = ['romance', 'fantasy', 'sci-fi', 'contemporary', 'historical']
+
+# peft's adapter name for rows of a mixed-adapter batch that use the bare base model
+BASE_ADAPTER = "__base__"
+
+# A sentence ends with . ! or ? optionally followed by closing quotes/brackets
+SENTENCE_END = re.compile(r'[.!?]["\'\u201d\u2019)\]]*(?=\s|$)')
+
+
+class GenerationMonitor:
+    """
+    Stopping criterion that records decode progress and enforces a deadline.
+
+    Passed to `generate` through `stopping_criteria`. It is called once per
+    generated token, so it doubles as a cheap way to measure time-to-first-token
+    and decode speed without a streamer.
+    """
+
+    def __init__(self, deadline: Optional[float] = None, stop_when: Optional[Callable[[], bool]] = None):
+        self.deadline = deadline
+        self.stop_when = stop_when  # Checked every token; True cancels the generation
+        self.started_at = time.time()
+        self.generate_started_at = None  # Set by backends that tokenize separately
+        self.first_token_at = None
+        self.last_token_at = None
+        self.tokens = 0
+        self.timed_out = False
+        self.cancelled = False
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        now = time.time()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.last_token_at = now
+        self.tokens += 1
+        if self.deadline is not None and now >= self.deadline:
+            self.timed_out = True
+        if self.stop_when is not None and self.stop_when():
+            self.cancelled = True
+        return self.timed_out or self.cancelled
+
+    def cancel(self):
+        """Stop the generation at the next token (e.g. its reader went away)."""
+        self.cancelled = True
+
+    def phases(self) -> List[tuple]:
+        """(name, start, end) for the tokenization, prefill and decode phases observed."""
+        phases = []
+        prefill_start = self.started_at
+        if self.generate_started_at is not None:
+            phases.append(("tokenize", self.started_at, self.generate_started_at))
+            prefill_start = self.generate_started_at
+        if self.first_token_at is not None:
+            phases.append(("prefill", prefill_start, self.first_token_at))
+            phases.append(("decode", self.first_token_at, self.last_token_at))
+        return phases
+    
+    def decode_tokens_per_second(self) -> Optional[float]:
+        """Tokens/s over the decode phase (excludes prefill), if measurable."""
+        if self.tokens < 2 or self.last_token_at <= self.first_token_at:
+            return None
+        return (self.tokens - 1) / (self.last_token_at - self.first_token_at)
+
+
+class SequenceScorer:
+    """
+    Logits processor that accumulates each sampled sequence's log-probability.
+
+    Custom logits processors run before the temperature/top-p warpers, so this
+    sees the model's own next-token distribution. The token sampled from it is
+    only known at the next step, so each call scores the previous step's token
+    and `finish` scores the last one. Only one step of log-probs is kept.
+    """
+
+    def __init__(self, eos_token_id: Optional[int]):
+        self.eos_token_id = eos_token_id
+        self.log_probs = None
+        self.lengths = None
+        self._finished = None
+        self._step_log_probs = None
+
+    def __call__(self, input_ids, scores):
+        import torch
+        if self._step_log_probs is not None:
+            self._accumulate(input_ids[:, -1])
+        self._step_log_probs = torch.log_softmax(scores.float(), dim=-1)
+        return scores
+
+    def _accumulate(self, tokens):
+        import torch
+        if self.log_probs is None:
+            self.log_probs = torch.zeros(tokens.shape[0], device=tokens.device)
+            self.lengths = torch.zeros(tokens.shape[0], device=tokens.device)
+            self._finished = torch.zeros(tokens.shape[0], dtype=torch.bool, device=tokens.device)
+        token_log_probs = self._step_log_probs.gather(1, tokens[:, None]).squeeze(1)
+        # Rows that already emitted EOS are only padding from here on
+        active = ~self._finished
+        self.log_probs += torch.where(active, token_log_probs, torch.zeros_like(token_log_probs))
+        self.lengths += active.float()
+        if self.eos_token_id is not None:
+            self._finished |= tokens == self.eos_token_id
+        self._step_log_probs = None
+
+    def finish(self, sequences) -> List[float]:
+        """Score the final step and return the mean log-probability per token of each row."""
+        if self._step_log_probs is not None:
+            self._accumulate(sequences[:, -1])
+        if self.log_probs is None:
+            return [0.0] * sequences.shape[0]
+        return (self.log_probs / self.lengths.clamp(min=1)).tolist()
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    """A generation's estimated memory does not fit the memory budget."""
+    
+    def __init__(self, required: int, available: int):
+        super().__init__(f"Generation needs ~{required / 1024 ** 2:.1f} MiB of KV cache, "
+                         f"{max(available, 0) / 1024 ** 2:.1f} MiB of the memory budget is free")
+        self.required = required
+        self.available = available
+
+
+def weight_nbytes(model) -> int:
+    """Bytes held by a model's parameters and buffers, including dynamically quantized Linear weights."""
+    total = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    for module in model.modules():
+        if hasattr(module, '_weight_bias'):
+            # torch.ao dynamic quantization keeps the int8 weights in packed params, not parameters
+            total += sum(t.numel() * t.element_size() for t in module._weight_bias() if t is not None)
+    return total
+
+
+def static_cache_len(prompt_tokens: int, max_new_tokens: int) -> int:
+    """
+    Static KV cache length for a generation: the smallest length tier covering max_new_tokens
+    plus the prompt rounded up to STATIC_PROMPT_BUCKET. The compiled decode step is specialized
+    to the cache length, so this keeps the number of compiled shapes small.
+    """
+    budget = next((t for t in sorted(LENGTH_TO_TOKENS.values()) if t >= max_new_tokens), max_new_tokens)
+    return budget + STATIC_PROMPT_BUCKET * max(1, -(-prompt_tokens // STATIC_PROMPT_BUCKET))
+
+
+def parse_adapters(spec: str) -> Dict[str, str]:
+    """Parse 'romance=path/to/lora,customer-42=user/lora-repo' into adapter name -> path."""
+    adapters = {}
+    for part in spec.split(','):
+        if part.strip():
+            name, path = part.split('=', 1)
+            adapters[name.strip()] = path.strip()
+    return adapters
+
+
+def trim_to_sentence(text: str) -> str:
+    """Cut text back to its last complete sentence (unchanged if there is none)."""
+    last_end = None
+    for match in SENTENCE_END.finditer(text):
+        last_end = match.end()
+    if last_end is None:
+        return text
+    return text[:last_end]
+
+
 class ModelIntegrationPipeline:
     def __init__(self, model_name: str = "UnfilteredAI/NSFW-3B", use_mock: bool = False, use_pipeline: bool = True, **kwargs):
         """
@@ -15,6 +194,27 @@ class ModelIntegrationPipeline:
             model_name: Name of the Hugging Face model to use. Default is "UnfilteredAI/NSFW-3B".
             use_mock: If True, will use mock responses instead of loading the model.
             use_pipeline: If True, will use Hugging Face pipeline (recommended for pro accounts).
+            kv_cache_bits: Store the KV cache in 8 or 4 bits (see kv_quant); defaults to the
+                           KV_CACHE_BITS environment variable, unset means full precision.
+            pipeline_stages: Split the layers across this many pinned worker processes
+                             (see pipeline_parallel); defaults to PIPELINE_STAGES, 1 means off.
+            adapters: LoRA adapters to attach, as {name: path} or 'name=path,...'; defaults to
+                      LORA_ADAPTERS. An adapter named after a genre is used for that genre.
+            torch_dtype: 'float16', 'bfloat16', 'float32' or 'auto' (float16 on GPU, float32 on CPU).
+            quantization: 'int8' for 8-bit weights (bitsandbytes on GPU, dynamic int8 on CPU).
+            use_cache: Reuse the KV cache while decoding (default True).
+            num_threads: torch CPU threads (process-wide); overrides the tuned count.
+            cpu_tuning_file: Thread counts and core affinity found by cpu_autotune.py, applied when the
+                             model loads on CPU; defaults to CPU_TUNING_FILE or cpu_tuning.json,
+                             None disables it.
+            profile: Name of the optimization profile these settings came from, for reporting.
+            memory_budget_mb: Memory for weights, adapters, KV caches and registered caches; a generation
+                              that would exceed it waits, then is refused (MemoryBudgetExceeded).
+                              Defaults to MEMORY_BUDGET_MB; unset means accounting only.
+            memory_wait: Seconds a generation waits for memory before it is refused (MEMORY_WAIT_SECONDS).
+            compiled_decode: Decode single stories with torch.compile over preallocated static KV caches,
+                             one shape per length tier, compiled at load (COMPILED_DECODE).
+            compile_cache_dir: Where compiled kernels are kept across restarts (COMPILE_CACHE_DIR).
         """
         self.model_name = model_name
         self.model = None
@@ -24,6 +224,60 @@ class ModelIntegrationPipeline:
         self.use_pipeline = use_pipeline
         self.device = kwargs.get('device', 'auto')
         self.torch_dtype = kwargs.get('torch_dtype', 'auto')
+        self.quantization = kwargs.get('quantization')
+        self.use_cache = kwargs.get('use_cache', True)
+        self.num_threads = kwargs.get('num_threads')
+        self.profile = kwargs.get('profile')
+        self.cpu_tuning_file = kwargs.get('cpu_tuning_file', os.environ.get('CPU_TUNING_FILE', 'cpu_tuning.json'))
+        self.cpu_tuning = None
+        
+        # Live decode speed (exponential moving average), used to size deadline-bound requests
+        self.tokens_per_second = None
+        # Time of the latest forward pass, i.e. decode step (see inference_daemon's worker watchdog)
+        self.last_step_at = None
+        self.deadline_safety = kwargs.get('deadline_safety', 0.9)
+        
+        # Optional quantized KV cache, so more concurrent generations fit in memory
+        kv_cache_bits = kwargs.get('kv_cache_bits', os.environ.get('KV_CACHE_BITS'))
+        self.kv_cache_bits = int(kv_cache_bits) if kv_cache_bits else None
+        
+        # Optional pipeline-parallel sharding across local processes (one per NUMA node)
+        self.pipeline_stages = int(kwargs.get('pipeline_stages', os.environ.get('PIPELINE_STAGES', 1)))
+        self.sharded = None
+        
+        # Optional LoRA adapters on the one resident base model (needs peft), name -> {"path", "bytes"}
+        adapters = kwargs.get('adapters', os.environ.get('LORA_ADAPTERS'))
+        if isinstance(adapters, str):
+            adapters = parse_adapters(adapters)
+        self.adapters: Dict[str, Dict[str, Any]] = {}
+        # peft injects adapter_names through module hooks, so adapter generations don't overlap
+        self.adapter_lock = threading.RLock()
+        
+        # Memory accounting: weights, adapters, the estimated KV cache of every generation in flight
+        # (prompt tokens + max_new_tokens) and caches registered with register_cache()
+        budget = kwargs.get('memory_budget_mb', os.environ.get('MEMORY_BUDGET_MB'))
+        self.memory_budget = int(float(budget) * 1024 ** 2) if budget else None
+        self.memory_wait = float(kwargs.get('memory_wait', os.environ.get('MEMORY_WAIT_SECONDS', 30)))
+        self.weight_bytes = 0
+        self.kv_bytes_per_token = None
+        self.kv_reservations: Dict[int, int] = {}
+        self.caches: Dict[str, Callable[[], int]] = {}
+        self.memory_lock = threading.Condition()
+        self.memory_stats = {"delayed": 0, "refused": 0, "peak_kv_bytes": 0}
+        
+        # Optional compiled decode over pooled static KV caches (cache length -> idle caches)
+        compiled = kwargs.get('compiled_decode', os.environ.get('COMPILED_DECODE', ''))
+        self.compiled_decode = str(compiled).lower() in ('1', 'true', 'yes')
+        self.compile_cache_dir = kwargs.get('compile_cache_dir', os.environ.get('COMPILE_CACHE_DIR', 'compile_cache'))
+        if self.compiled_decode and (self.kv_cache_bits or self.quantization):
+            print("⚠️ Compiled decode needs float weights and a full-precision KV cache; decoding eagerly")
+            self.compiled_decode = False
+        self.static_caches: Dict[int, List[Any]] = {}
+        self.static_cache_lock = threading.Lock()
+        self.compile_config = None
+        self.compile_stats = {"compiled_generations": 0, "caches_allocated": 0, "warmup_seconds": None}
+        if self.compiled_decode:
+            self.register_cache('static_kv', self._idle_static_cache_bytes)
         
         # Auto-detect GPU availability for Spaces
         if self.device == 'auto':
@@ -42,15 +296,40 @@ class ModelIntegrationPipeline:
         # If not in mock mode, try to load the model
         if not self.mock_mode:
             try:
-                if self.use_pipeline:
+                if self.device == 'cpu' and self.cpu_tuning_file and self.pipeline_stages == 1:
+                    # Pipeline stages pin themselves, one NUMA node each
+                    from cpu_autotune import load_tuning, apply_tuning
+                    self.cpu_tuning = load_tuning(self.cpu_tuning_file)
+                    if self.cpu_tuning:
+                        apply_tuning(self.cpu_tuning, self.num_threads)
+                        print(f"⚙️ CPU tuning: {self.cpu_tuning['num_threads']} threads on "
+                              f"{len(self.cpu_tuning['cpus'])} CPUs ({self.cpu_tuning['affinity']})")
+                if self.num_threads:
+                    import torch
+                    torch.set_num_threads(int(self.num_threads))
+                if self.pipeline_stages > 1:
+                    self._load_sharded()
+                elif self.use_pipeline:
                     self._load_pipeline()
+                    self._apply_runtime_settings()
+                    self._measure_memory()
                 else:
                     self._load_model()
+                    self._apply_runtime_settings()
+                    self._measure_memory()
+                if self.compiled_decode and not self.sharded:
+                    self._warm_up_compiled()
                 print(f"✅ Model loaded successfully on {self.device}")
             except Exception as e:
                 print(f"❌ Error loading model: {e}")
                 print("🔄 Falling back to mock mode")
                 self.mock_mode = True
+        
+        for name, path in (adapters or {}).items():
+            try:
+                self.load_adapter(name, path)
+            except Exception as e:
+                print(f"❌ Error loading adapter {name}: {e}")
     
     def _load_pipeline(self):
         """
@@ -68,10 +347,11 @@ class ModelIntegrationPipeline:
             self.pipeline = pipeline(
                 "text-generation",
                 model=self.model_name,
-                torch_dtype=torch.float16,  # Use half-precision for memory efficiency
+                torch_dtype=self._resolve_dtype(),  # Half precision on GPU unless configured otherwise
                 device_map="auto",  # Automatically distribute across available GPUs
                 trust_remote_code=True,  # Allow custom model code if needed
-                return_full_text=False  # Only return generated text, not the prompt
+                return_full_text=False,  # Only return generated text, not the prompt
+                model_kwargs=self._quantization_kwargs()
             )
             
             print(f"Successfully loaded {self.model_name} with pipeline")
@@ -95,8 +375,9 @@ class ModelIntegrationPipeline:
             self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
             self.model = AutoModelForCausalLM.from_pretrained(
                 self.model_name,
-                torch_dtype=torch.float16,  # Use half-precision to reduce memory usage
-                device_map="auto"  # Automatically determine the best device configuration
+                torch_dtype=self._resolve_dtype(),  # Half precision on GPU unless configured otherwise
+                device_map="auto",  # Automatically determine the best device configuration
+                **self._quantization_kwargs()
             )
             
             print(f"Successfully loaded {self.model_name}")
@@ -104,7 +385,221 @@ class ModelIntegrationPipeline:
             raise Exception(f"Failed to load model: {str(e)}")
 
     
-    def generate_story(self, prompt: str, genre: str, length: str, temperature: float = 0.7) -> str:
+    def _resolve_dtype(self):
+        """The torch dtype to load with: torch_dtype if set, else float16 on GPU and float32 on CPU."""
+        import torch
+        if self.torch_dtype in (None, 'auto'):
+            return torch.float16 if self.device == 'cuda' else torch.float32
+        if isinstance(self.torch_dtype, str):
+            return getattr(torch, self.torch_dtype)
+        return self.torch_dtype
+    
+    def _quantization_kwargs(self) -> Dict[str, Any]:
+        """from_pretrained kwargs for quantized loading (GPU int8 goes through bitsandbytes)."""
+        if self.quantization is None:
+            return {}
+        if self.quantization != 'int8':
+            raise ValueError(f"Unsupported quantization: {self.quantization}")
+        if self.device != 'cuda':
+            return {}  # Quantized after loading, see _apply_runtime_settings
+        from transformers import BitsAndBytesConfig
+        return {"quantization_config": BitsAndBytesConfig(load_in_8bit=True)}
+    
+    def _apply_runtime_settings(self):
+        """CPU int8 quantization and the default use_cache, applied to the freshly loaded model."""
+        import torch
+        model, _ = self._get_model_and_tokenizer()
+        if self.quantization == 'int8' and self.device != 'cuda':
+            from torch.ao.quantization import quantize_dynamic
+            # In place, so the float weights of the Linear layers are freed rather than copied
+            quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        model.generation_config.use_cache = self.use_cache
+        # Kept out of compiled graphs: a traced time.time() would be a guard that fails on every step
+        model.register_forward_pre_hook(torch.compiler.disable(self._mark_step))
+    
+    def _mark_step(self, module, args):
+        self.last_step_at = time.time()
+    
+    def _measure_memory(self):
+        """Weight bytes and KV cache bytes per token of the loaded model, for memory accounting."""
+        from kv_quant import kv_bytes_per_token
+        model, _ = self._get_model_and_tokenizer()
+        self.weight_bytes = weight_nbytes(model)
+        try:
+            self.kv_bytes_per_token = kv_bytes_per_token(model.config, self.kv_cache_bits,
+                                                         dtype_bytes=model.dtype.itemsize)
+        except AttributeError:
+            self.kv_bytes_per_token = None  # Config without the usual attention geometry; KV isn't estimated
+    
+    def _compile_settings(self):
+        """The CompileConfig generate uses for the decode step (prefill stays eager)."""
+        if self.compile_config is None:
+            from transformers import CompileConfig
+            # CUDA graphs on GPU; on CPU the decode step is compiled with inductor alone
+            config = CompileConfig(fullgraph=False, dynamic=False,
+                                   mode="reduce-overhead" if self.device == 'cuda' else "default")
+            config._compile_all_devices = True  # generate only compiles automatically on GPUs otherwise
+            self.compile_config = config
+        return self.compile_config
+    
+    @contextlib.contextmanager
+    def _decode_kwargs(self, model, prompt_tokens: int, max_new_tokens: int, adapter: Optional[str] = None):
+        """
+        `generate` kwargs for one sequence: a pooled static KV cache and the compile config
+        with compiled_decode, else those of _new_cache_kwargs. The cache returns to the pool on exit.
+        """
+        if not self.compiled_decode or adapter is not None:
+            # peft's per-row adapter hooks aren't worth a graph of their own
+            yield self._new_cache_kwargs(model)
+            return
+        from transformers import StaticCache
+        length = static_cache_len(prompt_tokens, max_new_tokens)
+        with self.static_cache_lock:
+            pool = self.static_caches.setdefault(length, [])
+            cache = pool.pop() if pool else None
+        if cache is None:
+            cache = StaticCache(config=model.config, max_cache_len=length)
+            self.compile_stats["caches_allocated"] += 1
+        else:
+            cache.reset()
+        try:
+            yield {"past_key_values": cache, "compile_config": self._compile_settings()}
+            self.compile_stats["compiled_generations"] += 1
+        finally:
+            with self.static_cache_lock:
+                pool.append(cache)
+    
+    def _idle_static_cache_bytes(self) -> int:
+        """Pooled static caches not in use (those in use are counted by their generation's reservation)."""
+        with self.static_cache_lock:
+            return sum(tensor.numel() * tensor.element_size()
+                       for pool in self.static_caches.values() for cache in pool for layer in cache.layers
+                       for tensor in (getattr(layer, 'keys', None), getattr(layer, 'values', None))
+                       if tensor is not None)
+    
+    def _warm_up_compiled(self):
+        """Compile the decode step for every length tier before the first request, reusing cached kernels."""
+        import torch
+        # Inductor's on-disk cache (compiled graphs and kernels) survives restarts here
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(self.compile_cache_dir))
+        model, tokenizer = self._get_model_and_tokenizer()
+        system_prompt = self._build_system_prompt("Two strangers meet at a masquerade ball", "romance", "medium")
+        input_ids = tokenizer(system_prompt, return_tensors="pt")["input_ids"].to(model.device)
+        started_at = time.time()
+        for tokens in sorted(LENGTH_TO_TOKENS.values()):
+            # The graph depends only on the cache length, so a few tokens compile the tier's shape
+            with self._decode_kwargs(model, input_ids.shape[1], tokens) as cache_kwargs, torch.no_grad():
+                model.generate(input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=3,
+                               do_sample=False, pad_token_id=tokenizer.eos_token_id, **cache_kwargs)
+        self.compile_stats["compiled_generations"] = 0
+        self.compile_stats["warmup_seconds"] = time.time() - started_at
+        print(f"🔥 Compiled decode warmed up for {len(LENGTH_TO_TOKENS)} length tiers in "
+              f"{self.compile_stats['warmup_seconds']:.1f}s")
+    
+    def register_cache(self, name: str, size: Callable[[], int]):
+        """Count a cache held elsewhere in the process (e.g. session KV caches) in the memory totals."""
+        self.caches[name] = size
+    
+    def estimate_kv_bytes(self, prompt_tokens: int, max_new_tokens: int, rows: int = 1) -> int:
+        """KV cache memory of a generation of `rows` sequences (0 when the model isn't measured)."""
+        if not self.kv_bytes_per_token:
+            return 0
+        return int(self.kv_bytes_per_token * (prompt_tokens + max_new_tokens) * rows)
+    
+    def _committed_bytes(self) -> int:
+        adapters = sum(info["bytes"] for info in self.adapters.values())
+        caches = sum(size() for size in self.caches.values())
+        return self.weight_bytes + adapters + caches + sum(self.kv_reservations.values())
+    
+    @contextlib.contextmanager
+    def _reserve_memory(self, prompts: List[str], max_new_tokens: int, copies: int = 1):
+        """
+        Hold the estimated KV memory of a generation over `prompts` (each decoded `copies` times)
+        while it runs. Past the memory budget, wait up to memory_wait seconds for other
+        generations to finish, then raise MemoryBudgetExceeded.
+        """
+        needed = 0
+        if self.kv_bytes_per_token:
+            _, tokenizer = self._get_model_and_tokenizer()
+            # Batches are padded to their longest prompt
+            prompt_tokens = max(len(tokenizer(text)["input_ids"]) for text in prompts)
+            needed = self.estimate_kv_bytes(prompt_tokens, max_new_tokens, len(prompts) * copies)
+        key = object()
+        with self.memory_lock:
+            if self.memory_budget is not None and needed:
+                deadline = time.time() + self.memory_wait
+                delayed = False
+                while self._committed_bytes() + needed > self.memory_budget:
+                    remaining = deadline - time.time()
+                    # With nothing else in flight, waiting can't free any memory
+                    if not self.kv_reservations or remaining <= 0:
+                        self.memory_stats["refused"] += 1
+                        raise MemoryBudgetExceeded(needed, self.memory_budget - self._committed_bytes())
+                    if not delayed:
+                        self.memory_stats["delayed"] += 1
+                        delayed = True
+                    self.memory_lock.wait(remaining)
+            self.kv_reservations[id(key)] = needed
+            self.memory_stats["peak_kv_bytes"] = max(self.memory_stats["peak_kv_bytes"],
+                                                     sum(self.kv_reservations.values()))
+        try:
+            yield
+        finally:
+            with self.memory_lock:
+                del self.kv_reservations[id(key)]
+                self.memory_lock.notify_all()
+    
+    def get_memory_info(self) -> Dict[str, Any]:
+        """Accounted memory in bytes, plus the process RSS for comparison."""
+        with self.memory_lock:
+            caches = {name: size() for name, size in self.caches.items()}
+            kv_active = sum(self.kv_reservations.values())
+            active = len(self.kv_reservations)
+            committed = self._committed_bytes()
+        info = {
+            "weights_bytes": self.weight_bytes,
+            "adapters_bytes": sum(a["bytes"] for a in self.adapters.values()),
+            "kv_bytes_per_token": self.kv_bytes_per_token,
+            "kv_active_bytes": kv_active,
+            "active_generations": active,
+            "caches_bytes": caches,
+            "total_bytes": committed,
+            "budget_bytes": self.memory_budget,
+            "available_bytes": self.memory_budget - committed if self.memory_budget is not None else None,
+            **self.memory_stats
+        }
+        try:
+            import psutil
+            info["process_rss_bytes"] = psutil.Process().memory_info().rss
+        except ImportError:
+            pass
+        return info
+    
+    def _load_sharded(self):
+        """Load the model split across pipeline_stages worker processes."""
+        from transformers import AutoTokenizer
+        from pipeline_parallel import PipelineParallelModel, in_stage_process
+        
+        if in_stage_process():
+            raise RuntimeError("Not loading a model inside a pipeline stage process")
+        print(f"Loading model {self.model_name} across {self.pipeline_stages} pipeline stages...")
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, trust_remote_code=True)
+        self.sharded = PipelineParallelModel(self.model_name, stages=self.pipeline_stages)
+    
+    def _generate_sharded(self, prompts: List[str], max_new_tokens: int, temperature: float, top_p: float,
+                          monitors: Optional[List[GenerationMonitor]] = None) -> List[Dict[str, Any]]:
+        """Generate from already-built prompts on the sharded model, all prompts in flight at once."""
+        prompt_ids = [self.tokenizer(p)["input_ids"] for p in prompts]
+        outputs = self.sharded.generate(prompt_ids, max_new_tokens, temperature, top_p,
+                                        eos_token_id=self.tokenizer.eos_token_id, stopping=monitors)
+        return [
+            {"text": self.tokenizer.decode(o["tokens"], skip_special_tokens=True).strip(), "tokens": len(o["tokens"])}
+            for o in outputs
+        ]
+    
+    def generate_story(self, prompt: str, genre: str, length: str, temperature: float = 0.7,
+                       top_p: float = 0.9, max_tokens: Optional[int] = None,
+                       deadline: Optional[float] = None) -> str:
         """
         Generate a story based on the given parameters.
         
@@ -113,45 +608,167 @@ class ModelIntegrationPipeline:
             genre: The genre of the story
             length: The desired length (short, medium, long)
             temperature: Creativity parameter (0.0 to 1.0)
+            top_p: Nucleus sampling parameter (0.0 to 1.0)
+            max_tokens: Optional explicit cap on new tokens (defaults to the length bucket)
+            deadline: Optional absolute time (time.time()) by which the story must be returned
             
         Returns:
             The generated story text
         """
+        return self.generate_story_detailed(
+            prompt, genre, length, temperature,
+            top_p=top_p, max_tokens=max_tokens, deadline=deadline
+        )["story"]
+    
+    def generate_story_detailed(self, prompt: str, genre: str, length: str, temperature: float = 0.7,
+                                top_p: float = 0.9, max_tokens: Optional[int] = None,
+                                deadline: Optional[float] = None, adapter: Optional[str] = None,
+                                stop_when: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+        """
+        Generate a story and report how the generation went.
+        
+        When a deadline is given, `max_new_tokens` is capped to what the live
+        decode speed can produce before it, and generation stops at the deadline.
+        A story cut short this way is trimmed back to a sentence boundary and
+        flagged with `truncated: True` instead of failing.
+        
+        `adapter` picks a loaded LoRA adapter (BASE_ADAPTER for none); by default
+        the genre's adapter is used if one is loaded.
+        
+        `stop_when` is polled every token; once it returns True the generation is
+        abandoned and the partial story comes back flagged as truncated.
+        
+        Returns:
+            Dict with `story`, `truncated`, `tokens_generated`, `max_new_tokens`, `elapsed`
+            and `adapter` (None when no adapters are loaded)
+        """
+        start_time = time.time()
+        budget = max_tokens or LENGTH_TO_TOKENS.get(length, 1024)
+        max_new_tokens = self._plan_max_new_tokens(budget, deadline)
+        adapter = self._resolve_adapter(genre, adapter)
+        
         if self.mock_mode:
-            return self._generate_mock_story(prompt, genre, length)
-        elif self.use_pipeline and self.pipeline:
-            return self._generate_with_pipeline(prompt, genre, length, temperature)
+            story = self._generate_mock_story(prompt, genre, length)
+            return {
+                "story": story,
+                "truncated": False,
+                "tokens_generated": len(story.split()),
+                "max_new_tokens": max_new_tokens,
+                "elapsed": time.time() - start_time,
+                "adapter": adapter
+            }
+        
+        if max_new_tokens <= 0:
+            # The deadline has already passed; don't start a generation nobody will read
+            return {
+                "story": "",
+                "truncated": True,
+                "tokens_generated": 0,
+                "max_new_tokens": 0,
+                "elapsed": time.time() - start_time,
+                "adapter": adapter
+            }
+        
+        monitor = GenerationMonitor(deadline, stop_when)
+        with self._reserve_memory([self._build_system_prompt(prompt, genre, length)], max_new_tokens), \
+                profiler.profile('generate_story', self._expected_seconds(max_new_tokens), genre=genre,
+                                 length=length, max_new_tokens=max_new_tokens, prompt_chars=len(prompt),
+                                 adapter=adapter):
+            if self.sharded:
+                system_prompt = self._build_system_prompt(prompt, genre, length)
+                story = self._generate_sharded([system_prompt], max_new_tokens, temperature, top_p,
+                                               [monitor])[0]["text"]
+            elif self.use_pipeline and self.pipeline:
+                story = self._generate_with_pipeline(prompt, genre, length, temperature, top_p, max_new_tokens,
+                                                     monitor, adapter)
+            else:
+                story = self._generate_with_model(prompt, genre, length, temperature, top_p, max_new_tokens,
+                                                  monitor, adapter)
+        
+        self._record_decode_speed(monitor)
+        for name, phase_start, phase_end in monitor.phases():
+            record_span(name, phase_start, phase_end, tokens=monitor.tokens)
+        
+        # Cut short by the deadline itself, the deadline-derived token cap or stop_when
+        truncated = (monitor.timed_out or monitor.cancelled
+                     or (max_new_tokens < budget and monitor.tokens >= max_new_tokens))
+        if truncated:
+            story = trim_to_sentence(story)
+        
+        return {
+            "story": story,
+            "truncated": truncated,
+            "tokens_generated": monitor.tokens,
+            "max_new_tokens": max_new_tokens,
+            "elapsed": time.time() - start_time,
+            "adapter": adapter
+        }
+    
+    def _plan_max_new_tokens(self, budget: int, deadline: Optional[float]) -> int:
+        """
+        Cap the token budget to what fits before the deadline at the measured decode speed.
+        Without a speed measurement yet, the full budget is used and the deadline is
+        enforced by the stopping criterion alone.
+        """
+        if deadline is None:
+            return budget
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return 0
+        if not self.tokens_per_second:
+            return budget
+        affordable = int(self.tokens_per_second * remaining * self.deadline_safety)
+        return max(1, min(budget, affordable))
+    
+    def _expected_seconds(self, max_new_tokens: int) -> Optional[float]:
+        """Decode time of max_new_tokens at the live speed, if measured (the slow-request profiler's baseline)."""
+        return max_new_tokens / self.tokens_per_second if self.tokens_per_second else None
+    
+    def _record_decode_speed(self, monitor: GenerationMonitor):
+        """Fold the decode speed of a finished generation into the moving average."""
+        rate = monitor.decode_tokens_per_second()
+        if rate is None:
+            return
+        if self.tokens_per_second is None:
+            self.tokens_per_second = rate
         else:
-            return self._generate_with_model(prompt, genre, length, temperature)
+            self.tokens_per_second = 0.7 * self.tokens_per_second + 0.3 * rate
+    
+    def _build_system_prompt(self, prompt: str, genre: str, length: str) -> str:
+        """Create a system prompt that guides the model"""
+        system_prompt = f"You are an expert writer of {genre} NSFW stories. "
+        system_prompt += f"Write a {length} story based on the following prompt: {prompt}\n\n"
+        return system_prompt
     
-    def _generate_with_pipeline(self, prompt: str, genre: str, length: str, temperature: float) -> str:
+    def _generate_with_pipeline(self, prompt: str, genre: str, length: str, temperature: float,
+                                top_p: float, max_new_tokens: int, monitor: GenerationMonitor,
+                                adapter: Optional[str] = None) -> str:
         """
         Generate a story using the Hugging Face Pipeline (recommended approach).
         This is more efficient and handles many optimizations automatically.
         """
-        # Map length to approximate token counts
-        length_to_tokens = {
-            "short": 512,
-            "medium": 1024,
-            "long": 2048
-        }
-        max_tokens = length_to_tokens.get(length, 1024)
+        from transformers import StoppingCriteriaList
         
-        # Create a system prompt that guides the model
-        system_prompt = f"You are an expert writer of {genre} NSFW stories. "
-        system_prompt += f"Write a {length} story based on the following prompt: {prompt}\n\n"
+        system_prompt = self._build_system_prompt(prompt, genre, length)
+        prompt_tokens = len(self.pipeline.tokenizer(system_prompt)["input_ids"])
+        monitor.generate_started_at = time.time()
         
         try:
             # Generate using pipeline - much simpler than manual approach
-            outputs = self.pipeline(
-                system_prompt,
-                max_new_tokens=max_tokens,
-                temperature=temperature,
-                top_p=0.9,
-                do_sample=True,
-                pad_token_id=self.pipeline.tokenizer.eos_token_id,
-                eos_token_id=self.pipeline.tokenizer.eos_token_id
-            )
+            with self._adapter_guard(), \
+                    self._decode_kwargs(self.pipeline.model, prompt_tokens, max_new_tokens, adapter) as cache_kwargs:
+                outputs = self.pipeline(
+                    system_prompt,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    do_sample=True,
+                    pad_token_id=self.pipeline.tokenizer.eos_token_id,
+                    eos_token_id=self.pipeline.tokenizer.eos_token_id,
+                    stopping_criteria=StoppingCriteriaList([monitor]),
+                    **self._adapter_kwargs([adapter]),
+                    **cache_kwargs
+                )
             
             # Extract the generated text
             if isinstance(outputs, list) and len(outputs) > 0:
@@ -166,37 +783,35 @@ class ModelIntegrationPipeline:
             # Fallback to mock story
             return self._generate_mock_story(prompt, genre, length)
     
-    def _generate_with_model(self, prompt: str, genre: str, length: str, temperature: float) -> str:
+    def _generate_with_model(self, prompt: str, genre: str, length: str, temperature: float,
+                             top_p: float, max_new_tokens: int, monitor: GenerationMonitor,
+                             adapter: Optional[str] = None) -> str:
         """
         Generate a story using the traditional Hugging Face Transformers model approach.
         This is the fallback method if pipeline doesn't work.
         """
         import torch
+        from transformers import StoppingCriteriaList
         
-        # Map length to approximate token counts
-        length_to_tokens = {
-            "short": 512,
-            "medium": 1024,
-            "long": 2048
-        }
-        max_tokens = length_to_tokens.get(length, 1024)
-        
-        # Create a system prompt that guides the model
-        system_prompt = f"You are an expert writer of {genre} NSFW stories. "
-        system_prompt += f"Write a {length} story based on the following prompt: {prompt}\n\n"
+        system_prompt = self._build_system_prompt(prompt, genre, length)
         
         # Tokenize the input
         inputs = self.tokenizer(system_prompt, return_tensors="pt").to(self.model.device)
+        monitor.generate_started_at = time.time()
         
         # Generate the story
-        with torch.no_grad():
+        with torch.no_grad(), self._adapter_guard(), \
+                self._decode_kwargs(self.model, inputs["input_ids"].shape[1], max_new_tokens, adapter) as cache_kwargs:
             outputs = self.model.generate(
                 inputs["input_ids"],
-                max_new_tokens=max_tokens,
+                max_new_tokens=max_new_tokens,
                 temperature=temperature,
-                top_p=0.9,
+                top_p=top_p,
                 do_sample=True,
-                pad_token_id=self.tokenizer.eos_token_id
+                pad_token_id=self.tokenizer.eos_token_id,
+                stopping_criteria=StoppingCriteriaList([monitor]),
+                **self._adapter_kwargs([adapter]),
+                **cache_kwargs
             )
         
         # Decode the generated text
@@ -207,6 +822,514 @@ class ModelIntegrationPipeline:
         
         return story
     
+    def generate_stories(self, requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Generate several stories with batched forward passes.
+        
+        Requests that share a length bucket and sampling settings are generated
+        together in a single left-padded `generate` call, even when they use
+        different LoRA adapters: each row runs through its own adapter.
+        
+        Args:
+            requests: Dicts with `prompt` and optional `genre`, `length`, `temperature`, `top_p`, `adapter`
+            
+        Returns:
+            One result per request, in order, with `story`, `truncated`, `tokens_generated`,
+            `max_new_tokens`, `elapsed` (of the batch it ran in) and `adapter`
+        """
+        if self.mock_mode:
+            return [
+                self.generate_story_detailed(r['prompt'], r.get('genre', 'romance'),
+                                             r.get('length', 'medium'), r.get('temperature', 0.7),
+                                             adapter=r.get('adapter'))
+                for r in requests
+            ]
+        
+        groups = {}
+        for i, r in enumerate(requests):
+            key = (r.get('length', 'medium'), r.get('temperature', 0.7), r.get('top_p', 0.9))
+            groups.setdefault(key, []).append(i)
+        
+        results = [None] * len(requests)
+        for (length, temperature, top_p), indices in groups.items():
+            prompts = [
+                self._build_system_prompt(requests[i]['prompt'], requests[i].get('genre', 'romance'), length)
+                for i in indices
+            ]
+            adapters = [self._resolve_adapter(requests[i].get('genre', 'romance'), requests[i].get('adapter'))
+                        for i in indices]
+            with self._reserve_memory(prompts, LENGTH_TO_TOKENS.get(length, 1024)):
+                batch = self._generate_batch(prompts, LENGTH_TO_TOKENS.get(length, 1024), temperature, top_p,
+                                             adapters)
+            for i, result in zip(indices, batch):
+                results[i] = result
+        return results
+    
+    def _generate_batch(self, prompts: List[str], max_new_tokens: int, temperature: float,
+                        top_p: float, adapters: Optional[List[Optional[str]]] = None) -> List[Dict[str, Any]]:
+        """Run one batched `generate` call over already-built system prompts, one adapter per row."""
+        import torch
+        
+        start_time = time.time()
+        if self.sharded:
+            # Each prompt becomes its own micro-batch in the stage pipeline
+            outputs = self._generate_sharded(prompts, max_new_tokens, temperature, top_p)
+            return [
+                {"story": o["text"], "truncated": False, "tokens_generated": o["tokens"],
+                 "max_new_tokens": max_new_tokens, "elapsed": time.time() - start_time}
+                for o in outputs
+            ]
+        
+        model, tokenizer = self._get_model_and_tokenizer()
+        
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        # Decoder-only models must be padded on the left so each row continues its own prompt
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = 'left'
+        try:
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+        finally:
+            tokenizer.padding_side = padding_side
+        
+        adapters = adapters or [None] * len(prompts)
+        with torch.no_grad(), self._adapter_guard():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                do_sample=True,
+                pad_token_id=tokenizer.pad_token_id,
+                **self._adapter_kwargs(adapters),
+                **self._new_cache_kwargs(model)
+            )
+        
+        elapsed = time.time() - start_time
+        results = []
+        for row, adapter in zip(outputs[:, inputs["input_ids"].shape[1]:], adapters):
+            # Finished rows are padded after their EOS token
+            eos_positions = (row == tokenizer.eos_token_id).nonzero()
+            tokens = int(eos_positions[0]) + 1 if len(eos_positions) else len(row)
+            results.append({
+                "story": tokenizer.decode(row[:tokens], skip_special_tokens=True).strip(),
+                "truncated": False,
+                "tokens_generated": tokens,
+                "max_new_tokens": max_new_tokens,
+                "elapsed": elapsed,
+                "adapter": adapter
+            })
+        return results
+    
+    def generate_candidates(self, prompt: str, genre: str, length: str, n: int = 3,
+                            temperature: float = 0.7, top_p: float = 0.9,
+                            max_tokens: Optional[int] = None, deadline: Optional[float] = None,
+                            adapter: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Sample `n` candidate stories for one prompt in a single batched `generate` call.
+        
+        The prompt is prefilled once and its KV cache is repeated for every
+        candidate, so only decoding is paid per candidate. Candidates are ranked
+        by the model's mean log-probability per generated token.
+        
+        Returns:
+            `n` results, best first, each with `story`, `score`, `truncated`,
+            `tokens_generated`, `max_new_tokens` and `elapsed` (of the whole call)
+        """
+        import torch
+        from transformers import LogitsProcessorList, StoppingCriteriaList
+        
+        start_time = time.time()
+        budget = max_tokens or LENGTH_TO_TOKENS.get(length, 1024)
+        max_new_tokens = self._plan_max_new_tokens(budget, deadline)
+        
+        if self.mock_mode or max_new_tokens <= 0:
+            result = self.generate_story_detailed(prompt, genre, length, temperature, top_p=top_p,
+                                                  max_tokens=max_tokens, deadline=deadline, adapter=adapter)
+            return [dict(result, score=0.0) for _ in range(n)]
+        adapter = self._resolve_adapter(genre, adapter)
+        
+        model, tokenizer = self._get_model_and_tokenizer()
+        monitor = GenerationMonitor(deadline)
+        scorer = SequenceScorer(tokenizer.eos_token_id)
+        
+        system_prompt = self._build_system_prompt(prompt, genre, length)
+        input_ids = tokenizer(system_prompt, return_tensors="pt")["input_ids"].to(model.device)
+        monitor.generate_started_at = time.time()
+        
+        with self._reserve_memory([system_prompt], max_new_tokens, copies=n), \
+                profiler.profile('generate_candidates', self._expected_seconds(max_new_tokens), genre=genre,
+                                 length=length, max_new_tokens=max_new_tokens, prompt_chars=len(prompt), n=n,
+                                 adapter=adapter), torch.no_grad(), self._adapter_guard():
+            # Prefill everything but the last prompt token once; generate feeds that token itself
+            generate_kwargs = self._new_cache_kwargs(model)
+            if input_ids.shape[1] > 1:
+                cache = model(input_ids[:, :-1], use_cache=True, **self._adapter_kwargs([adapter]),
+                              **generate_kwargs).past_key_values
+                generate_kwargs = {}
+                if hasattr(cache, 'batch_repeat_interleave'):
+                    cache.batch_repeat_interleave(n)
+                    generate_kwargs["past_key_values"] = cache
+            batch_ids = input_ids.repeat(n, 1)
+            outputs = model.generate(
+                batch_ids,
+                attention_mask=torch.ones_like(batch_ids),
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                do_sample=True,
+                pad_token_id=tokenizer.eos_token_id,
+                use_cache=True,
+                logits_processor=LogitsProcessorList([scorer]),
+                stopping_criteria=StoppingCriteriaList([monitor]),
+                **self._adapter_kwargs([adapter] * n),
+                **generate_kwargs
+            )
+        
+        self._record_decode_speed(monitor)
+        for name, phase_start, phase_end in monitor.phases():
+            record_span(name, phase_start, phase_end, tokens=monitor.tokens, candidates=n)
+        
+        scores = scorer.finish(outputs)
+        truncated = monitor.timed_out or (max_new_tokens < budget and monitor.tokens >= max_new_tokens)
+        elapsed = time.time() - start_time
+        candidates = []
+        for row, score in zip(outputs[:, input_ids.shape[1]:], scores):
+            eos_positions = (row == tokenizer.eos_token_id).nonzero()
+            tokens = int(eos_positions[0]) + 1 if len(eos_positions) else len(row)
+            story = tokenizer.decode(row[:tokens], skip_special_tokens=True).strip()
+            # Rows that ended on their own are complete even if the batch ran out of time
+            row_truncated = truncated and not len(eos_positions)
+            candidates.append({
+                "story": trim_to_sentence(story) if row_truncated else story,
+                "score": score,
+                "truncated": row_truncated,
+                "tokens_generated": tokens,
+                "max_new_tokens": max_new_tokens,
+                "elapsed": elapsed,
+                "adapter": adapter
+            })
+        candidates.sort(key=lambda c: c['score'], reverse=True)
+        return candidates
+    
+    def generate_text(self, text: str, max_new_tokens: int, temperature: float = 0.7,
+                      top_p: float = 0.9, adapter: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Continue raw text, without the story system prompt (and through `adapter`, if given).
+        Used by callers that build their own prompts (e.g. novel_pipeline).
+        
+        Returns:
+            Dict with `text` (the continuation only), `tokens_generated` and `elapsed`
+        """
+        start_time = time.time()
+        
+        if self.mock_mode:
+            # Use the last line of the prompt as the mock story's prompt
+            lines = [line for line in text.strip().splitlines() if line.strip()]
+            story = self._generate_mock_story(lines[-1][:200] if lines else text, 'romance', 'medium')
+            return {
+                "text": story,
+                "tokens_generated": len(story.split()),
+                "elapsed": time.time() - start_time
+            }
+        
+        if self.sharded:
+            monitor = GenerationMonitor()
+            output = self._generate_sharded([text], max_new_tokens, temperature, top_p, [monitor])[0]
+            self._record_decode_speed(monitor)
+            return {"text": output["text"], "tokens_generated": output["tokens"], "elapsed": time.time() - start_time}
+        
+        import torch
+        from transformers import StoppingCriteriaList
+        
+        model, tokenizer = self._get_model_and_tokenizer()
+        adapter = self._resolve_adapter(None, adapter)
+        monitor = GenerationMonitor()
+        inputs = tokenizer(text, return_tensors="pt").to(model.device)
+        monitor.generate_started_at = time.time()
+        
+        with self._reserve_memory([text], max_new_tokens), torch.no_grad(), self._adapter_guard():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                do_sample=True,
+                pad_token_id=tokenizer.eos_token_id,
+                stopping_criteria=StoppingCriteriaList([monitor]),
+                **self._adapter_kwargs([adapter]),
+                **self._new_cache_kwargs(model)
+            )
+        
+        self._record_decode_speed(monitor)
+        for name, phase_start, phase_end in monitor.phases():
+            record_span(name, phase_start, phase_end, tokens=monitor.tokens)
+        
+        return {
+            "text": tokenizer.decode(outputs[0, inputs["input_ids"].shape[1]:], skip_special_tokens=True).strip(),
+            "tokens_generated": monitor.tokens,
+            "elapsed": time.time() - start_time
+        }
+    
+    def generate_story_stream(self, prompt: str, genre: str, length: str, temperature: float = 0.7,
+                              top_p: float = 0.9, max_tokens: Optional[int] = None,
+                              adapter: Optional[str] = None, raw: bool = False):
+        """
+        Generate a story and yield its text in chunks as it is decoded.
+        Closing the generator early stops the generation at the next token.
+        
+        Args:
+            raw: Yield UTF-8 bytes instead of str (what a socket or HTTP response writes)
+            
+        Yields:
+            Text chunks (str, or bytes with `raw`)
+        """
+        encode = (lambda text: text.encode('utf-8')) if raw else (lambda text: text)
+        if self.mock_mode or self.sharded:
+            # No token stream to tap: yield the finished story a paragraph at a time
+            story = self.generate_story_detailed(prompt, genre, length, temperature, top_p=top_p,
+                                                 max_tokens=max_tokens, adapter=adapter)["story"]
+            for paragraph in re.split(r'(?<=\n\n)', story):
+                yield encode(paragraph)
+            return
+        
+        import torch
+        from transformers import StoppingCriteriaList, TextIteratorStreamer
+        
+        model, tokenizer = self._get_model_and_tokenizer()
+        adapter = self._resolve_adapter(genre, adapter)
+        monitor = GenerationMonitor()
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        system_prompt = self._build_system_prompt(prompt, genre, length)
+        inputs = tokenizer(system_prompt, return_tensors="pt").to(model.device)
+        max_new_tokens = max_tokens or LENGTH_TO_TOKENS.get(length, 1024)
+        monitor.generate_started_at = time.time()
+        
+        def run():
+            try:
+                with torch.no_grad(), self._adapter_guard(), \
+                        self._decode_kwargs(model, inputs["input_ids"].shape[1], max_new_tokens,
+                                            adapter) as cache_kwargs:
+                    model.generate(
+                        **inputs,
+                        max_new_tokens=max_new_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                        do_sample=True,
+                        pad_token_id=tokenizer.eos_token_id,
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList([monitor]),
+                        **self._adapter_kwargs([adapter]),
+                        **cache_kwargs
+                    )
+            finally:
+                # Unblock the reader even if generate failed
+                streamer.end()
+        
+        with self._reserve_memory([system_prompt], max_new_tokens):
+            worker = threading.Thread(target=run, name="story-stream", daemon=True)
+            worker.start()
+            try:
+                for text in streamer:
+                    if text:
+                        yield encode(text)
+            finally:
+                monitor.cancel()
+                worker.join()
+                self._record_decode_speed(monitor)
+                for name, phase_start, phase_end in monitor.phases():
+                    record_span(name, phase_start, phase_end, tokens=monitor.tokens)
+    
+    def generate_in_session(self, session, prompt: str, temperature: float = 0.7, top_p: float = 0.9,
+                            max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Generate the next part of a story session (see story_sessions.StorySession).
+        
+        The first turn writes a story from `prompt`; later turns treat `prompt` as an
+        instruction for continuing it. Only tokens missing from the session's KV cache
+        are prefilled, and the cache returned by `generate` is kept for the next turn.
+        
+        Returns:
+            Dict with `story` (the new part), `tokens_generated`, `prefill_tokens`,
+            `cached_tokens`, `max_new_tokens`, `truncated` and `elapsed`
+        """
+        start_time = time.time()
+        max_new_tokens = max_tokens or LENGTH_TO_TOKENS.get(session.length, 1024)
+        if session.turns == 0:
+            text = self._build_system_prompt(prompt, session.genre, session.length)
+        else:
+            text = f"\n\nContinue the story: {prompt}\n\n"
+        
+        if self.mock_mode:
+            story = self._generate_mock_story(prompt, session.genre, session.length)
+            session.text = f"{session.text}\n\n{story}" if session.text else story
+            session.turns += 1
+            return {
+                "story": story,
+                "truncated": False,
+                "tokens_generated": len(story.split()),
+                "prefill_tokens": len(text.split()),
+                "cached_tokens": 0,
+                "max_new_tokens": max_new_tokens,
+                "elapsed": time.time() - start_time
+            }
+        
+        import torch
+        from transformers import StoppingCriteriaList
+        
+        model, tokenizer = self._get_model_and_tokenizer()
+        monitor = GenerationMonitor()
+        
+        new_ids = tokenizer(text, return_tensors="pt", add_special_tokens=session.token_ids is None)["input_ids"]
+        new_ids = new_ids.to(model.device)
+        if session.token_ids is None:
+            input_ids = new_ids
+        else:
+            input_ids = torch.cat([session.token_ids, new_ids], dim=1)
+        
+        # Past the context window, keep only the most recent tokens and re-prefill them
+        max_context = getattr(model.config, 'max_position_embeddings', None)
+        if max_context and input_ids.shape[1] + max_new_tokens > max_context:
+            input_ids = input_ids[:, -max(1, max_context - max_new_tokens):]
+            session.drop_cache()
+        
+        cache = session.past_key_values
+        cached_tokens = cache.get_seq_length() if hasattr(cache, 'get_seq_length') else 0
+        generate_kwargs = {"past_key_values": cache} if cache is not None else self._new_cache_kwargs(model)
+        generate_kwargs.update(self._adapter_kwargs([self._resolve_adapter(session.genre, None)]))
+        monitor.generate_started_at = time.time()
+        
+        # Only the tokens added this turn; the session's existing cache is counted as a registered cache
+        with self._reserve_memory([text], max_new_tokens):
+            try:
+                with torch.no_grad(), self._adapter_guard():
+                    outputs = model.generate(
+                        input_ids,
+                        attention_mask=torch.ones_like(input_ids),
+                        max_new_tokens=max_new_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                        do_sample=True,
+                        pad_token_id=tokenizer.eos_token_id,
+                        use_cache=True,
+                        return_dict_in_generate=True,
+                        stopping_criteria=StoppingCriteriaList([monitor]),
+                        **generate_kwargs
+                    )
+            except Exception:
+                # generate extends the cache in place, so after a failure it can't be trusted
+                session.drop_cache()
+                raise
+        
+        self._record_decode_speed(monitor)
+        for name, phase_start, phase_end in monitor.phases():
+            record_span(name, phase_start, phase_end, tokens=monitor.tokens)
+        
+        story = tokenizer.decode(outputs.sequences[0, input_ids.shape[1]:], skip_special_tokens=True).strip()
+        session.token_ids = outputs.sequences
+        session.past_key_values = outputs.past_key_values
+        session.text = f"{session.text}\n\n{story}" if session.text else story
+        session.turns += 1
+        
+        return {
+            "story": story,
+            "truncated": False,
+            "tokens_generated": monitor.tokens,
+            "prefill_tokens": int(input_ids.shape[1]) - cached_tokens,
+            "cached_tokens": cached_tokens,
+            "max_new_tokens": max_new_tokens,
+            "elapsed": time.time() - start_time
+        }
+    
+    def _get_model_and_tokenizer(self):
+        """The underlying model and tokenizer, whichever loading method was used."""
+        if self.sharded:
+            raise RuntimeError("Not supported with pipeline_stages > 1: the model is split across processes")
+        if self.use_pipeline and self.pipeline:
+            return self.pipeline.model, self.pipeline.tokenizer
+        return self.model, self.tokenizer
+    
+    def load_adapter(self, name: str, path: str):
+        """
+        Attach (or replace) a LoRA adapter on the resident base model.
+        Can be called while serving; only the adapter's weights are loaded.
+        
+        Args:
+            name: Adapter name; a genre name makes it that genre's default
+            path: Local directory or Hub repo of a peft LoRA adapter
+        """
+        if name == BASE_ADAPTER:
+            raise ValueError(f"'{BASE_ADAPTER}' is reserved for the base model")
+        if self.mock_mode:
+            self.adapters[name] = {"path": path, "bytes": 0}
+            return
+        if self.sharded:
+            raise RuntimeError("LoRA adapters are not supported with pipeline_stages > 1")
+        from peft import PeftModel
+        
+        with self.adapter_lock:
+            model, _ = self._get_model_and_tokenizer()
+            if isinstance(model, PeftModel):
+                if name in model.peft_config:
+                    model.delete_adapter(name)
+                model.load_adapter(path, adapter_name=name)
+            else:
+                model = PeftModel.from_pretrained(model, path, adapter_name=name)
+                self._set_model(model)
+            model.eval()
+            adapter_bytes = sum(p.numel() * p.element_size() for n, p in model.named_parameters()
+                                if f".{name}." in n)
+            self.adapters[name] = {"path": path, "bytes": adapter_bytes}
+        print(f"✅ Loaded adapter {name} from {path} ({adapter_bytes / 1024 ** 2:.1f} MiB)")
+    
+    def unload_adapter(self, name: str):
+        """Detach a LoRA adapter; the base model is unwrapped again when none are left."""
+        with self.adapter_lock:
+            if name not in self.adapters:
+                raise ValueError(f"Unknown adapter '{name}'")
+            del self.adapters[name]
+            if self.mock_mode:
+                return
+            model, _ = self._get_model_and_tokenizer()
+            if self.adapters:
+                model.delete_adapter(name)
+            else:
+                self._set_model(model.unload())
+    
+    def _set_model(self, model):
+        if self.use_pipeline and self.pipeline:
+            self.pipeline.model = model
+        else:
+            self.model = model
+    
+    def _resolve_adapter(self, genre: Optional[str], adapter: Optional[str]) -> Optional[str]:
+        """The adapter a request runs through: the named one, else the genre's, else the base model."""
+        if not self.adapters:
+            if adapter not in (None, BASE_ADAPTER):
+                raise ValueError(f"Unknown adapter '{adapter}'")
+            return None
+        if adapter is not None:
+            if adapter != BASE_ADAPTER and adapter not in self.adapters:
+                raise ValueError(f"Unknown adapter '{adapter}'")
+            return adapter
+        return genre if genre in self.adapters else BASE_ADAPTER
+    
+    def _adapter_kwargs(self, adapters: List[Optional[str]]) -> Dict[str, Any]:
+        """`generate`/forward kwargs routing each batch row through its adapter."""
+        if not self.adapters:
+            return {}
+        return {"adapter_names": [adapter or BASE_ADAPTER for adapter in adapters]}
+    
+    def _adapter_guard(self):
+        return self.adapter_lock if self.adapters else contextlib.nullcontext()
+    
+    def _new_cache_kwargs(self, model) -> Dict[str, Any]:
+        """`generate` kwargs for a fresh KV cache: quantized if kv_cache_bits is set, else the default."""
+        if not self.kv_cache_bits:
+            return {}
+        from kv_quant import make_quantized_cache
+        return {"past_key_values": make_quantized_cache(model.config, self.kv_cache_bits)}
+    
     def _generate_mock_story(self, prompt: str, genre: str, length: str) -> str:
         """
         Generate a mock story for testing purposes.
@@ -235,6 +1358,28 @@ class ModelIntegrationPipeline:
         
         return story
     
+    def wait_until_idle(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the generations running on this instance to finish.
+
+        Returns:
+            False if some were still running after `timeout` seconds
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.memory_lock:
+            while self.kv_reservations:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.memory_lock.wait(remaining)
+        return True
+    
+    def close(self):
+        """Stop the pipeline stage processes, if the model is sharded."""
+        if self.sharded:
+            self.sharded.close()
+            self.sharded = None
+    
     def get_model_info(self) -> Dict[str, Any]:
         """
         Get information about the loaded model.
@@ -243,15 +1388,38 @@ class ModelIntegrationPipeline:
             "model_name": self.model_name,
             "mock_mode": self.mock_mode,
             "use_pipeline": self.use_pipeline,
-            "loaded": not self.mock_mode
+            "loaded": not self.mock_mode,
+            "tokens_per_second": self.tokens_per_second,
+            "kv_cache_bits": self.kv_cache_bits,
+            "adapters": {name: dict(info) for name, info in self.adapters.items()},
+            "profile": self.profile,
+            "memory": self.get_memory_info(),
+            "compiled_decode": {
+                "static_cache_lengths": sorted(self.static_caches),
+                **self.compile_stats
+            } if self.compiled_decode else None,
+            "settings": {
+                "torch_dtype": str(self.torch_dtype),
+                "quantization": self.quantization,
+                "use_cache": self.use_cache,
+                "num_threads": self.num_threads,
+                "cpu_tuning": self.cpu_tuning,
+                "compiled_decode": self.compiled_decode
+            }
         }
         
         if not self.mock_mode:
-            if self.use_pipeline and self.pipeline:
+            if self.sharded:
+                info["method"] = "pipeline-parallel"
+                info["device"] = "cpu"
+                info["pipeline_stages"] = self.sharded.get_info()
+            elif self.use_pipeline and self.pipeline:
                 info["method"] = "pipeline"
                 info["device"] = str(self.pipeline.device)
+                info["dtype"] = str(self.pipeline.model.dtype)
             elif self.model:
                 info["method"] = "traditional"
                 info["device"] = str(self.model.device)
+                info["dtype"] = str(self.model.dtype)
                 
         return info
\ No newline at end of file
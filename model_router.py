@@ -0,0 +1,179 @@
+import time
+import threading
+from typing import Dict, Any, Optional, List
+
+# Cost-based routing across several resident models.
+# Every model has a quality tier (the best tier it may serve) and a relative
+# cost per generated token (roughly its parameter count). A request goes to the
+# cheapest model that meets its quality tier and whose estimated latency --
+# work already assigned to that model plus this request's decode time at the
+# model's measured speed -- fits the request's latency budget. If none fits,
+# the eligible model with the lowest estimate wins. Busy time per model is
+# tracked so the pool can be right-sized.
+
+QUALITY_TIERS = ('draft', 'standard', 'premium')
+
+
+def parse_models(spec: str) -> List[Dict[str, Any]]:
+    """Parse 'name:tier:cost,...' (e.g. 'UnfilteredAI/NSFW-3B:premium:3') into model specs."""
+    models = []
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        name, tier, cost = part.strip().rsplit(':', 2)
+        if tier not in QUALITY_TIERS:
+            raise ValueError(f"Unknown quality tier '{tier}' for {name}; use one of {QUALITY_TIERS}")
+        models.append({"name": name, "tier": tier, "cost": float(cost)})
+    return models
+
+
+class _PooledModel:
+    def __init__(self, backend, tier: str, cost: float):
+        self.backend = backend
+        self.tier = tier
+        self.cost = cost
+        self.assigned = 0  # Routed requests not yet finished (queued or running)
+        self.requests = 0
+        self.tokens = 0
+        self.busy_seconds = 0.0
+        self.service_seconds = None  # Moving average of generation time per request
+
+    @property
+    def name(self) -> str:
+        return self.backend.model_name
+
+
+class ModelRouter:
+    def __init__(self):
+        self.models: List[_PooledModel] = []
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+
+    def add(self, backend, tier: str = 'premium', cost: float = 1.0):
+        """Add a loaded ModelIntegrationPipeline to the pool."""
+        if tier not in QUALITY_TIERS:
+            raise ValueError(f"Unknown quality tier '{tier}'")
+        with self.lock:
+            self.models.append(_PooledModel(backend, tier, cost))
+
+    def replace(self, old_backend, new_backend):
+        """Swap a pooled model's backend (e.g. after /api/switch-model), keeping its tier and cost."""
+        with self.lock:
+            for pooled in self.models:
+                if pooled.backend is old_backend:
+                    pooled.backend = new_backend
+                    pooled.service_seconds = None
+
+    def estimate_seconds(self, pooled: _PooledModel, tokens: int) -> Optional[float]:
+        """Estimated latency of a new request on this model; None until its speed is known."""
+        tokens_per_second = pooled.backend.tokens_per_second
+        if not tokens_per_second:
+            return None
+        queue_wait = pooled.assigned * (pooled.service_seconds or 0.0)
+        return queue_wait + tokens / tokens_per_second
+
+    def route(self, quality: str, tokens: int, latency_budget: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Pick a model and count the request against it; call finish() (or cancel()) afterwards.
+
+        Args:
+            quality: Minimum quality tier
+            tokens: Token budget of the request
+            latency_budget: Seconds the caller is willing to wait, if any
+
+        Returns:
+            Dict with `backend`, `model`, `estimated_seconds` and `met_budget`
+        """
+        required = QUALITY_TIERS.index(quality)
+        with self.lock:
+            eligible = [m for m in self.models if QUALITY_TIERS.index(m.tier) >= required]
+            if not eligible:
+                # Nothing is good enough; the best tier available is the closest match
+                best_tier = max(QUALITY_TIERS.index(m.tier) for m in self.models)
+                eligible = [m for m in self.models if QUALITY_TIERS.index(m.tier) == best_tier]
+            estimates = {id(m): self.estimate_seconds(m, tokens) for m in eligible}
+
+            def fits(m):
+                estimate = estimates[id(m)]
+                # Unmeasured models are assumed to fit until they have served a request
+                return latency_budget is None or estimate is None or estimate <= latency_budget
+
+            fitting = [m for m in eligible if fits(m)]
+            if fitting:
+                chosen = min(fitting, key=lambda m: (m.cost, estimates[id(m)] or 0.0))
+            else:
+                chosen = min(eligible, key=lambda m: estimates[id(m)])
+            chosen.assigned += 1
+            return {
+                "backend": chosen.backend,
+                "model": chosen.name,
+                "tier": chosen.tier,
+                "estimated_seconds": estimates[id(chosen)],
+                "met_budget": bool(fitting)
+            }
+
+    def finish(self, route: Dict[str, Any], busy_seconds: float, tokens: int):
+        """Record a routed request's generation time and output."""
+        with self.lock:
+            pooled = self._find(route)
+            if pooled is None:
+                return
+            pooled.assigned = max(0, pooled.assigned - 1)
+            pooled.requests += 1
+            pooled.tokens += tokens
+            pooled.busy_seconds += busy_seconds
+            if pooled.service_seconds is None:
+                pooled.service_seconds = busy_seconds
+            else:
+                pooled.service_seconds = 0.8 * pooled.service_seconds + 0.2 * busy_seconds
+
+    def cancel(self, route: Dict[str, Any]):
+        """Release a routed request that never ran (e.g. rejected by the scheduler)."""
+        with self.lock:
+            pooled = self._find(route)
+            if pooled is not None:
+                pooled.assigned = max(0, pooled.assigned - 1)
+
+    def tier_of(self, backend) -> Optional[str]:
+        """The quality tier of a pooled backend, or None if it is not in the pool."""
+        with self.lock:
+            for pooled in self.models:
+                if pooled.backend is backend:
+                    return pooled.tier
+        return None
+
+    def _find(self, route: Dict[str, Any]) -> Optional[_PooledModel]:
+        for pooled in self.models:
+            if pooled.backend is route["backend"]:
+                return pooled
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Per-model load; utilization is the fraction of wall time spent generating."""
+        with self.lock:
+            elapsed = max(time.time() - self.started_at, 1e-9)
+            models = []
+            for pooled in self.models:
+                utilization = pooled.busy_seconds / elapsed
+                if utilization > 0.8:
+                    advice = "saturated: add a replica or route less to it"
+                elif pooled.requests and utilization < 0.05:
+                    advice = "mostly idle: candidate for removal"
+                elif not pooled.requests:
+                    advice = "unused"
+                else:
+                    advice = "ok"
+                models.append({
+                    "model": pooled.name,
+                    "tier": pooled.tier,
+                    "cost": pooled.cost,
+                    "assigned": pooled.assigned,
+                    "requests": pooled.requests,
+                    "tokens": pooled.tokens,
+                    "busy_seconds": pooled.busy_seconds,
+                    "utilization": utilization,
+                    "tokens_per_second": pooled.backend.tokens_per_second,
+                    "mean_service_seconds": pooled.service_seconds,
+                    "advice": advice
+                })
+            return {"uptime_seconds": elapsed, "tiers": list(QUALITY_TIERS), "models": models}
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Long-form multi-chapter novel generation
+
+Builds a novel far beyond a single "long" story (and beyond the model's
+context window) on top of ModelIntegrationPipeline:
+
+1. An outline is generated once from the premise
+2. Chapters are generated one after another, each prompted with a bounded
+   rolling context: the outline, a running summary of the story so far and
+   the tail of the previous chapter -- never the full text
+3. After each chapter the running summary is updated, the chapter is written
+   to its own file and appended to novel.md, and the run state is saved
+
+Because every prompt has the same bounded size, memory and per-chapter
+latency stay flat as the novel grows. Rerunning the same command resumes
+after the last completed chapter.
+
+Usage:
+    python novel_pipeline.py my_novel --premise "A forbidden romance in Victorian London" --chapters 20
+    python novel_pipeline.py my_novel --real --model UnfilteredAI/NSFW-3B
+"""
+
+import argparse
+import json
+import os
+import re
+import time
+from typing import Dict, Any, List
+
+from model_integration_pipeline import ModelIntegrationPipeline, GENRES
+
+CHAPTER_LINE = re.compile(r'^\s*(?:chapter\s*)?(\d+)\s*[:.)-]\s*(.+)$', re.IGNORECASE)
+
+
+class NovelPipeline:
+    def __init__(self, model: ModelIntegrationPipeline, output_dir: str, premise: str = "",
+                 genre: str = "romance", chapters: int = 12, chapter_tokens: int = 1024,
+                 summary_tokens: int = 256, temperature: float = 0.8, outline_chars: int = 2000,
+                 summary_chars: int = 2000, tail_chars: int = 1500):
+        """
+        Initialize the novel pipeline.
+
+        Args:
+            model: The model integration used for every generation
+            output_dir: Directory holding the run state, chapter files and novel.md
+            premise: What the novel is about (only used when starting a new novel)
+            genre: Genre of the novel
+            chapters: Number of chapters to write
+            chapter_tokens: New tokens per chapter
+            summary_tokens: New tokens for each running-summary update
+            temperature: Sampling temperature for chapters
+            outline_chars / summary_chars / tail_chars: Bounds on each part of the rolling context
+        """
+        self.model = model
+        self.output_dir = output_dir
+        self.chapter_tokens = chapter_tokens
+        self.summary_tokens = summary_tokens
+        self.temperature = temperature
+        self.outline_chars = outline_chars
+        self.summary_chars = summary_chars
+        self.tail_chars = tail_chars
+        self.state_path = os.path.join(output_dir, "novel.json")
+        self.novel_path = os.path.join(output_dir, "novel.md")
+
+        os.makedirs(output_dir, exist_ok=True)
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+            if premise and premise != self.state['premise']:
+                print(f"⚠️ Resuming the existing novel in {output_dir}; ignoring the new premise")
+        else:
+            self.state = {
+                "premise": premise,
+                "genre": genre,
+                "chapters": chapters,
+                "outline": [],
+                "summary": "",
+                "completed": 0,
+                "novel_bytes": 0,
+                "chapter_stats": []
+            }
+
+    def _save_state(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def chapter_path(self, number: int) -> str:
+        return os.path.join(self.output_dir, f"chapter_{number:03d}.md")
+
+    def generate_outline(self) -> List[str]:
+        """Generate one line per chapter; missing lines get a generic beat."""
+        chapters = self.state['chapters']
+        prompt = (
+            f"You are an expert writer of {self.state['genre']} NSFW novels. "
+            f"Write an outline for a {chapters}-chapter novel based on this premise: {self.state['premise']}\n"
+            f"Give exactly one line per chapter in the form 'Chapter N: what happens'.\n\n"
+        )
+        result = self.model.generate_text(prompt, max_new_tokens=48 * chapters + 64, temperature=0.7)
+        beats = {}
+        for line in result['text'].splitlines():
+            match = CHAPTER_LINE.match(line)
+            if match and 1 <= int(match.group(1)) <= chapters:
+                beats.setdefault(int(match.group(1)), match.group(2).strip())
+        return [beats.get(n, f"The story of {self.state['premise']} continues") for n in range(1, chapters + 1)]
+
+    def _outline_text(self, number: int) -> str:
+        """The outline, windowed around the current chapter if it exceeds outline_chars."""
+        lines = [f"Chapter {n}: {beat}" for n, beat in enumerate(self.state['outline'], 1)]
+        text = "\n".join(lines)
+        if len(text) <= self.outline_chars:
+            return text
+        # Keep the chapters nearest to the one being written
+        window = []
+        for offset in range(len(lines)):
+            for n in (number - 1 - offset, number - 1 + offset):
+                if 0 <= n < len(lines) and lines[n] not in window:
+                    window.append(lines[n])
+            if sum(len(line) + 1 for line in window) > self.outline_chars:
+                break
+        return "\n".join(sorted(window, key=lines.index))[:self.outline_chars]
+
+    def _previous_tail(self, number: int) -> str:
+        """The last tail_chars of the previous chapter, read without loading the whole file."""
+        if number <= 1:
+            return ""
+        path = self.chapter_path(number - 1)
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - self.tail_chars * 4))
+            return f.read().decode('utf-8', errors='ignore')[-self.tail_chars:]
+
+    def build_chapter_prompt(self, number: int) -> str:
+        """Rolling context: outline + running summary + tail of the previous chapter."""
+        parts = [
+            f"You are an expert writer of {self.state['genre']} NSFW novels.",
+            f"Premise: {self.state['premise']}",
+            f"Outline:\n{self._outline_text(number)}"
+        ]
+        if self.state['summary']:
+            parts.append(f"Story so far: {self.state['summary']}")
+        tail = self._previous_tail(number)
+        if tail:
+            parts.append(f"End of the previous chapter:\n...{tail}")
+        parts.append(f"Write Chapter {number}: {self.state['outline'][number - 1]}\n\n")
+        return "\n\n".join(parts)
+
+    def update_summary(self, number: int, chapter_text: str) -> str:
+        """Fold a finished chapter into the running summary, keeping it bounded."""
+        prompt = (
+            f"Story so far: {self.state['summary'] or 'The story begins.'}\n\n"
+            f"Chapter {number}:\n{chapter_text[-self.tail_chars * 2:]}\n\n"
+            f"Rewrite the story-so-far summary to include Chapter {number}, in one short paragraph:\n"
+        )
+        result = self.model.generate_text(prompt, max_new_tokens=self.summary_tokens, temperature=0.3)
+        summary = result['text'].strip() or f"{self.state['summary']} {chapter_text[:200]}"
+        return summary[-self.summary_chars:]
+
+    def run(self) -> Dict[str, Any]:
+        """Generate the remaining chapters, saving progress after each one."""
+        if not self.state['outline']:
+            print("📝 Generating outline...")
+            self.state['outline'] = self.generate_outline()
+            self._save_state()
+
+        # Drop anything appended to novel.md after the last saved state
+        with open(self.novel_path, 'ab') as novel:
+            novel.truncate(self.state['novel_bytes'])
+
+        for number in range(self.state['completed'] + 1, self.state['chapters'] + 1):
+            started = time.time()
+            prompt = self.build_chapter_prompt(number)
+            result = self.model.generate_text(prompt, max_new_tokens=self.chapter_tokens,
+                                              temperature=self.temperature)
+            chapter_text = result['text']
+            chapter_seconds = time.time() - started
+
+            tmp_path = f"{self.chapter_path(number)}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(chapter_text)
+            os.replace(tmp_path, self.chapter_path(number))
+
+            with open(self.novel_path, 'ab') as novel:
+                novel.write(f"## Chapter {number}: {self.state['outline'][number - 1]}\n\n{chapter_text}\n\n".encode('utf-8'))
+                novel_bytes = novel.tell()
+
+            self.state['summary'] = self.update_summary(number, chapter_text)
+            self.state['completed'] = number
+            self.state['novel_bytes'] = novel_bytes
+            self.state['chapter_stats'].append({
+                "chapter": number,
+                "prompt_chars": len(prompt),
+                "tokens": result['tokens_generated'],
+                "chapter_seconds": chapter_seconds,
+                "total_seconds": time.time() - started
+            })
+            self._save_state()
+            print(f"📖 Chapter {number}/{self.state['chapters']} written "
+                  f"({result['tokens_generated']} tokens, {chapter_seconds:.1f}s, prompt {len(prompt)} chars)")
+
+        return self.state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a multi-chapter novel")
+    parser.add_argument('output_dir', help="Directory for the novel (rerun to resume)")
+    parser.add_argument('--premise', default="", help="What the novel is about")
+    parser.add_argument('--genre', default='romance', choices=GENRES)
+    parser.add_argument('--chapters', type=int, default=12)
+    parser.add_argument('--chapter-tokens', type=int, default=1024)
+    parser.add_argument('--temperature', type=float, default=0.8)
+    parser.add_argument('--model', default="UnfilteredAI/NSFW-3B", help="Hugging Face model name or local path")
+    parser.add_argument('--real', action='store_true', help="Load the real model instead of mock mode")
+    args = parser.parse_args()
+
+    if not args.premise and not os.path.exists(os.path.join(args.output_dir, "novel.json")):
+        parser.error("--premise is required to start a new novel")
+
+    model = ModelIntegrationPipeline(model_name=args.model, use_mock=not args.real, use_pipeline=True)
+    novel = NovelPipeline(model, args.output_dir, premise=args.premise, genre=args.genre,
+                          chapters=args.chapters, chapter_tokens=args.chapter_tokens,
+                          temperature=args.temperature)
+    state = novel.run()
+
+    seconds = [c['chapter_seconds'] for c in state['chapter_stats']]
+    print(f"\n🎉 Novel complete: {state['completed']} chapters in {novel.novel_path}")
+    if seconds:
+        print(f"   Per-chapter latency: min {min(seconds):.1f}s, max {max(seconds):.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Pipeline-parallel sharding across local processes
+
+Splits a decoder model's transformer layers into contiguous stages, each run
+by its own worker process pinned to one NUMA node (or an even share of the
+CPUs when the host has fewer nodes than stages). Loading happens after
+pinning, so with the kernel's first-touch policy each stage's weights end up
+in its node's local memory.
+
+- Stage 0 embeds tokens, the last stage applies the final norm and LM head
+  and samples the next token; stages in between only run their layers
+- Activations cross stage boundaries through shared-memory slot buffers:
+  the producer copies its hidden states into a slot and the consumer runs its
+  layers directly on a tensor view of that slot, with no pickling. Queues
+  only carry small control tuples
+- Every request is its own micro-batch with its own KV cache in each stage,
+  so while one request is in stage 1, the next can already be in stage 0.
+  Concurrent requests therefore keep every stage busy
+
+Supports models with the `model.layers` / `model.norm` / `lm_head` layout
+(Llama, Mistral, Qwen2, Gemma, Phi-3, StableLM, ...).
+
+Usage:
+    python pipeline_parallel.py --model /path/to/tiny-llama --stages 2 --self-test
+    ModelIntegrationPipeline(model_name=..., pipeline_stages=2)   # or PIPELINE_STAGES=2
+"""
+
+import argparse
+import glob
+import itertools
+import os
+import threading
+import time
+from typing import Dict, Any, Optional, List, Callable, Set
+
+
+# Stage processes are spawned, so they re-import the caller's main module (e.g. an app
+# that builds its model at import time); this name lets such code tell it is in a stage
+STAGE_PROCESS_PREFIX = "pipeline-stage-"
+
+
+def in_stage_process() -> bool:
+    import multiprocessing
+    return multiprocessing.current_process().name.startswith(STAGE_PROCESS_PREFIX)
+
+
+def _parse_cpulist(text: str) -> Set[int]:
+    """Parse a kernel cpulist such as '0-3,8-11'."""
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            low, high = part.split('-')
+            cpus.update(range(int(low), int(high) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def numa_cpu_sets() -> List[Set[int]]:
+    """The CPUs of each NUMA node that this process may run on (one set if NUMA info is missing)."""
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                       key=lambda p: int(p.split('/node')[-1].split('/')[0])):
+        with open(path) as f:
+            cpus = _parse_cpulist(f.read()) & allowed
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [set(allowed)]
+
+
+def stage_cpu_sets(stages: int) -> List[Set[int]]:
+    """One CPU set per stage: whole NUMA nodes when there are enough, else an even split."""
+    nodes = numa_cpu_sets()
+    if len(nodes) >= stages:
+        return nodes[:stages]
+    cpus = sorted(set().union(*nodes))
+    per_stage = max(1, len(cpus) // stages)
+    return [set(cpus[i * per_stage:(i + 1) * per_stage]) or set(cpus) for i in range(stages)]
+
+
+def split_layers(num_layers: int, stages: int) -> List[range]:
+    """Contiguous, near-equal layer ranges."""
+    if not 1 <= stages <= num_layers:
+        raise ValueError(f"Cannot split {num_layers} layers into {stages} stages")
+    bounds = [round(i * num_layers / stages) for i in range(stages + 1)]
+    return [range(bounds[i], bounds[i + 1]) for i in range(stages)]
+
+
+def sample_token(logits, temperature: float, top_p: float) -> int:
+    """Greedy when temperature <= 0, else temperature + nucleus sampling."""
+    import torch
+    if temperature <= 0:
+        return int(logits.argmax())
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, order = probs.sort(descending=True)
+        # Keep the smallest prefix whose mass reaches top_p (always at least one token)
+        keep = sorted_probs.cumsum(-1) - sorted_probs < top_p
+        probs = torch.zeros_like(probs).scatter(-1, order[keep], sorted_probs[keep])
+    return int(torch.multinomial(probs, 1))
+
+
+def _stage_main(stage: int, stages: int, model_name: str, layers: range, cpus: Set[int], dtype: str,
+                in_queue, next_queue, results, shm_in: Optional[str], shm_out: Optional[str],
+                free_in, free_out, slot_shape: tuple):
+    """Worker process for one stage."""
+    from multiprocessing import shared_memory
+
+    os.sched_setaffinity(0, cpus)
+    import torch
+    from torch import nn
+    from transformers import AutoModelForCausalLM, DynamicCache
+
+    torch.set_num_threads(len(cpus))
+    torch_dtype = getattr(torch, dtype)
+    try:
+        model = AutoModelForCausalLM.from_pretrained(model_name, dtype=torch_dtype, attn_implementation="sdpa",
+                                                     low_cpu_mem_usage=True)
+        inner = model.model
+        # Keep only this stage's layers, renumbered so they index this stage's own KV cache
+        kept = [inner.layers[i] for i in layers]
+        for index, layer in enumerate(kept):
+            layer.self_attn.layer_idx = index
+        inner.layers = nn.ModuleList(kept)
+        config = model.config
+        config.num_hidden_layers = len(kept)
+        if getattr(config, 'layer_types', None):
+            config.layer_types = config.layer_types[layers.start:layers.stop]
+        if stage > 0:
+            inner.embed_tokens = nn.Identity()
+        if stage < stages - 1:
+            inner.norm = nn.Identity()
+            model.lm_head = nn.Identity()
+        model.eval()
+    except Exception as e:
+        results.put(("error", stage, f"{type(e).__name__}: {e}"))
+        return
+
+    def slots(name):
+        if name is None:
+            return None, None
+        shm = shared_memory.SharedMemory(name=name)
+        view = torch.frombuffer(shm.buf, dtype=torch_dtype).view(slot_shape)
+        return shm, view
+
+    shm_in_handle, in_slots = slots(shm_in)
+    shm_out_handle, out_slots = slots(shm_out)
+    caches: Dict[Any, Any] = {}
+    results.put(("ready", stage, len(kept)))
+
+    with torch.no_grad():
+        while True:
+            message = in_queue.get()
+            if message is None:
+                if next_queue is not None:
+                    next_queue.put(None)
+                break
+            op, request_id = message[0], message[1]
+            if op == "free":
+                caches.pop(request_id, None)
+                if next_queue is not None:
+                    next_queue.put(message)
+                continue
+
+            _, _, payload, length, sampling = message
+            cache = caches.get(request_id)
+            if cache is None:
+                cache = caches[request_id] = DynamicCache(config=config)
+            past = cache.get_seq_length()
+            position_ids = torch.arange(past, past + length).unsqueeze(0)
+            slot = None
+            try:
+                if stage == 0:
+                    outputs = inner(input_ids=torch.tensor([payload]), position_ids=position_ids,
+                                    past_key_values=cache, use_cache=True)
+                else:
+                    # Run directly on the shared-memory slot, then hand the slot back (also on failure,
+                    # or the upstream stage would run out of slots and block)
+                    try:
+                        outputs = inner(inputs_embeds=in_slots[payload, :length].unsqueeze(0),
+                                        position_ids=position_ids, past_key_values=cache, use_cache=True)
+                    finally:
+                        free_in.put(payload)
+                hidden = outputs.last_hidden_state[0]
+                if next_queue is None:
+                    logits = model.lm_head(hidden[-1])
+                    results.put(("token", request_id, sample_token(logits, *sampling)))
+                else:
+                    slot = free_out.get()
+                    out_slots[slot, :length].copy_(hidden)
+                    next_queue.put(("step", request_id, slot, length, sampling))
+                    slot = None  # Now owned by the next stage
+            except Exception as e:
+                if slot is not None:
+                    free_out.put(slot)
+                caches.pop(request_id, None)
+                results.put(("failed", request_id, f"stage {stage}: {type(e).__name__}: {e}"))
+
+    for handle in (shm_in_handle, shm_out_handle):
+        if handle is not None:
+            handle.close()
+
+
+class _Request:
+    def __init__(self, request_id: int, prompt_ids: List[int], max_new_tokens: int, sampling: tuple,
+                 eos_token_id: Optional[int], stopping: Optional[Callable]):
+        self.request_id = request_id
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.sampling = sampling
+        self.eos_token_id = eos_token_id
+        self.stopping = stopping
+        self.tokens: List[int] = []
+        self.stopped = False
+        self.error = None
+        self.done = threading.Event()
+
+
+class PipelineParallelModel:
+    def __init__(self, model_name: str, stages: int = 2, cpu_sets: Optional[List[Set[int]]] = None,
+                 max_tokens: int = 4096, slots: int = 4, dtype: str = "float32"):
+        """
+        Start one worker process per stage and wait until every stage has loaded its layers.
+
+        Args:
+            model_name: Hugging Face model name or local path
+            stages: Number of stages (worker processes)
+            cpu_sets: CPUs per stage (defaults to one NUMA node, or an even CPU share, each)
+            max_tokens: Longest chunk (prompt) a stage boundary slot can hold
+            slots: Activation slots per stage boundary, i.e. micro-batches in flight between two stages
+            dtype: torch dtype name for weights and activations
+        """
+        import multiprocessing
+        from multiprocessing import shared_memory
+        import torch
+        from transformers import AutoConfig
+
+        config = AutoConfig.from_pretrained(model_name).get_text_config(decoder=True)
+        self.model_name = model_name
+        self.stages = stages
+        self.layer_ranges = split_layers(config.num_hidden_layers, stages)
+        self.cpu_sets = cpu_sets or stage_cpu_sets(stages)
+        self.max_tokens = max_tokens
+        self.slot_shape = (slots, max_tokens, config.hidden_size)
+        slot_bytes = slots * max_tokens * config.hidden_size * torch.empty(0, dtype=getattr(torch, dtype)).element_size()
+
+        ctx = multiprocessing.get_context('spawn')
+        self._queues = [ctx.Queue() for _ in range(stages)]
+        self._results = ctx.Queue()
+        self._shms = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(stages - 1)]
+        self._free = [ctx.Queue() for _ in range(stages - 1)]
+        for free in self._free:
+            for slot in range(slots):
+                free.put(slot)
+
+        self._processes = []
+        self._requests: Dict[int, _Request] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        try:
+            # Start stages one at a time, so only one full checkpoint is being loaded at any moment
+            for stage in range(stages):
+                process = ctx.Process(target=_stage_main, name=f"{STAGE_PROCESS_PREFIX}{stage}", daemon=True, args=(
+                    stage, stages, model_name, self.layer_ranges[stage], self.cpu_sets[stage], dtype,
+                    self._queues[stage], self._queues[stage + 1] if stage + 1 < stages else None, self._results,
+                    self._shms[stage - 1].name if stage > 0 else None,
+                    self._shms[stage].name if stage + 1 < stages else None,
+                    self._free[stage - 1] if stage > 0 else None,
+                    self._free[stage] if stage + 1 < stages else None,
+                    self.slot_shape
+                ))
+                process.start()
+                self._processes.append(process)
+                kind, _, detail = self._wait_for_stage(process)
+                if kind != "ready":
+                    raise RuntimeError(f"Stage {stage} failed to load: {detail}")
+                print(f"✅ Stage {stage}: layers {self.layer_ranges[stage].start}-{self.layer_ranges[stage].stop - 1} "
+                      f"on CPUs {_format_cpus(self.cpu_sets[stage])}")
+        except BaseException:
+            self.close()
+            raise
+
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._receiver.start()
+
+    def _wait_for_stage(self, process, timeout: float = 600.0) -> tuple:
+        """The stage's ready/error message, or an error tuple if it dies or times out first."""
+        import queue
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                return self._results.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive():
+                    return ("error", None, f"process exited with code {process.exitcode}")
+        return ("error", None, f"not ready after {timeout:.0f}s")
+
+    def _receive(self):
+        """Route sampled tokens back to their requests and feed each request's next step."""
+        while True:
+            message = self._results.get()
+            if message is None:
+                break
+            kind, request_id, value = message
+            with self._lock:
+                request = self._requests.get(request_id)
+            if request is None:
+                continue
+            if kind == "failed":
+                request.error = value
+                self._finish(request)
+                continue
+            request.tokens.append(value)
+            if request.stopping is not None and request.stopping(None, None):
+                request.stopped = True
+            if (request.stopped or len(request.tokens) >= request.max_new_tokens
+                    or value == request.eos_token_id):
+                self._finish(request)
+            else:
+                self._queues[0].put(("step", request_id, [value], 1, request.sampling))
+
+    def _finish(self, request: _Request):
+        self._queues[0].put(("free", request.request_id))
+        with self._lock:
+            self._requests.pop(request.request_id, None)
+        request.done.set()
+
+    def generate(self, prompts: List[List[int]], max_new_tokens: int, temperature: float = 0.7,
+                 top_p: float = 0.9, eos_token_id: Optional[int] = None,
+                 stopping: Optional[List[Callable]] = None) -> List[Dict[str, Any]]:
+        """
+        Generate continuations for several prompts (token id lists), all in flight at once.
+        Safe to call from several threads; their requests share the pipeline.
+
+        Args:
+            stopping: Optional per-prompt callables (e.g. GenerationMonitor), called once per
+                      generated token; returning True stops that prompt
+
+        Returns:
+            One dict per prompt with `tokens` (generated ids) and `stopped` (ended by `stopping`)
+        """
+        if any(len(p) > self.max_tokens for p in prompts):
+            raise ValueError(f"Prompt longer than the {self.max_tokens}-token stage buffer")
+        requests = []
+        for i, prompt_ids in enumerate(prompts):
+            request = _Request(next(self._ids), list(prompt_ids), max_new_tokens, (temperature, top_p),
+                               eos_token_id, stopping[i] if stopping else None)
+            with self._lock:
+                self._requests[request.request_id] = request
+            requests.append(request)
+        for request in requests:
+            self._queues[0].put(("step", request.request_id, request.prompt_ids, len(request.prompt_ids),
+                                 request.sampling))
+        for request in requests:
+            while not request.done.wait(timeout=1.0):
+                if not all(p.is_alive() for p in self._processes):
+                    raise RuntimeError("A pipeline stage process died")
+            if request.error:
+                raise RuntimeError(request.error)
+        return [{"tokens": r.tokens, "stopped": r.stopped} for r in requests]
+
+    def close(self):
+        """Stop the stage processes and release the shared memory."""
+        if self._queues:
+            self._queues[0].put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+        self._processes = []
+
+    def get_info(self) -> Dict[str, Any]:
+        return {
+            "stages": self.stages,
+            "layers": [f"{r.start}-{r.stop - 1}" for r in self.layer_ranges],
+            "cpus": [_format_cpus(c) for c in self.cpu_sets],
+            "slots_per_boundary": self.slot_shape[0]
+        }
+
+
+def _format_cpus(cpus: Set[int]) -> str:
+    cpus = sorted(cpus)
+    ranges = []
+    for _, group in itertools.groupby(enumerate(cpus), key=lambda item: item[1] - item[0]):
+        group = [cpu for _, cpu in group]
+        ranges.append(f"{group[0]}-{group[-1]}" if len(group) > 1 else str(group[0]))
+    return ",".join(ranges)
+
+
+def self_test(model_name: str, stages: int, tokens: int = 32):
+    """Check greedy output against the unsharded model, then compare sequential vs micro-batched throughput."""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    prompts = [
+        "The moonlight filtered through the ancient oak trees",
+        "Aboard the starship Nebula, the crew gathered",
+        "In the candlelit chambers of the medieval castle",
+        "A chance encounter at a coffee shop changes everything",
+    ]
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    reference = AutoModelForCausalLM.from_pretrained(model_name, dtype=torch.float32, attn_implementation="sdpa")
+    reference.eval()
+    prompt_ids = [tokenizer(p)["input_ids"] for p in prompts]
+    expected = []
+    with torch.no_grad():
+        for ids in prompt_ids:
+            output = reference.generate(torch.tensor([ids]), max_new_tokens=tokens, min_new_tokens=tokens,
+                                        do_sample=False, pad_token_id=tokenizer.eos_token_id)
+            expected.append(output[0, len(ids):].tolist())
+    del reference
+
+    sharded = PipelineParallelModel(model_name, stages=stages, max_tokens=256)
+    try:
+        results = sharded.generate(prompt_ids, tokens, temperature=0.0)
+        ok = True
+        for prompt, want, got in zip(prompts, expected, results):
+            match = want == got["tokens"]
+            ok &= match
+            print(f"{'✅' if match else '❌'} {prompt[:40]!r}: {len(got['tokens'])} tokens "
+                  f"{'identical to' if match else 'differ from'} the unsharded model")
+
+        start = time.time()
+        for ids in prompt_ids:
+            sharded.generate([ids], tokens, temperature=0.0)
+        sequential = time.time() - start
+        start = time.time()
+        sharded.generate(prompt_ids, tokens, temperature=0.0)
+        batched = time.time() - start
+        total = tokens * len(prompt_ids)
+        print(f"\n⏱️ One request at a time: {total / sequential:.1f} tokens/s")
+        print(f"⏱️ {len(prompt_ids)} micro-batches in flight: {total / batched:.1f} tokens/s "
+              f"({sequential / batched:.2f}x)")
+    finally:
+        sharded.close()
+    if not ok:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline-parallel model sharding across local processes")
+    parser.add_argument('--model', required=True, help="Model name or local path")
+    parser.add_argument('--stages', type=int, default=2)
+    parser.add_argument('--tokens', type=int, default=32)
+    parser.add_argument('--self-test', action='store_true',
+                        help="Compare against the unsharded model and measure micro-batching throughput")
+    args = parser.parse_args()
+
+    print(f"🧩 NUMA nodes: {[_format_cpus(c) for c in numa_cpu_sets()]}")
+    if args.self_test:
+        self_test(args.model, args.stages, args.tokens)
+    else:
+        for stage, cpus in enumerate(stage_cpu_sets(args.stages)):
+            print(f"   Stage {stage} would run on CPUs {_format_cpus(cpus)}")
+
+
+if __name__ == "__main__":
+    main()
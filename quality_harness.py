@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Quality-regression harness for the fast paths
+
+Every speed mode (lower precision, dynamic int8 weights, quantized KV cache,
+speculative decoding, compiled decode, ...) is compared against a float32
+reference of the same model on a fixed, seeded prompt set:
+
+- perplexity of the reference stories, fed token by token through the mode's
+  decode path (so KV cache quantization is exercised), and its change vs fp32
+- top-1 agreement: how often the mode's next-token argmax matches fp32 on the
+  same teacher-forced positions
+- greedy match: mean fraction of a greedy decode identical to the fp32 decode
+- decode speed and speedup over fp32
+
+Modes that exceed the quality gates make the script exit non-zero, so it can
+guard CI or a deploy. Use a small local model; the fp32 reference is loaded too.
+
+Usage:
+    python quality_harness.py --model hf-internal-testing/tiny-random-LlamaForCausalLM
+    python quality_harness.py --model ./tiny-model --mode kv_int8 --mode dynamic_int8 --json report.json
+"""
+
+import argparse
+import json
+import random
+import time
+import numpy as np
+from typing import Dict, Any, List, Callable
+
+from model_integration_pipeline import (ModelIntegrationPipeline, GENRES, LENGTH_TO_TOKENS, STATIC_PROMPT_BUCKET,
+                                        static_cache_len)
+from benchmark_pipeline import SAMPLE_PROMPTS
+
+REFERENCE_MODE = "fp32"
+
+# name -> setup(model_name) returning {"model", "new_cache" (callable or None), "generate_kwargs"}
+MODES: Dict[str, Callable[[str], Dict[str, Any]]] = {}
+
+
+def register_mode(name: str):
+    """Register a mode setup function under `name` (decorator)."""
+    def decorator(setup):
+        MODES[name] = setup
+        return setup
+    return decorator
+
+
+def _load(model_name: str, dtype):
+    from transformers import AutoModelForCausalLM
+    model = AutoModelForCausalLM.from_pretrained(model_name, dtype=dtype)
+    model.eval()
+    return model
+
+
+@register_mode("fp32")
+def fp32_mode(model_name: str) -> Dict[str, Any]:
+    import torch
+    return {"model": _load(model_name, torch.float32), "new_cache": None, "generate_kwargs": {}}
+
+
+@register_mode("bf16")
+def bf16_mode(model_name: str) -> Dict[str, Any]:
+    import torch
+    return {"model": _load(model_name, torch.bfloat16), "new_cache": None, "generate_kwargs": {}}
+
+
+@register_mode("fp16")
+def fp16_mode(model_name: str) -> Dict[str, Any]:
+    import torch
+    return {"model": _load(model_name, torch.float16), "new_cache": None, "generate_kwargs": {}}
+
+
+@register_mode("dynamic_int8")
+def dynamic_int8_mode(model_name: str) -> Dict[str, Any]:
+    """int8 weights with per-call activation quantization on every Linear (CPU only)."""
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+    model = quantize_dynamic(_load(model_name, torch.float32), {torch.nn.Linear}, dtype=torch.qint8)
+    return {"model": model, "new_cache": None, "generate_kwargs": {}}
+
+
+def _kv_mode(nbits: int):
+    def setup(model_name: str) -> Dict[str, Any]:
+        import torch
+        from kv_quant import make_quantized_cache
+        model = _load(model_name, torch.float32)
+        # A short residual window so the harness's short texts are actually quantized
+        return {"model": model, "new_cache": lambda: make_quantized_cache(model.config, nbits, residual_length=16),
+                "generate_kwargs": {}}
+    return setup
+
+
+register_mode("kv_int8")(_kv_mode(8))
+register_mode("kv_int4")(_kv_mode(4))
+
+
+@register_mode("prompt_lookup")
+def prompt_lookup_mode(model_name: str) -> Dict[str, Any]:
+    """Speculative decoding with n-gram drafts from the prompt; exact for greedy decoding."""
+    import torch
+    return {"model": _load(model_name, torch.float32), "new_cache": None,
+            "generate_kwargs": {"prompt_lookup_num_tokens": 8}}
+
+
+@register_mode("compiled")
+def compiled_mode(model_name: str) -> Dict[str, Any]:
+    """Static KV cache with a torch.compile'd decode step, as with compiled_decode in the backend."""
+    import torch
+    from transformers import StaticCache, CompileConfig
+    model = _load(model_name, torch.float32)
+    config = CompileConfig(fullgraph=False, dynamic=False, mode="default")
+    config._compile_all_devices = True
+    length = static_cache_len(STATIC_PROMPT_BUCKET, LENGTH_TO_TOKENS["short"])
+    return {"model": model, "new_cache": lambda: StaticCache(config=model.config, max_cache_len=length),
+            "generate_kwargs": {"compile_config": config}}
+
+
+def build_prompt_set(count: int, seed: int) -> List[Dict[str, str]]:
+    """Fixed (system prompt, story) pairs: the prompts the app builds and the mock stories as text."""
+    rng = random.Random(seed)
+    builder = ModelIntegrationPipeline(use_mock=True)
+    prompt_set = []
+    for _ in range(count):
+        prompt, genre = rng.choice(SAMPLE_PROMPTS), rng.choice(GENRES)
+        prompt_set.append({
+            "prompt": builder._build_system_prompt(prompt, genre, "short"),
+            "story": builder._generate_mock_story(prompt, genre, "short")
+        })
+    return prompt_set
+
+
+def encode_prompt_set(tokenizer, prompt_set: List[Dict[str, str]], max_story_tokens: int) -> List[Dict[str, Any]]:
+    encoded = []
+    for item in prompt_set:
+        prompt_ids = tokenizer(item["prompt"], return_tensors="pt")["input_ids"]
+        story_ids = tokenizer(item["story"], return_tensors="pt", add_special_tokens=False)["input_ids"]
+        encoded.append({"prompt_ids": prompt_ids, "story_ids": story_ids[:, :max_story_tokens]})
+    return encoded
+
+
+def decode_path_log_probs(setup: Dict[str, Any], prompt_ids, story_ids):
+    """
+    Log-probabilities of the story's next tokens, prefilling the prompt and then
+    feeding the story one token at a time through the mode's cache.
+
+    Returns:
+        [story_tokens, vocab] float32 log-probabilities (row i predicts story token i)
+    """
+    import torch
+    model = setup["model"]
+    kwargs = {"past_key_values": setup["new_cache"]()} if setup["new_cache"] else {}
+    rows = []
+    with torch.no_grad():
+        out = model(prompt_ids, use_cache=True, **kwargs)
+        rows.append(out.logits[:, -1])
+        cache = out.past_key_values
+        for position in range(story_ids.shape[1] - 1):
+            out = model(story_ids[:, position:position + 1], past_key_values=cache, use_cache=True)
+            rows.append(out.logits[:, -1])
+            cache = out.past_key_values
+    return torch.log_softmax(torch.cat(rows).float(), dim=-1)
+
+
+def greedy_decode(setup: Dict[str, Any], tokenizer, prompt_ids, tokens: int):
+    """Greedy continuation of exactly `tokens` tokens and the decode time in seconds."""
+    import torch
+    kwargs = dict(setup["generate_kwargs"])
+    if setup["new_cache"]:
+        kwargs["past_key_values"] = setup["new_cache"]()
+    start = time.perf_counter()
+    with torch.no_grad():
+        output = setup["model"].generate(
+            prompt_ids, attention_mask=torch.ones_like(prompt_ids), max_new_tokens=tokens, min_new_tokens=tokens,
+            do_sample=False, pad_token_id=tokenizer.eos_token_id, **kwargs
+        )
+    return output[0, prompt_ids.shape[1]:], time.perf_counter() - start
+
+
+def evaluate_mode(setup: Dict[str, Any], tokenizer, encoded: List[Dict[str, Any]], greedy_tokens: int,
+                  reference: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Quality and speed of one mode; agreement metrics need the reference's evaluation."""
+    import torch
+    # One untimed generation first, so lazy initialization (or compilation) is not measured
+    greedy_decode(setup, tokenizer, encoded[0]["prompt_ids"], 2)
+
+    nll, scored, argmaxes, greedy, decode_seconds = 0.0, 0, [], [], 0.0
+    for item in encoded:
+        log_probs = decode_path_log_probs(setup, item["prompt_ids"], item["story_ids"])
+        targets = item["story_ids"][0]
+        nll -= log_probs[torch.arange(len(targets)), targets].sum().item()
+        scored += len(targets)
+        argmaxes.append(log_probs.argmax(-1))
+        tokens, seconds = greedy_decode(setup, tokenizer, item["prompt_ids"], greedy_tokens)
+        greedy.append(tokens)
+        decode_seconds += seconds
+
+    result = {
+        "perplexity": float(np.exp(nll / scored)),
+        "tokens_per_second": greedy_tokens * len(encoded) / decode_seconds,
+        "_argmaxes": argmaxes,
+        "_greedy": greedy
+    }
+    if reference is not None:
+        agree = sum((a == b).sum().item() for a, b in zip(argmaxes, reference["_argmaxes"]))
+        prefixes = [(a == b).int().cumprod(0).sum().item() / greedy_tokens
+                    for a, b in zip(greedy, reference["_greedy"])]
+        result.update({
+            "perplexity_delta": result["perplexity"] / reference["perplexity"] - 1,
+            "top1_agreement": agree / scored,
+            "greedy_match": float(np.mean(prefixes)),
+            "speedup": result["tokens_per_second"] / reference["tokens_per_second"]
+        })
+    return result
+
+
+def run_harness(model_name: str, modes: List[str], prompts: int = 6, seed: int = 1234, story_tokens: int = 96,
+                greedy_tokens: int = 32) -> Dict[str, Dict[str, Any]]:
+    """Evaluate `modes` against the fp32 reference; returns mode -> metrics (the reference included)."""
+    import torch
+    from transformers import AutoTokenizer
+
+    torch.manual_seed(seed)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    encoded = encode_prompt_set(tokenizer, build_prompt_set(prompts, seed), story_tokens)
+
+    print(f"🔬 Reference: {REFERENCE_MODE} on {prompts} prompts")
+    reference = evaluate_mode(MODES[REFERENCE_MODE](model_name), tokenizer, encoded, greedy_tokens)
+    results = {REFERENCE_MODE: reference}
+    for mode in modes:
+        if mode == REFERENCE_MODE:
+            continue
+        print(f"🔬 Mode: {mode}")
+        try:
+            setup = MODES[mode](model_name)
+        except Exception as e:
+            print(f"⚠️ Skipping {mode}: {e}")
+            results[mode] = {"error": str(e)}
+            continue
+        results[mode] = evaluate_mode(setup, tokenizer, encoded, greedy_tokens, reference)
+        del setup
+
+    return {mode: {k: v for k, v in metrics.items() if not k.startswith('_')} for mode, metrics in results.items()}
+
+
+def gate(results: Dict[str, Dict[str, Any]], max_ppl_increase: float, min_agreement: float) -> List[str]:
+    """Modes that fail the quality gates."""
+    return [
+        mode for mode, metrics in results.items()
+        if mode != REFERENCE_MODE and "error" not in metrics
+        and (metrics["perplexity_delta"] > max_ppl_increase or metrics["top1_agreement"] < min_agreement)
+    ]
+
+
+def print_report(results: Dict[str, Dict[str, Any]], failed: List[str]):
+    print(f"\n{'mode':<14}{'speedup':>9}{'tok/s':>10}{'ppl':>10}{'Δppl':>9}{'top-1':>8}{'greedy':>8}")
+    for mode, m in results.items():
+        if "error" in m:
+            print(f"{mode:<14}  skipped: {m['error']}")
+            continue
+        if mode == REFERENCE_MODE:
+            print(f"{mode:<14}{1.0:>8.2f}x{m['tokens_per_second']:>10.1f}{m['perplexity']:>10.2f}"
+                  f"{'-':>9}{'-':>8}{'-':>8}")
+            continue
+        flag = "  ❌" if mode in failed else "  ✅"
+        print(f"{mode:<14}{m['speedup']:>8.2f}x{m['tokens_per_second']:>10.1f}{m['perplexity']:>10.2f}"
+              f"{m['perplexity_delta']:>+9.2%}{m['top1_agreement']:>8.1%}{m['greedy_match']:>8.1%}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed vs quality of each fast path against an fp32 reference")
+    parser.add_argument('--model', default="hf-internal-testing/tiny-random-LlamaForCausalLM",
+                        help="Small model name or local path")
+    parser.add_argument('--mode', action='append', choices=sorted(MODES),
+                        help="Mode to evaluate (repeatable; default: all)")
+    parser.add_argument('--prompts', type=int, default=6, help="Prompts in the seeded prompt set")
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--story-tokens', type=int, default=96, help="Story tokens scored per prompt")
+    parser.add_argument('--greedy-tokens', type=int, default=32, help="Tokens per greedy decode")
+    parser.add_argument('--max-ppl-increase', type=float, default=0.05,
+                        help="Gate: maximum relative perplexity increase over fp32")
+    parser.add_argument('--min-agreement', type=float, default=0.9, help="Gate: minimum top-1 agreement with fp32")
+    parser.add_argument('--json', help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = run_harness(args.model, args.mode or sorted(MODES), args.prompts, args.seed,
+                          args.story_tokens, args.greedy_tokens)
+    failed = gate(results, args.max_ppl_increase, args.min_agreement)
+    print_report(results, failed)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"model": args.model, "seed": args.seed, "results": results, "failed": failed}, f, indent=2)
+    if failed:
+        print(f"\n❌ Over the quality gates: {', '.join(failed)}")
+        raise SystemExit(1)
+    print("\n✅ All modes within the quality gates")
+
+
+if __name__ == "__main__":
+    main()
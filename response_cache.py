@@ -0,0 +1,285 @@
+import re
+import time
+import zlib
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional, Tuple, List
+
+import numpy as np
+
+from model_router import QUALITY_TIERS
+
+# Cache of finished stories, used as the last degradation level under overload:
+# a stored story for the same prompt, or failing that for the same genre and
+# length, is returned instead of queueing another generation. Each story keeps
+# the quality tier of the model that wrote it, and is only served to requests
+# asking for that tier or a lower one.
+#
+# SemanticCache (opt-in) serves rephrasings of earlier prompts at any load:
+# prompt embeddings live in one contiguous float32 matrix, and a lookup is a
+# single matrix-vector product (cosine similarity of unit vectors) masked to
+# the request's genre and length, the quality tiers that may serve it and its
+# sampling temperature.
+
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r'\s+', ' ', prompt.strip().lower())
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 512, ttl: float = 3600.0):
+        """
+        Initialize the response cache.
+
+        Args:
+            max_entries: Stories kept (least recently used are evicted first)
+            ttl: Seconds a story stays servable
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"stores": 0, "exact_hits": 0, "fallback_hits": 0, "misses": 0, "evictions": 0}
+
+    def put(self, prompt: str, genre: str, length: str, story: str, tokens_generated: int, tier: str):
+        """Store a story written by a model of quality tier `tier`."""
+        key = (normalize_prompt(prompt), genre, length)
+        with self.lock:
+            self.entries[key] = {
+                "story": story,
+                "tokens_generated": tokens_generated,
+                "tier": tier,
+                "stored_at": time.time()
+            }
+            self.entries.move_to_end(key)
+            self.stats["stores"] += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def get(self, prompt: str, genre: str, length: str, fallback: bool = True,
+            tier: str = QUALITY_TIERS[0]) -> Optional[Dict[str, Any]]:
+        """
+        A cached story for this prompt, or (with `fallback`) the most recent one for
+        the same genre and length, written by a model of at least quality tier `tier`.
+        The result's `match` is 'exact' or 'genre_length'.
+        """
+        key = (normalize_prompt(prompt), genre, length)
+        required = QUALITY_TIERS.index(tier)
+        with self.lock:
+            self._expire()
+            entry = self.entries.get(key)
+            if entry is not None and QUALITY_TIERS.index(entry["tier"]) >= required:
+                self.entries.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return dict(entry, match="exact")
+            if fallback:
+                for (_, entry_genre, entry_length), entry in reversed(self.entries.items()):
+                    if (entry_genre == genre and entry_length == length
+                            and QUALITY_TIERS.index(entry["tier"]) >= required):
+                        self.stats["fallback_hits"] += 1
+                        return dict(entry, match="genre_length")
+            self.stats["misses"] += 1
+            return None
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        # Entries are in least-recently-used order, but a touched old entry can sit at the end
+        for key in [k for k, e in self.entries.items() if e["stored_at"] < cutoff]:
+            del self.entries[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "ttl": self.ttl, **self.stats}
+
+
+class HashingEncoder:
+    """
+    Word and character-trigram feature hashing into a fixed-size unit vector.
+    Needs no model download; catches reworded and reordered near-duplicates
+    that share most of their words, not paraphrases with different ones.
+    """
+    name = "hashing"
+    default_threshold = 0.8
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[int]:
+        text = normalize_prompt(text)
+        words = re.findall(r"\w+", text)
+        grams = [text[i:i + 3] for i in range(max(len(text) - 2, 0))]
+        return [zlib.crc32(f.encode('utf-8')) % self.dim for f in words + grams]
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            np.add.at(vectors[row], self._features(text), 1.0)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class TransformerEncoder:
+    """Mean-pooled sentence embeddings from a small local encoder (e.g. all-MiniLM-L6-v2)."""
+    default_threshold = 0.9
+
+    def __init__(self, model_name: str):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+        self.name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if self.tokenizer.pad_token is None:
+            # Padded positions are masked out of the mean, so any token will do
+            self.tokenizer.pad_token = self.tokenizer.eos_token or self.tokenizer.unk_token
+        self.model = AutoModel.from_pretrained(model_name, dtype=torch.float32)
+        self.model.eval()
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        import torch
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=128, return_tensors="pt")
+        with torch.no_grad():
+            hidden = self.model(**inputs).last_hidden_state
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(1) / mask.sum(1).clamp(min=1)
+        return torch.nn.functional.normalize(pooled, dim=-1).numpy().astype(np.float32)
+
+
+def load_encoder(spec: str):
+    """'hashing', or a Hugging Face encoder name/path; falls back to hashing if the encoder can't be loaded."""
+    if spec == HashingEncoder.name:
+        return HashingEncoder()
+    try:
+        return TransformerEncoder(spec)
+    except Exception as e:
+        print(f"⚠️ Could not load prompt encoder {spec} ({e}); using the hashing encoder")
+        return HashingEncoder()
+
+
+class SemanticCache:
+    def __init__(self, encoder, capacity: int = 1024, threshold: Optional[float] = None, ttl: float = 3600.0):
+        """
+        Initialize the semantic cache.
+
+        Args:
+            encoder: HashingEncoder or TransformerEncoder (see load_encoder)
+            capacity: Stories kept; the least recently used is evicted when full
+            threshold: Cosine similarity needed to serve a stored story (default: the encoder's)
+            ttl: Seconds a story stays servable
+        """
+        self.encoder = encoder
+        self.capacity = capacity
+        self.threshold = encoder.default_threshold if threshold is None else threshold
+        self.ttl = ttl
+        # One row per slot; rows of empty slots are zero, so they never score above 0
+        self.vectors = np.zeros((capacity, encoder.dim), dtype=np.float32)
+        self.genres = np.full(capacity, -1, dtype=np.int16)
+        self.lengths = np.full(capacity, -1, dtype=np.int16)
+        self.tiers = np.full(capacity, -1, dtype=np.int8)  # Index in QUALITY_TIERS of the writing model
+        self.temperatures = np.zeros(capacity, dtype=np.float32)
+        self.stored_at = np.zeros(capacity)
+        self.last_used = np.zeros(capacity)
+        self.entries: List[Optional[Dict[str, Any]]] = [None] * capacity
+        self.codes: Dict[str, int] = {}  # Genre and length names -> small ints for the masks
+        self.lock = threading.Lock()
+        self.stats = {"lookups": 0, "hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+        self.embed_seconds: deque = deque(maxlen=1000)
+        self.search_seconds: deque = deque(maxlen=1000)
+
+    def _code(self, name: str) -> int:
+        return self.codes.setdefault(name, len(self.codes))
+
+    def _embed(self, prompt: str) -> Tuple[np.ndarray, float]:
+        """The prompt's unit vector and the seconds it took (encoding runs outside the lock)."""
+        started = time.perf_counter()
+        vector = self.encoder.encode([prompt])[0]
+        return vector, time.perf_counter() - started
+
+    def _expire(self):
+        expired = (self.genres >= 0) & (self.stored_at < time.time() - self.ttl)
+        for slot in np.flatnonzero(expired):
+            self._clear(slot)
+            self.stats["expired"] += 1
+
+    def _clear(self, slot: int):
+        self.vectors[slot] = 0.0
+        self.genres[slot] = self.lengths[slot] = self.tiers[slot] = -1
+        self.entries[slot] = None
+
+    def get(self, prompt: str, genre: str, length: str, tier: str = QUALITY_TIERS[0],
+            temperature: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        The stored story whose prompt is most similar to this one, among stories of the same
+        genre and length written by a model of at least quality tier `tier` (and, if given,
+        sampled at `temperature`), if the similarity reaches the threshold. The result has
+        `similarity` and the stored `prompt`.
+        """
+        query, embed_seconds = self._embed(prompt)
+        with self.lock:
+            started = time.perf_counter()
+            self.embed_seconds.append(embed_seconds)
+            self.stats["lookups"] += 1
+            self._expire()
+            scores = self.vectors @ query
+            excluded = ((self.genres != self.codes.get(genre, -2)) | (self.lengths != self.codes.get(length, -2))
+                        | (self.tiers < QUALITY_TIERS.index(tier)))
+            if temperature is not None:
+                excluded |= np.abs(self.temperatures - temperature) > 1e-3
+            scores[excluded] = -1.0
+            slot = int(np.argmax(scores))
+            similarity = float(scores[slot])
+            self.search_seconds.append(time.perf_counter() - started)
+            if similarity < self.threshold:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.last_used[slot] = time.time()
+            return dict(self.entries[slot], similarity=similarity, match="semantic")
+
+    def put(self, prompt: str, genre: str, length: str, story: str, tokens_generated: int, tier: str,
+            temperature: float):
+        """Store a story sampled at `temperature` by a model of quality tier `tier`."""
+        vector, embed_seconds = self._embed(prompt)
+        normalized = normalize_prompt(prompt)
+        with self.lock:
+            self.embed_seconds.append(embed_seconds)
+            genre_code, length_code = self._code(genre), self._code(length)
+            same = [i for i in np.flatnonzero((self.genres == genre_code) & (self.lengths == length_code))
+                    if self.entries[i]["normalized"] == normalized
+                    and self.entries[i]["tier"] == tier and self.entries[i]["temperature"] == temperature]
+            if same:
+                slot = same[0]  # A newer story for the same prompt replaces the old one
+            else:
+                free = np.flatnonzero(self.genres < 0)
+                if len(free):
+                    slot = int(free[0])
+                else:
+                    slot = int(np.argmin(self.last_used))
+                    self.stats["evictions"] += 1
+            now = time.time()
+            self.vectors[slot] = vector
+            self.genres[slot], self.lengths[slot] = genre_code, length_code
+            self.tiers[slot], self.temperatures[slot] = QUALITY_TIERS.index(tier), temperature
+            self.stored_at[slot] = self.last_used[slot] = now
+            self.entries[slot] = {"prompt": prompt, "normalized": normalized, "story": story,
+                                  "tokens_generated": tokens_generated, "tier": tier,
+                                  "temperature": temperature, "stored_at": now}
+            self.stats["stores"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            embed = np.array(self.embed_seconds) * 1000
+            search = np.array(self.search_seconds) * 1000
+            return {
+                "encoder": self.encoder.name,
+                "entries": int((self.genres >= 0).sum()),
+                "capacity": self.capacity,
+                "threshold": self.threshold,
+                "ttl": self.ttl,
+                "matrix_bytes": self.vectors.nbytes,
+                **self.stats,
+                "hit_rate": self.stats["hits"] / self.stats["lookups"] if self.stats["lookups"] else 0.0,
+                "mean_embed_ms": float(embed.mean()) if len(embed) else None,
+                "mean_search_ms": float(search.mean()) if len(search) else None,
+                "p95_search_ms": float(np.percentile(search, 95)) if len(search) else None
+            }
@@ -0,0 +1,138 @@
+import time
+import threading
+from collections import deque
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+# SLO-driven degradation.
+# Each length bucket has a p95 latency target. The controller watches the
+# latencies of finished requests plus the age of requests still in flight
+# (which is what grows first when the queue backs up), and when the p95 gets
+# close to the target it steps the bucket down one degradation level at a time.
+# It steps back up once the p95 has stayed well under the target, with a
+# cooldown between changes so the level doesn't flap.
+
+LEVELS = ('normal', 'capped_tokens', 'small_model', 'cached')
+
+
+def parse_targets(spec: str) -> Dict[str, float]:
+    """Parse 'short:15,medium:30,long:60' into per-bucket p95 targets in seconds."""
+    targets = {}
+    for part in spec.split(','):
+        if part.strip():
+            name, seconds = part.split(':')
+            targets[name.strip()] = float(seconds)
+    return targets
+
+
+class _Bucket:
+    def __init__(self, target: float, window: int):
+        self.target = target
+        self.latencies = deque(maxlen=window)  # (started_at, finished_at, latency)
+        self.in_flight: Dict[int, float] = {}  # ticket -> started_at
+        self.level = 0
+        self.changed_at = 0.0
+        self.step_downs = 0
+        self.step_ups = 0
+        self.p95 = None
+
+
+class SLOController:
+    def __init__(self, targets: Dict[str, float], window: int = 100, min_samples: int = 10,
+                 risk_fraction: float = 0.9, recover_fraction: float = 0.5, cooldown: float = 15.0,
+                 max_age: float = 120.0, max_level: int = len(LEVELS) - 1):
+        """
+        Initialize the controller.
+
+        Args:
+            targets: p95 latency target in seconds per length bucket
+            window: Recent latencies kept per bucket
+            min_samples: Fewer samples than this never trigger a step down
+            risk_fraction: Step down when p95 >= target * risk_fraction
+            recover_fraction: Step up when p95 < target * recover_fraction (or there is no recent traffic)
+            cooldown: Minimum seconds between level changes of a bucket
+            max_age: Latencies older than this are ignored
+            max_level: Deepest level to use (e.g. 1 when there is no small model or cache)
+        """
+        self.buckets = {name: _Bucket(target, window) for name, target in targets.items()}
+        self.min_samples = min_samples
+        self.risk_fraction = risk_fraction
+        self.recover_fraction = recover_fraction
+        self.cooldown = cooldown
+        self.max_age = max_age
+        self.max_level = max_level
+        self.lock = threading.Lock()
+        self._tickets = 0
+
+    def start(self, bucket: str) -> Optional[tuple]:
+        """Register a request entering the system; pass the ticket to finish()."""
+        with self.lock:
+            if bucket not in self.buckets:
+                return None
+            self._tickets += 1
+            self.buckets[bucket].in_flight[self._tickets] = time.time()
+            return bucket, self._tickets
+
+    def finish(self, ticket: Optional[tuple]):
+        """Record the end-to-end latency of a request started with start()."""
+        if ticket is None:
+            return
+        bucket_name, ticket_id = ticket
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets[bucket_name]
+            started_at = bucket.in_flight.pop(ticket_id, None)
+            if started_at is not None:
+                bucket.latencies.append((started_at, now, now - started_at))
+
+    def level(self, bucket: str) -> int:
+        """Current degradation level of a bucket (re-evaluated on every call)."""
+        with self.lock:
+            if bucket not in self.buckets:
+                return 0
+            return self._evaluate(self.buckets[bucket], time.time())
+
+    def _p95(self, bucket: _Bucket, now: float) -> tuple:
+        """(p95 or None, number of samples) over recent and in-flight requests."""
+        # Finished requests only count if they were served entirely at the current level
+        samples = [latency for started_at, finished_at, latency in bucket.latencies
+                   if started_at >= bucket.changed_at and now - finished_at <= self.max_age]
+        # Requests still waiting will take at least as long as they have so far
+        samples.extend(now - started_at for started_at in bucket.in_flight.values())
+        if not samples:
+            return None, 0
+        return float(np.percentile(samples, 95)), len(samples)
+
+    def _evaluate(self, bucket: _Bucket, now: float) -> int:
+        bucket.p95, samples = self._p95(bucket, now)
+        if now - bucket.changed_at < self.cooldown:
+            return bucket.level
+        at_risk = samples >= self.min_samples and bucket.p95 >= bucket.target * self.risk_fraction
+        if at_risk and bucket.level < self.max_level:
+            bucket.level += 1
+            bucket.step_downs += 1
+            bucket.changed_at = now
+        elif bucket.level > 0 and (bucket.p95 is None or bucket.p95 < bucket.target * self.recover_fraction):
+            bucket.level -= 1
+            bucket.step_ups += 1
+            bucket.changed_at = now
+        return bucket.level
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self.lock:
+            stats = {}
+            for name, bucket in self.buckets.items():
+                self._evaluate(bucket, now)
+                stats[name] = {
+                    "level": bucket.level,
+                    "mode": LEVELS[bucket.level],
+                    "target_p95": bucket.target,
+                    "p95": bucket.p95,
+                    "samples": sum(1 for started_at, _, _ in bucket.latencies if started_at >= bucket.changed_at),
+                    "in_flight": len(bucket.in_flight),
+                    "step_downs": bucket.step_downs,
+                    "step_ups": bucket.step_ups
+                }
+            return {"levels": list(LEVELS), "max_level": self.max_level, "buckets": stats}
@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+from collections import Counter
+from typing import Dict, Any, Optional, List
+
+from tracing import current_span
+
+# Opt-in profiling of slow generations (PROFILE_SLOW_REQUESTS=1).
+# Each generation registers its thread and the time at which it counts as slow
+# (slow_factor times its expected latency). One watcher thread sleeps until the
+# earliest of those times; only requests still running then have their Python
+# stack sampled every `interval` seconds until they finish. A request that
+# finishes in time costs a dict insert and delete. A small random fraction
+# (sample_rate) is sampled from the start, and also records torch operator
+# timings, since the torch profiler cannot be attached to a running call.
+# Profiles are JSON files in a bounded directory, with stacks in the folded
+# format that flame graph tools read.
+
+MAX_STACK_DEPTH = 64
+
+
+def fold_stack(frame) -> str:
+    """'file:function:line;...' from the outermost frame to `frame`."""
+    parts = []
+    while frame is not None and len(parts) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ';'.join(reversed(parts))
+
+
+class _Request:
+    def __init__(self, name: str, attributes: Dict[str, Any], threshold: float, reason: Optional[str]):
+        self.name = name
+        self.attributes = attributes
+        self.thread_id = threading.get_ident()
+        self.started_at = time.time()
+        self.threshold = threshold
+        self.slow_at = self.started_at + threshold
+        self.reason = reason  # 'random' from the start, 'slow' once past the threshold
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.torch_profile = None
+        self.torch_startup_seconds = None
+
+    def restart_clock(self):
+        """Start timing now, e.g. after the torch profiler has started."""
+        self.started_at = time.time()
+        self.slow_at = self.started_at + self.threshold
+
+
+class _NoopProfile:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_PROFILE = _NoopProfile()
+
+
+class _Profile:
+    def __init__(self, profiler: 'SlowRequestProfiler', request: _Request, with_torch: bool):
+        self.profiler = profiler
+        self.request = request
+        self.with_torch = with_torch
+
+    def __enter__(self):
+        if self.with_torch:
+            self.request.torch_profile = self.profiler._start_torch_profile()
+            # The profiler's startup is recorded separately, not as request time
+            self.request.torch_startup_seconds = time.time() - self.request.started_at
+            self.request.restart_clock()
+        self.profiler._register(self.request)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler._finish(self.request, error=repr(exc) if exc is not None else None)
+        return False
+
+
+class SlowRequestProfiler:
+    def __init__(self, directory: str = "profiles", enabled: bool = False, slow_factor: float = 2.0,
+                 slow_seconds: float = 30.0, sample_rate: float = 0.0, interval: float = 0.01,
+                 max_profiles: int = 50, max_bytes: int = 50 * 1024 * 1024):
+        """
+        Initialize the profiler. Nothing runs until it is enabled and a request is profiled.
+
+        Args:
+            directory: Where profiles are written
+            enabled: Profile at all; when False, profile() returns a shared no-op
+            slow_factor: A request is slow after this multiple of its expected latency
+            slow_seconds: Threshold for requests whose expected latency is unknown
+            sample_rate: Fraction of requests profiled from the start, including torch operators
+            interval: Seconds between stack samples
+            max_profiles: Profiles kept (oldest are deleted first)
+            max_bytes: Total size of the kept profiles
+        """
+        self.directory = directory
+        self.enabled = enabled
+        self.slow_factor = slow_factor
+        self.slow_seconds = slow_seconds
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_profiles = max_profiles
+        self.max_bytes = max_bytes
+        self.active: Dict[int, _Request] = {}
+        self.lock = threading.Condition()
+        self.watcher = None
+        self.stats = {"requests": 0, "slow": 0, "random": 0, "written": 0, "deleted": 0}
+
+    def profile(self, name: str, expected_seconds: Optional[float] = None, **attributes):
+        """
+        Context manager around one generation.
+
+        Args:
+            name: What is being generated (e.g. 'generate_story')
+            expected_seconds: Expected latency, e.g. tokens / live decode speed
+            **attributes: Recorded in the profile (keep prompts out; they may be private)
+        """
+        if not self.enabled:
+            return _NOOP_PROFILE
+        threshold = self.slow_seconds if not expected_seconds else self.slow_factor * expected_seconds
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        return _Profile(self, _Request(name, attributes, threshold, 'random' if sampled else None), sampled)
+
+    def _register(self, request: _Request):
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self._watch, name="slow-profiler", daemon=True)
+                self.watcher.start()
+            self.active[id(request)] = request
+            self.stats["requests"] += 1
+            self.lock.notify()
+
+    def _watch(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                waiting = []
+                for request in self.active.values():
+                    if request.reason is None and now >= request.slow_at:
+                        request.reason = 'slow'
+                    if request.reason is None:
+                        waiting.append(request.slow_at)
+                sampling = [r for r in self.active.values() if r.reason is not None]
+                if not sampling:
+                    # Nothing to sample: sleep until the next request turns slow (or a new one arrives)
+                    self.lock.wait(min(waiting) - now if waiting else None)
+                    continue
+            frames = sys._current_frames()
+            for request in sampling:
+                frame = frames.get(request.thread_id)
+                if frame is not None:
+                    request.stacks[fold_stack(frame)] += 1
+                    request.samples += 1
+            del frames
+            time.sleep(self.interval)
+
+    def _start_torch_profile(self):
+        try:
+            import torch
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            torch_profile = torch.profiler.profile(activities=activities)
+            torch_profile.__enter__()
+            return torch_profile
+        except Exception:
+            return None
+
+    def _torch_ops(self, torch_profile, top: int = 25) -> Optional[List[Dict[str, Any]]]:
+        try:
+            torch_profile.__exit__(None, None, None)
+            averages = sorted(torch_profile.key_averages(), key=lambda e: e.self_cpu_time_total, reverse=True)
+        except Exception:
+            return None
+        return [{
+            "op": event.key,
+            "calls": event.count,
+            "self_cpu_ms": event.self_cpu_time_total / 1000,
+            "cpu_total_ms": event.cpu_time_total / 1000,
+            "device_total_ms": getattr(event, 'device_time_total', 0) / 1000
+        } for event in averages[:top]]
+
+    def _finish(self, request: _Request, error: Optional[str] = None):
+        with self.lock:
+            del self.active[id(request)]
+            if request.reason is not None:
+                self.stats[request.reason] += 1
+        torch_ops = self._torch_ops(request.torch_profile) if request.torch_profile is not None else None
+        if request.reason is None:
+            return
+        elapsed = time.time() - request.started_at
+        span = current_span()
+        profile = {
+            "name": request.name,
+            "reason": request.reason,
+            "started_at": request.started_at,
+            "elapsed_seconds": elapsed,
+            "threshold_seconds": request.threshold,
+            "torch_startup_seconds": request.torch_startup_seconds,
+            "trace_id": span.trace_id if span is not None else None,
+            "error": error,
+            "attributes": request.attributes,
+            "interval": self.interval,
+            "samples": request.samples,
+            "stacks": [{"stack": stack, "count": count} for stack, count in request.stacks.most_common()],
+            "torch_ops": torch_ops
+        }
+        filename = "{}.{:03d}-{}-{}-{}ms.json".format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(request.started_at)), int(request.started_at * 1000) % 1000,
+            request.reason, request.name, int(elapsed * 1000)
+        )
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, filename), 'w') as f:
+                json.dump(profile, f)
+            with self.lock:
+                self.stats["written"] += 1
+            self._prune()
+        except OSError as e:
+            print(f"⚠️ Could not save profile {filename}: {e}")
+
+    def _files(self) -> List[str]:
+        """Profile files, oldest first."""
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith('.json')]
+        except FileNotFoundError:
+            return []
+        return sorted(names, key=lambda n: os.path.getmtime(os.path.join(self.directory, n)))
+
+    def _prune(self):
+        files = self._files()
+        sizes = {n: os.path.getsize(os.path.join(self.directory, n)) for n in files}
+        total = sum(sizes.values())
+        while files and (len(files) > self.max_profiles or total > self.max_bytes):
+            oldest = files.pop(0)
+            total -= sizes[oldest]
+            os.remove(os.path.join(self.directory, oldest))
+            with self.lock:
+                self.stats["deleted"] += 1
+
+    def list_profiles(self) -> List[Dict[str, Any]]:
+        """Summaries of the saved profiles, newest first."""
+        summaries = []
+        for name in reversed(self._files()):
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    profile = json.load(f)
+            except (OSError, ValueError):
+                continue
+            summaries.append({
+                "file": name,
+                "bytes": os.path.getsize(path),
+                **{key: profile.get(key) for key in ("name", "reason", "started_at", "elapsed_seconds",
+                                                     "threshold_seconds", "trace_id", "samples")},
+                "top_stack": profile["stacks"][0]["stack"].rsplit(';', 3)[-3:] if profile.get("stacks") else None
+            })
+        return summaries
+
+    def get_profile(self, name: str) -> Optional[Dict[str, Any]]:
+        if name not in self._files():
+            return None  # Also keeps the name from escaping the directory
+        with open(os.path.join(self.directory, name)) as f:
+            return json.load(f)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "directory": self.directory,
+                "slow_factor": self.slow_factor,
+                "slow_seconds": self.slow_seconds,
+                "sample_rate": self.sample_rate,
+                "active": len(self.active),
+                **self.stats
+            }
+
+
+profiler = SlowRequestProfiler(
+    directory=os.environ.get('PROFILE_DIR', 'profiles'),
+    enabled=os.environ.get('PROFILE_SLOW_REQUESTS', '').lower() in ('1', 'true', 'yes'),
+    slow_factor=float(os.environ.get('PROFILE_SLOW_FACTOR', 2.0)),
+    slow_seconds=float(os.environ.get('PROFILE_SLOW_SECONDS', 30)),
+    sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0.0)),
+    max_profiles=int(os.environ.get('PROFILE_MAX_FILES', 50))
+)
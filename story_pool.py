@@ -0,0 +1,232 @@
+import time
+import threading
+from collections import deque
+from typing import Dict, Any, Optional, List, Tuple, Callable
+
+from response_cache import normalize_prompt
+
+# Idle-time pre-generation: while no real request is queued or running, a
+# background thread fills a small pool of finished stories per (genre, length).
+# Unlike the response cache, a pooled story is handed out once and then
+# replaced, so every reader still gets a fresh story. Refills check for traffic
+# every generated token and abandon the story as soon as a request arrives.
+# Each seed may carry its own sampling settings (temperature, top_p, max_tokens);
+# a pooled story is only served to a request with the settings it was made with.
+
+# The gr.Examples rows in app_spaces.py (prompt, genre, length, temperature, top_p, max_tokens),
+# so clicking an example is instant
+EXAMPLE_PROMPTS = [
+    ("A mysterious stranger enters a cozy bookshop on a rainy evening", "romance", "medium", 0.7, 0.9, 200),
+    ("In a world where magic is forbidden, a young mage discovers their powers", "fantasy", "long", 0.8, 0.9, 300),
+    ("Two rival scientists are forced to work together on a space station", "sci-fi", "medium", 0.6, 0.8, 250),
+    ("A chance encounter at a coffee shop changes everything", "contemporary", "short", 0.7, 0.9, 150),
+    ("A forbidden romance blooms in Victorian London", "historical", "medium", 0.8, 0.9, 200)
+]
+
+# Prompts for requests that take any story of their genre and length
+GENRE_PROMPTS = {
+    "romance": "Two strangers meet at a masquerade ball",
+    "fantasy": "A thief steals a crown that whispers to her",
+    "sci-fi": "A space explorer discovers an alien artifact",
+    "contemporary": "An heiress hires a bodyguard with a secret",
+    "historical": "A spy and a diplomat share a train compartment in 1920s Europe"
+}
+
+
+Seed = Tuple[str, str, str, Optional[float], Optional[float], Optional[int]]
+
+
+def build_seeds(genres: List[str], lengths: List[str], example_settings: bool = False) -> List[Seed]:
+    """
+    (prompt, genre, length, temperature, top_p, max_tokens) targets: the example prompts plus
+    one prompt per genre at every length. Settings of None are the pool's defaults.
+
+    Args:
+        example_settings: Give the example prompts the settings of their gr.Examples rows
+                          (for app_spaces.py, whose examples fill in the sliders too)
+    """
+    seeds = [seed if example_settings else seed[:3] + (None, None, None)
+             for seed in EXAMPLE_PROMPTS if seed[1] in genres and seed[2] in lengths]
+    for genre in genres:
+        for length in lengths:
+            if genre in GENRE_PROMPTS:
+                seeds.append((GENRE_PROMPTS[genre], genre, length, None, None, None))
+    return seeds
+
+
+class StoryPool:
+    def __init__(self, model, seeds: List[Seed], per_key: int = 2, ttl: float = 3600.0,
+                 idle_delay: float = 2.0, temperature: float = 0.7, top_p: float = 0.9,
+                 max_tokens: Optional[int] = None, is_busy: Optional[Callable[[], bool]] = None):
+        """
+        Initialize the pool (call start() to begin refilling).
+
+        Args:
+            model: ModelIntegrationPipeline used for the refills
+            seeds: build_seeds() targets; each (genre, length) with a seed gets a pool
+            per_key: Stories kept ready per (genre, length)
+            ttl: Seconds before an unserved story is thrown away as stale
+            idle_delay: Seconds without requests before refilling starts
+            temperature: Sampling temperature of seeds without their own
+            top_p: Nucleus sampling threshold of seeds without their own
+            max_tokens: Token budget of seeds without their own (default: the length bucket's)
+            is_busy: Returns True while real requests are queued or running (e.g. scheduler.is_idle negated)
+        """
+        self.model = model
+        self.seeds = list(seeds)
+        self.per_key = per_key
+        self.ttl = ttl
+        self.idle_delay = idle_delay
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_tokens = max_tokens
+        self.is_busy = is_busy or (lambda: False)
+        self.pools: Dict[Tuple[str, str], deque] = {(seed[1], seed[2]): deque() for seed in self.seeds}
+        self.lock = threading.Lock()
+        self.last_request_at = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats = {"exact_hits": 0, "any_hits": 0, "misses": 0, "generated": 0, "abandoned": 0,
+                      "expired": 0, "generation_seconds": 0.0}
+        self.served_ages: deque = deque(maxlen=1000)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._refill_loop, name="story-pool", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def replace_model(self, model):
+        """Refill with a new model (e.g. after a model switch); stories from the old one are dropped."""
+        with self.lock:
+            self.model = model
+            for pool in self.pools.values():
+                pool.clear()
+
+    def note_request(self):
+        """Mark real traffic; an in-progress refill stops at its next token."""
+        self.last_request_at = time.time()
+
+    def _should_pause(self) -> bool:
+        return (self.stopped.is_set() or self.is_busy()
+                or time.time() - self.last_request_at < self.idle_delay)
+
+    def _settings(self, temperature: Optional[float], top_p: Optional[float],
+                  max_tokens: Optional[int]) -> Tuple[float, float, Optional[int]]:
+        """Sampling settings with the pool's defaults filled in."""
+        return (self.temperature if temperature is None else round(float(temperature), 6),
+                self.top_p if top_p is None else round(float(top_p), 6),
+                self.max_tokens if max_tokens is None else int(max_tokens))
+
+    def take(self, prompt: str, genre: str, length: str, any_prompt: bool = False,
+             temperature: Optional[float] = None, top_p: Optional[float] = None,
+             max_tokens: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        Remove and return a ready story for this prompt, or (with `any_prompt`) the oldest one
+        for the same genre and length, made with these sampling settings (None: the pool's
+        defaults). The result's `match` is 'exact' or 'any_prompt'.
+        """
+        key = (genre, length)
+        normalized = normalize_prompt(prompt)
+        settings = self._settings(temperature, top_p, max_tokens)
+        with self.lock:
+            self._expire()
+            pool = [e for e in self.pools.get(key, ()) if e["settings"] == settings]
+            entry = next((e for e in pool if e["normalized"] == normalized), None)
+            match = "exact"
+            if entry is None and any_prompt and pool:
+                entry, match = pool[0], "any_prompt"
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.pools[key].remove(entry)
+            self.stats["exact_hits" if match == "exact" else "any_hits"] += 1
+            age = time.time() - entry["created_at"]
+            self.served_ages.append(age)
+            return {"story": entry["story"], "tokens_generated": entry["tokens_generated"],
+                    "prompt": entry["prompt"], "match": match, "age_seconds": age}
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for pool in self.pools.values():
+            while pool and pool[0]["created_at"] < cutoff:
+                pool.popleft()
+                self.stats["expired"] += 1
+
+    def _next_seed(self) -> Optional[Seed]:
+        """The seed whose (genre, length) pool is emptiest, preferring prompts not in it yet."""
+        with self.lock:
+            self._expire()
+            best, best_rank = None, None
+            for seed in self.seeds:
+                prompt, genre, length = seed[:3]
+                settings = self._settings(*seed[3:])
+                pool = self.pools[(genre, length)]
+                if len(pool) >= self.per_key:
+                    continue
+                copies = sum(1 for e in pool
+                             if e["normalized"] == normalize_prompt(prompt) and e["settings"] == settings)
+                rank = (len(pool), copies)
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = seed, rank
+            return best
+
+    def _refill_loop(self):
+        while not self.stopped.is_set():
+            seed = None if self._should_pause() else self._next_seed()
+            if seed is None:
+                self.stopped.wait(0.5)
+                continue
+            prompt, genre, length = seed[:3]
+            settings = self._settings(*seed[3:])
+            started_at = time.time()
+            model = self.model
+            try:
+                result = model.generate_story_detailed(prompt, genre, length, *settings,
+                                                       stop_when=self._should_pause)
+            except Exception as e:
+                print(f"⚠️ Story pool refill failed: {e}")
+                self.stopped.wait(5.0)
+                continue
+            with self.lock:
+                self.stats["generation_seconds"] += time.time() - started_at
+                if result["truncated"] or not result["story"] or model is not self.model:
+                    # Interrupted by real traffic (or the model changed); the partial story is not worth keeping
+                    self.stats["abandoned"] += 1
+                    continue
+                self.pools[(genre, length)].append({
+                    "prompt": prompt,
+                    "normalized": normalize_prompt(prompt),
+                    "story": result["story"],
+                    "tokens_generated": result["tokens_generated"],
+                    "settings": settings,
+                    "created_at": time.time()
+                })
+                self.stats["generated"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Hit rate counts pool lookups; ages are of served stories (staleness)."""
+        with self.lock:
+            self._expire()
+            now = time.time()
+            hits = self.stats["exact_hits"] + self.stats["any_hits"]
+            lookups = hits + self.stats["misses"]
+            ages = list(self.served_ages)
+            oldest = min((e["created_at"] for pool in self.pools.values() for e in pool), default=None)
+            return {
+                "ready": sum(len(pool) for pool in self.pools.values()),
+                "capacity": len(self.pools) * self.per_key,
+                "per_key": self.per_key,
+                "ttl": self.ttl,
+                "refilling": self.thread is not None and not self._should_pause(),
+                **self.stats,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "mean_served_age": sum(ages) / len(ages) if ages else None,
+                "max_served_age": max(ages) if ages else None,
+                "oldest_ready_age": now - oldest if oldest is not None else None
+            }
@@ -0,0 +1,219 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List
+
+# Persistent story sessions.
+# A session keeps the token ids of everything generated so far together with
+# the model's past_key_values, so "continue this story" only has to prefill the
+# new instruction instead of the whole text. Idle sessions are expired by TTL,
+# and under a memory cap the least recently used caches are spilled to disk
+# (or dropped, in which case the next continuation re-prefills from the text).
+# A session with a continuation queued or running is pinned: its cache is never
+# spilled or dropped under it, so the spill file can't go stale.
+
+
+def cache_tensors(past_key_values) -> List[Any]:
+    """All tensors held by a KV cache, whatever its representation."""
+    if past_key_values is None:
+        return []
+    if hasattr(past_key_values, 'layers'):
+        # transformers >= 4.54 Cache objects
+        tensors = []
+        for layer in past_key_values.layers:
+            tensors.extend(t for t in (getattr(layer, 'keys', None), getattr(layer, 'values', None)) if t is not None)
+            # Quantized layers (kv_quant) hold (int data, scales) tuples besides the full-precision residual
+            tensors.extend(cache_tensors(getattr(layer, '_quantized_keys', None)))
+            tensors.extend(cache_tensors(getattr(layer, '_quantized_values', None)))
+        return tensors
+    if hasattr(past_key_values, 'key_cache'):
+        return list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    if hasattr(past_key_values, 'nbytes') and hasattr(past_key_values, 'dtype'):
+        return [past_key_values]
+    if isinstance(past_key_values, (tuple, list)):
+        tensors = []
+        for item in past_key_values:
+            tensors.extend(cache_tensors(item))
+        return tensors
+    return []
+
+
+def cache_nbytes(past_key_values) -> int:
+    """Memory held by a KV cache in bytes."""
+    return sum(t.numel() * t.element_size() for t in cache_tensors(past_key_values))
+
+
+class StorySession:
+    def __init__(self, genre: str, length: str):
+        self.session_id = uuid.uuid4().hex
+        self.genre = genre
+        self.length = length
+        self.text = ""
+        self.token_ids = None  # Everything fed to and generated by the model so far
+        self.past_key_values = None  # KV cache for token_ids (minus the last token)
+        self.spilled_path = None
+        self.pins = 0  # Generations queued or running on this session (guarded by the store's lock)
+        self.turns = 0
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.lock = threading.Lock()  # One generation per session at a time
+
+    @property
+    def cache_bytes(self) -> int:
+        return cache_nbytes(self.past_key_values)
+
+    def drop_cache(self):
+        """Forget the KV cache; the next continuation re-prefills from token_ids."""
+        self.past_key_values = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "genre": self.genre,
+            "length": self.length,
+            "turns": self.turns,
+            "tokens": int(self.token_ids.shape[-1]) if self.token_ids is not None else 0,
+            "cache_bytes": self.cache_bytes,
+            "spilled": self.spilled_path is not None,
+            "created_at": self.created_at,
+            "last_used": self.last_used
+        }
+
+
+class SessionStore:
+    def __init__(self, max_bytes: int = 2 * 1024 ** 3, ttl: float = 1800.0, spill_dir: Optional[str] = None):
+        """
+        Initialize the session store.
+
+        Args:
+            max_bytes: Memory cap for resident KV caches
+            ttl: Seconds of inactivity after which a session is deleted
+            spill_dir: If set, caches evicted under memory pressure are saved here
+                       instead of dropped, and reloaded on the next continuation
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.sessions: "OrderedDict[str, StorySession]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"created": 0, "expired": 0, "spilled": 0, "reloaded": 0, "dropped": 0}
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def create(self, genre: str, length: str) -> StorySession:
+        """A new session, pinned for its first generation (call release() after it)."""
+        session = StorySession(genre, length)
+        session.pins = 1
+        with self.lock:
+            self.sessions[session.session_id] = session
+            self.stats["created"] += 1
+        return session
+
+    def get(self, session_id: str, pin: bool = False) -> Optional[StorySession]:
+        """
+        Look up a session, marking it most recently used and reloading a spilled cache.
+
+        Args:
+            pin: Keep its cache resident until release(), e.g. while a continuation is queued
+        """
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            self.sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            if pin:
+                session.pins += 1
+            if session.spilled_path:
+                self._reload(session)
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                self._remove_spill(session)
+            return session is not None
+
+    def clear(self):
+        """Delete every session (e.g. after switching models, which invalidates their caches)."""
+        with self.lock:
+            for session in self.sessions.values():
+                self._remove_spill(session)
+            self.sessions.clear()
+
+    def release(self, session: StorySession):
+        """Unpin a session after its generation ran (or failed to be queued); enforces the memory cap."""
+        with self.lock:
+            session.pins = max(0, session.pins - 1)
+            session.last_used = time.time()
+            self._enforce_cap(keep=session.session_id)
+
+    def resident_bytes(self) -> int:
+        return sum(s.cache_bytes for s in self.sessions.values())
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for session_id in [sid for sid, s in self.sessions.items() if s.last_used < cutoff and not s.pins]:
+            session = self.sessions.pop(session_id)
+            self._remove_spill(session)
+            self.stats["expired"] += 1
+
+    def _enforce_cap(self, keep: Optional[str] = None):
+        self._expire()
+        total = self.resident_bytes()
+        # Oldest first; skip sessions with a generation queued or running
+        for session in list(self.sessions.values()):
+            if total <= self.max_bytes:
+                break
+            if session.session_id == keep or session.past_key_values is None or session.pins:
+                continue
+            size = session.cache_bytes
+            if self.spill_dir:
+                self._spill(session)
+            else:
+                session.drop_cache()
+                self.stats["dropped"] += 1
+            total -= size
+
+    def _spill(self, session: StorySession):
+        import torch
+        path = os.path.join(self.spill_dir, f"{session.session_id}.pt")
+        torch.save({"past_key_values": session.past_key_values}, path)
+        session.spilled_path = path
+        session.drop_cache()
+        self.stats["spilled"] += 1
+
+    def _reload(self, session: StorySession):
+        import torch
+        try:
+            # Our own files, written by _spill; the cache object is not a plain tensor dict
+            state = torch.load(session.spilled_path, weights_only=False)
+            session.past_key_values = state["past_key_values"]
+            self.stats["reloaded"] += 1
+        except Exception as e:
+            print(f"⚠️ Could not reload spilled session cache: {e}")
+        self._remove_spill(session)
+        self._enforce_cap(keep=session.session_id)
+
+    def _remove_spill(self, session: StorySession):
+        if session.spilled_path:
+            try:
+                os.remove(session.spilled_path)
+            except OSError:
+                pass
+            session.spilled_path = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "resident_bytes": self.resident_bytes(),
+                "max_bytes": self.max_bytes,
+                "spilled_sessions": sum(1 for s in self.sessions.values() if s.spilled_path),
+                "ttl": self.ttl,
+                **self.stats
+            }
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import secrets
+import logging
+import contextvars
+from logging.handlers import RotatingFileHandler
+from typing import Dict, Any, Optional, Tuple
+
+# Lightweight request tracing.
+# Trace ids travel in the W3C `traceparent` header from CodespacesConnector to
+# the Flask app, and through a context variable into ModelIntegrationPipeline.
+# Sampled spans are written one per line in the OpenTelemetry OTLP/JSON format
+# to a local rotating file; unsampled requests only pay for a context variable.
+
+SERVICE_NAME = "nsfw-novel-generator"
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def new_span_id() -> str:
+    return secrets.token_hex(8)
+
+
+def format_traceparent(trace_id: str, span_id: str, sampled: bool) -> str:
+    return f"00-{trace_id}-{span_id}-{'01' if sampled else '00'}"
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """Parse a W3C traceparent header into (trace_id, parent_span_id, sampled)."""
+    if not header:
+        return None
+    parts = header.strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == '0' * 32 or parts[2] == '0' * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def _otlp_value(value) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Span:
+    def __init__(self, tracer: 'Tracer', name: str, trace_id: str, parent_span_id: Optional[str],
+                 sampled: bool, kind: str = 'internal', start: Optional[float] = None,
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_span_id = parent_span_id
+        self.sampled = sampled
+        self.kind = kind
+        self.start_time = time.time() if start is None else start
+        self.end_time = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self._token = None
+
+    @property
+    def traceparent(self) -> str:
+        return format_traceparent(self.trace_id, self.span_id, self.sampled)
+
+    def set_attribute(self, key: str, value):
+        if self.sampled:
+            self.attributes[key] = value
+
+    def activate(self) -> 'Span':
+        """Make this the current span for code running in this context."""
+        self._token = _current_span.set(self)
+        return self
+
+    def finish(self, end: Optional[float] = None):
+        self.end_time = time.time() if end is None else end
+        if self._token is not None:
+            _current_span.reset(self._token)
+            self._token = None
+        if self.sampled:
+            self.tracer.export(self)
+
+    def __enter__(self) -> 'Span':
+        return self.activate()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.error = str(exc)
+        self.finish()
+        return False
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": f"SPAN_KIND_{self.kind.upper()}",
+            "startTimeUnixNano": str(int(self.start_time * 1e9)),
+            "endTimeUnixNano": str(int(self.end_time * 1e9)),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": "STATUS_CODE_ERROR", "message": self.error} if self.error
+                      else {"code": "STATUS_CODE_OK"}
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+
+class Tracer:
+    def __init__(self, path: str = "traces/spans.jsonl", sample_rate: float = 0.01,
+                 max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5):
+        """
+        Initialize the tracer. The trace file is only created once a span is sampled.
+
+        Args:
+            path: Trace file; rotated to path.1 ... path.N when it reaches max_bytes
+            sample_rate: Fraction of new traces recorded (requests arriving with the
+                         traceparent sampled flag are always recorded)
+            max_bytes: Size at which the trace file is rotated
+            backup_count: Rotated files kept
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._logger = None
+
+    def _should_sample(self, trace_id: str) -> bool:
+        # Derived from the trace id, so every process makes the same decision for a trace
+        return int(trace_id[-8:], 16) / 0x100000000 < self.sample_rate
+
+    def start_span(self, name: str, traceparent: Optional[str] = None, kind: str = 'internal',
+                   **attributes) -> Span:
+        """
+        Start a span: a child of the current span if there is one, else a child of
+        the remote parent in `traceparent`, else the root of a new trace.
+        """
+        parent = _current_span.get()
+        if parent is not None:
+            return Span(self, name, parent.trace_id, parent.span_id, parent.sampled, kind, attributes=attributes)
+        remote = parse_traceparent(traceparent)
+        if remote is not None:
+            trace_id, parent_span_id, sampled = remote
+            sampled = sampled or self._should_sample(trace_id)
+            return Span(self, name, trace_id, parent_span_id, sampled, kind, attributes=attributes)
+        trace_id = new_trace_id()
+        return Span(self, name, trace_id, None, self._should_sample(trace_id), kind, attributes=attributes)
+
+    def export(self, span: Span):
+        """Append a finished span to the trace file as an OTLP/JSON export request."""
+        if self._logger is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backup_count)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger = logging.getLogger(f"{__name__}.{id(self)}")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            self._logger = logger
+        self._logger.info(json.dumps({
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp()]}]
+            }]
+        }))
+
+
+tracer = Tracer(
+    path=os.environ.get('TRACE_FILE', 'traces/spans.jsonl'),
+    sample_rate=float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+class _NoopSpan:
+    def set_attribute(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def child_span(name: str, **attributes):
+    """Context manager for a child of the current span; a no-op unless the trace is sampled."""
+    parent = _current_span.get()
+    if parent is None or not parent.sampled:
+        return _NOOP_SPAN
+    return Span(parent.tracer, name, parent.trace_id, parent.span_id, True, attributes=attributes)
+
+
+def record_span(name: str, start: float, end: float, **attributes):
+    """Record an already-measured phase as a child of the current span, if sampled."""
+    parent = _current_span.get()
+    if parent is None or not parent.sampled:
+        return
+    span = Span(parent.tracer, name, parent.trace_id, parent.span_id, True, start=start, attributes=attributes)
+    span.finish(end)
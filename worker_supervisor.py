@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Inference worker supervisor
+
+Runs inference_daemon.py as a child process and replaces it when it has
+served --max-requests requests, when its RSS (with any pipeline stage
+processes) passes --max-rss-mb, or when a generation has made no decode step
+for --step-timeout seconds. Long-running workers grow from allocator
+fragmentation and cached tensors, and a stuck generate() call would otherwise
+hang its request forever.
+
+A replacement is started on a temporary socket, and only once it answers is
+it renamed over the public socket. New connections therefore reach the new
+worker without a gap. The old worker is then drained (SIGUSR1): it finishes
+its requests in progress and closes its connections. InferenceClient
+reconnects on the next call. A stuck worker is killed instead, and the client
+retries the lost call once on the replacement.
+
+Each start, recycle, kill and crash is appended as a JSON line to
+--events-file (a rotating file, like the trace file).
+
+Usage:
+    python worker_supervisor.py --socket /tmp/nsfw-novel.sock --max-requests 500 --max-rss-mb 12000 \\
+        --step-timeout 120 -- --model UnfilteredAI/NSFW-3B
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import logging
+import argparse
+import threading
+import subprocess
+from logging.handlers import RotatingFileHandler
+from typing import Dict, Any, Optional, List
+
+import psutil
+
+from inference_daemon import DEFAULT_SOCKET, MSG_REQUEST, MSG_RESULT, STATUS_METHOD, send_json, recv_frame
+
+DAEMON_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inference_daemon.py')
+
+
+def process_rss(pid: int) -> int:
+    """Resident set size of a process and its children, in bytes."""
+    try:
+        process = psutil.Process(pid)
+        return sum(p.memory_info().rss for p in [process] + process.children(recursive=True))
+    except psutil.Error:
+        return 0
+
+
+def query_status(socket_path: str, timeout: float) -> Optional[Dict[str, Any]]:
+    """A worker's status, or None if it does not answer within `timeout` seconds."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        send_json(sock, MSG_REQUEST, {"method": STATUS_METHOD})
+        frame = recv_frame(sock)
+        if frame is None or frame[0] != MSG_RESULT:
+            return None
+        return json.loads(frame[1])["result"]
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+
+class _Worker:
+    def __init__(self, process: subprocess.Popen, generation: int, socket_path: str):
+        self.process = process
+        self.generation = generation
+        self.socket_path = socket_path  # Temporary path it was started on
+        self.started_at = time.time()
+        self.unresponsive_since = None
+
+
+class WorkerSupervisor:
+    def __init__(self, daemon_args: List[str], socket_path: str = DEFAULT_SOCKET, max_requests: int = 0,
+                 max_rss_mb: float = 0, step_timeout: float = 0, check_interval: float = 5.0,
+                 drain_timeout: float = 300.0, start_timeout: float = 600.0,
+                 events_path: str = "traces/worker_events.jsonl"):
+        """
+        Initialize the supervisor (run() starts the first worker).
+
+        Args:
+            daemon_args: Extra inference_daemon.py arguments (e.g. ['--model', name])
+            socket_path: Public socket the front ends connect to
+            max_requests: Recycle a worker after this many requests (0 disables)
+            max_rss_mb: Recycle a worker once its RSS passes this many MB (0 disables)
+            step_timeout: Kill a worker whose generation made no decode step for this long (0 disables)
+            check_interval: Seconds between health checks
+            drain_timeout: Seconds a recycled worker gets to finish its requests before it is killed
+            start_timeout: Seconds a new worker gets to load its model and answer
+            events_path: JSON-lines file the events are exported to
+        """
+        self.daemon_args = list(daemon_args)
+        self.socket_path = socket_path
+        self.max_requests = max_requests
+        self.max_rss_mb = max_rss_mb
+        self.step_timeout = step_timeout
+        self.check_interval = check_interval
+        self.drain_timeout = drain_timeout
+        self.start_timeout = start_timeout
+        self.events_path = events_path
+        self.generation = 0
+        self.current: Optional[_Worker] = None
+        self.stopped = threading.Event()
+        self._logger = None
+
+    def record_event(self, event: str, worker: _Worker, **details):
+        """Export a lifecycle event as one JSON line (and print it)."""
+        record = {"time": time.time(), "event": event, "pid": worker.process.pid,
+                  "worker_generation": worker.generation, **details}
+        print(f"🔁 {event}: {json.dumps(record)}")
+        if self._logger is None:
+            directory = os.path.dirname(self.events_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handler = RotatingFileHandler(self.events_path, maxBytes=10 * 1024 * 1024, backupCount=5)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger = logging.getLogger(f"{__name__}.{id(self)}")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            self._logger = logger
+        self._logger.info(json.dumps(record))
+
+    def _spawn(self) -> _Worker:
+        """Start a worker on a temporary socket and wait until it answers."""
+        self.generation += 1
+        path = f"{self.socket_path}.{self.generation}"
+        env = dict(os.environ, WORKER_GENERATION=str(self.generation))
+        process = subprocess.Popen([sys.executable, DAEMON_SCRIPT, '--socket', path] + self.daemon_args, env=env)
+        worker = _Worker(process, self.generation, path)
+        deadline = time.time() + self.start_timeout
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Inference worker exited with code {process.returncode} while starting")
+            if os.path.exists(path) and query_status(path, timeout=5.0) is not None:
+                return worker
+            time.sleep(0.5)
+        process.kill()
+        raise RuntimeError(f"Inference worker did not start within {self.start_timeout}s")
+
+    def _promote(self, worker: _Worker):
+        # The rename is atomic, so connecting clients always find a listening worker
+        os.replace(worker.socket_path, self.socket_path)
+        self.current = worker
+
+    def recycle(self, reason: str, kill: bool = False, **details):
+        """Swap in a fresh worker, then drain (or, if stuck, kill) the old one."""
+        old = self.current
+        new = self._spawn()
+        self._promote(new)
+        self.record_event('watchdog_kill' if kill else 'recycle', old, reason=reason, new_pid=new.process.pid,
+                          uptime_seconds=time.time() - old.started_at, **details)
+        if kill:
+            old.process.kill()
+            old.process.wait()
+            return
+        old.process.send_signal(signal.SIGUSR1)
+        threading.Thread(target=self._reap, args=(old,), daemon=True).start()
+
+    def _reap(self, worker: _Worker):
+        try:
+            worker.process.wait(self.drain_timeout)
+        except subprocess.TimeoutExpired:
+            worker.process.kill()
+            worker.process.wait()
+            self.record_event('drain_timeout', worker)
+
+    def check(self):
+        """One health check of the current worker; recycles it if needed."""
+        worker = self.current
+        if worker.process.poll() is not None:
+            self.record_event('crash', worker, exit_code=worker.process.returncode)
+            self._promote(self._spawn())
+            self.record_event('start', self.current, reason='crash')
+            return
+        rss_mb = process_rss(worker.process.pid) / 1024 ** 2
+        status = query_status(self.socket_path, timeout=max(self.check_interval, 1.0))
+        if status is None:
+            # A generate() call holding the GIL blocks the status reply too
+            worker.unresponsive_since = worker.unresponsive_since or time.time()
+            unresponsive = time.time() - worker.unresponsive_since
+            if self.step_timeout and unresponsive > self.step_timeout:
+                self.recycle('unresponsive', kill=True, unresponsive_seconds=unresponsive, rss_mb=rss_mb)
+            return
+        worker.unresponsive_since = None
+        stalled = status["stalled_seconds"]
+        if self.step_timeout and stalled is not None and stalled > self.step_timeout:
+            self.recycle('stalled_generation', kill=True, stalled_seconds=stalled, requests=status["requests"],
+                         rss_mb=rss_mb)
+        elif self.max_rss_mb and rss_mb > self.max_rss_mb:
+            self.recycle('rss', rss_mb=rss_mb, requests=status["requests"])
+        elif self.max_requests and status["requests"] >= self.max_requests:
+            self.recycle('requests', rss_mb=rss_mb, requests=status["requests"])
+
+    def run(self):
+        self._promote(self._spawn())
+        self.record_event('start', self.current, reason='initial')
+        try:
+            while not self.stopped.wait(self.check_interval):
+                try:
+                    self.check()
+                except RuntimeError as e:
+                    # The replacement failed to start; keep the current worker and try again later
+                    print(f"❌ {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.current is not None and self.current.process.poll() is None:
+            self.current.process.terminate()
+            self.current.process.wait()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run inference_daemon.py and recycle it on request count, RSS or stuck generations",
+        epilog="Arguments after -- are passed to inference_daemon.py"
+    )
+    parser.add_argument('--socket', default=os.environ.get('INFERENCE_SOCKET', DEFAULT_SOCKET))
+    parser.add_argument('--max-requests', type=int, default=int(os.environ.get('WORKER_MAX_REQUESTS', 0)))
+    parser.add_argument('--max-rss-mb', type=float, default=float(os.environ.get('WORKER_MAX_RSS_MB', 0)))
+    parser.add_argument('--step-timeout', type=float, default=float(os.environ.get('WORKER_STEP_TIMEOUT', 120)))
+    parser.add_argument('--check-interval', type=float, default=5.0)
+    parser.add_argument('--drain-timeout', type=float, default=300.0)
+    parser.add_argument('--events-file', default=os.environ.get('WORKER_EVENTS_FILE', 'traces/worker_events.jsonl'))
+    args, daemon_args = parser.parse_known_args()
+    if daemon_args and daemon_args[0] == '--':
+        daemon_args = daemon_args[1:]
+
+    supervisor = WorkerSupervisor(
+        daemon_args, args.socket, max_requests=args.max_requests, max_rss_mb=args.max_rss_mb,
+        step_timeout=args.step_timeout, check_interval=args.check_interval, drain_timeout=args.drain_timeout,
+        events_path=args.events_file
+    )
+    signal.signal(signal.SIGTERM, lambda *_: supervisor.stopped.set())
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()